@@ -0,0 +1,48 @@
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+# measures how long a fresh interpreter takes to import the modules a django worker
+# loads at boot, and which heavy analysis libraries get pulled in along the way.
+# run from the felagi/ directory:  python benchmarks/import_time.py
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ["matplotlib", "scipy", "datasets", "pandas", "numpy"]
+
+PROBE = """
+import sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+loaded = [name for name in {heavy!r} if name in sys.modules]
+print(elapsed)
+print(",".join(loaded))
+"""
+
+
+def measure(module, runs):
+    timings = []
+    loaded = []
+    code = PROBE.format(module=module, heavy=HEAVY_MODULES)
+    for _ in range(runs):
+        out = subprocess.run(
+            [sys.executable, "-c", code],
+            cwd=PROJECT_DIR, capture_output=True, text=True, check=True,
+        ).stdout.splitlines()
+        timings.append(float(out[0]))
+        loaded = [name for name in out[1].split(",") if name] if len(out) > 1 else []
+    return timings, loaded
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--module", default="retrieval_system.search_engine")
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    timings, loaded = measure(args.module, args.runs)
+    print(f"import {args.module}: median {statistics.median(timings) * 1000:.1f} ms "
+          f"over {args.runs} runs (min {min(timings) * 1000:.1f} ms)")
+    print("heavy modules loaded:", ", ".join(loaded) if loaded else "none")
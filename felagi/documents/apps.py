@@ -1,6 +1,21 @@
+import os
+
 from django.apps import AppConfig
 
 
 class DocumentsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'documents'
+
+    # every worker maps the newest search snapshot on start, without touching the database.
+    # queries are analyzed with the stopword file of the pipeline when it is there.
+    def ready(self):
+        from django.conf import settings
+        from retrieval_system.text_operations import TextOperations
+        from .snapshot import open_latest
+
+        path = getattr(settings, 'AMHARIC_STOPWORDS_PATH', None)
+        if path and os.path.exists(path):
+            TextOperations.STOPWORDS_PATH = str(path)
+        TextOperations.REFRESH_STOPWORDS_COMMAND = "python manage.py refresh_stopwords"
+        open_latest()
@@ -0,0 +1,54 @@
+import numpy as np
+from django.conf import settings
+
+from .models import Document, Posting, Term
+
+# forward index: every document keeps the ids of its top terms by weight in
+# Document.index_terms, packed as little-endian uint32 with the heaviest term first. it is
+# written when a document is indexed, so a result page reads its index terms from the rows it
+# already fetches and resolves the words with one query instead of joining the Posting table
+# for every result. Document.term_ids holds all of its term ids the same way, which is how a
+# removed document is found in packed posting lists (see packed_postings.py).
+
+FORWARD_INDEX_TERMS = getattr(settings, 'FORWARD_INDEX_TERMS', 32)
+TERM_DTYPE = np.dtype('<u4')
+
+
+# term_weights are (term id, weight) pairs; ties keep the lower term id first
+def pack_terms(term_weights, limit=FORWARD_INDEX_TERMS):
+    ordered = sorted(term_weights, key=lambda item: (-item[1], item[0]))[:limit]
+    return np.asarray([term_id for term_id, _ in ordered], dtype=TERM_DTYPE).tobytes()
+
+
+# some database drivers return a memoryview for a binary field
+def unpack_terms(blob):
+    return np.frombuffer(bytes(blob or b''), dtype=TERM_DTYPE)
+
+
+# the words of every packed list, in order, with one query for all of them
+def index_terms(blobs):
+    term_ids = [unpack_terms(blob).tolist() for blob in blobs]
+    words = dict(Term.objects.filter(id__in={t for ids in term_ids for t in ids}).values_list('id', 'word'))
+    return [[words[t] for t in ids if t in words] for ids in term_ids]
+
+
+# (re)builds the forward index of the documents from their Posting rows, batch_size documents
+# per query, in document id order. packed terms are left out, so it runs before packing.
+def build_forward_index(batch_size=1000):
+    updated = 0
+    last = 0
+    while True:
+        ids = list(Document.objects.filter(pk__gt=last).order_by('pk').values_list('pk', flat=True)[:batch_size])
+        if not ids:
+            return updated
+        last = ids[-1]
+        weights = {doc_id: [] for doc_id in ids}
+        rows = Posting.objects.filter(document_id__in=ids).values_list('document_id', 'term_id', 'tf')
+        for doc_id, term_id, tf in rows:
+            weights[doc_id].append((term_id, tf))
+        batch = [
+            Document(pk=doc_id, index_terms=pack_terms(pairs), term_ids=pack_terms(pairs, limit=None))
+            for doc_id, pairs in weights.items()
+        ]
+        Document.objects.bulk_update(batch, ['index_terms', 'term_ids'])
+        updated += len(batch)
@@ -0,0 +1,90 @@
+import math
+from collections import Counter
+
+from django.db import transaction
+from django.db.models import F
+
+from retrieval_system.text_operations import TextOperations
+from .forward_index import pack_terms, unpack_terms
+from .packed_postings import remove_posting
+from .models import Document, IndexStats, Posting, Term
+from .snapshot import schedule_snapshot
+from .views import convert_amharic_date
+
+# in-place updates of the database index. postings hold the length normalized tf of a term in
+# a document and idf is applied to the query at search time, so adding or removing a document
+# only writes its own postings, the df counter of its terms and the document count; no other
+# row changes. the counters are updated with F() expressions inside the same transaction as
+# the postings, so concurrent updates can't lose increments. every change also bumps the
+# generation that cached posting lists are keyed by, and the document's forward index is
+# written with it; once committed, a change schedules a new search snapshot. a document always
+# gets Posting rows, even for terms whose postings are packed (see packed_postings.py), until
+# pack_postings merges them into the blobs; removing it deletes its rows and takes it out of
+# the blobs it was packed into.
+# like the segments of the retrieval system, a document added here indexes every
+# non-stopword stem; the luhn cutoffs only apply to the full pipeline build.
+
+
+def add_document(entry):
+    url, title, content = TextOperations.analyze_entry(entry, TextOperations.load_amharic_stopwords())
+    counts = Counter(title)
+    counts.update(content)
+    total_terms = sum(counts.values()) or 1
+    tf = {word: count / total_terms for word, count in counts.items()}
+
+    with transaction.atomic():
+        # a url that is already indexed is replaced
+        remove_document(url)
+        Term.objects.bulk_create([Term(word=word) for word in tf], ignore_conflicts=True)
+        terms = Term.objects.in_bulk(list(tf), field_name='word')
+        norm = math.sqrt(sum(w * w for w in tf.values()))
+        document = Document.objects.create(
+            title=entry.get('title', ''),
+            description=entry.get('content', ''),
+            url=url,
+            post_date=convert_amharic_date(entry.get('date', '')),
+            norm=norm,
+            index_terms=pack_terms((terms[word].pk, weight) for word, weight in tf.items()),
+            term_ids=pack_terms(((terms[word].pk, weight) for word, weight in tf.items()), limit=None),
+        )
+        Posting.objects.bulk_create([Posting(term=terms[word], document=document, tf=weight) for word, weight in tf.items()])
+        Term.objects.filter(word__in=list(tf)).update(df=F('df') + 1)
+        IndexStats.objects.get_or_create(pk=1)
+        IndexStats.objects.filter(pk=1).update(total_docs=F('total_docs') + 1, generation=F('generation') + 1)
+        transaction.on_commit(schedule_snapshot)
+    return document
+
+
+def remove_document(url):
+    with transaction.atomic():
+        document = Document.objects.filter(url=url).first()
+        if document is None:
+            return False
+        term_ids = list(Posting.objects.filter(document=document).values_list('term_id', flat=True))
+        if Term.objects.filter(packed__isnull=False).exists():
+            term_ids += remove_packed(document)
+        Term.objects.filter(pk__in=term_ids, df__gt=0).update(df=F('df') - 1)
+        document.delete()
+        IndexStats.objects.get_or_create(pk=1)
+        IndexStats.objects.filter(pk=1).update(generation=F('generation') + 1)
+        IndexStats.objects.filter(pk=1, total_docs__gt=0).update(total_docs=F('total_docs') - 1)
+        transaction.on_commit(schedule_snapshot)
+    return True
+
+
+# packed terms have no rows to find the document by, it is removed from the terms recorded in
+# its term_ids when it was indexed; returns the ids of the terms it was removed from
+def remove_packed(document):
+    terms = Term.objects.select_for_update().filter(packed__isnull=False)
+    term_ids = unpack_terms(document.term_ids).tolist()
+    if term_ids:
+        terms = terms.filter(pk__in=term_ids)
+    # a document indexed before its term ids were recorded is looked for in every packed term
+    removed = []
+    for term in terms.iterator():
+        blob = remove_posting(term.packed, document.pk)
+        if blob is not None:
+            term.packed = blob
+            removed.append(term)
+    Term.objects.bulk_update(removed, ['packed'])
+    return [term.pk for term in removed]
@@ -0,0 +1,14 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from documents.snapshot import write_snapshot
+
+
+class Command(BaseCommand):
+    help = "Writes the memory-mapped search snapshot of the index in the database"
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        path = write_snapshot()
+        self.stdout.write(f"wrote {path} in {time.perf_counter() - start:.1f}s")
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from retrieval_system.records import iter_records
+from documents.indexing import add_document, remove_document
+from documents.snapshot import flush_snapshot
+
+
+class Command(BaseCommand):
+    help = "Adds articles to or removes urls from the index in place, without re-weighting the corpus"
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=('add', 'remove'))
+        parser.add_argument('--input', help="articles to add (JSON array or JSONL)")
+        parser.add_argument('--url', action='append', default=[], help="url to remove, can be repeated")
+
+    def handle(self, *args, **options):
+        if options['action'] == 'add':
+            added = 0
+            for entry in iter_records(options['input']):
+                add_document(entry)
+                added += 1
+            self.stdout.write(f"added {added} documents")
+        else:
+            removed = sum(remove_document(url) for url in options['url'])
+            self.stdout.write(f"removed {removed} documents")
+        # the rebuild the changes scheduled would die with this process
+        path = flush_snapshot()
+        if path is not None:
+            self.stdout.write(f"wrote {path}")
@@ -0,0 +1,201 @@
+import json
+import os
+import time
+
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import F
+
+from retrieval_system.binary_index import BinaryIndex
+from retrieval_system.inverted_index import InvertedIndex
+from retrieval_system.records import iter_records
+from retrieval_system.vocabulary import Vocabulary
+from documents.forward_index import build_forward_index
+from documents.models import Document, IndexStats, Posting, Term
+from documents.snapshot import snapshot_dir, write_snapshot
+from documents.views import convert_amharic_date
+
+# loads a full build of the retrieval system into the database. the articles and the index are
+# streamed, rows are inserted with bulk_create, one transaction per batch, and urls and words are
+# resolved to primary keys a batch at a time. rows that already exist are skipped, and the
+# progress is written next to the index after every batch, so an interrupted load picks up
+# where it stopped when the command is run again. the forward index of the documents is rebuilt
+# from the postings at the end, and so is the search snapshot when one is configured.
+
+
+class Command(BaseCommand):
+    help = "Loads the articles and the inverted index built by the retrieval system into the database"
+
+    def add_arguments(self, parser):
+        root = settings.BASE_DIR.parent
+        parser.add_argument('--articles', default=str(root / 'isr_system' / 'combined_articles.json'),
+                            help="articles as a json array or jsonl")
+        parser.add_argument('--index', default=str(root / 'outputs' / 'inverted_index.json'),
+                            help="inverted_index.json or inverted_index.bin")
+        parser.add_argument('--vocabulary', help="vocabulary of a json index (default: next to the index)")
+        parser.add_argument('--batch-size', type=int, default=5000, help="rows per transaction")
+        parser.add_argument('--restart', action='store_true', help="ignore the progress of an interrupted load")
+
+    def handle(self, *args, **options):
+        if Term.objects.filter(packed__isnull=False).exists():
+            raise CommandError("the postings are packed, run pack_postings --unpack before loading an index")
+        index_path = options['index']
+        self.batch_size = options['batch_size']
+        self.progress_path = index_path + '.load_progress.json'
+        st = os.stat(index_path)
+        stamp = [st.st_mtime_ns, st.st_size]
+        progress = {'index': stamp, 'articles': 0, 'terms': 0}
+        if os.path.exists(self.progress_path) and not options['restart']:
+            with open(self.progress_path, 'r', encoding='utf-8') as f:
+                saved = json.load(f)
+            if saved.get('index') == stamp:
+                progress = saved
+                self.stdout.write(f"resuming after {progress['articles']} articles and {progress['terms']} terms")
+
+        if BinaryIndex.is_binary_index(index_path):
+            index = BinaryIndex(index_path)
+            doc_ids = {index.url(doc_id): doc_id for doc_id in range(index.num_docs)}
+            doc_norms = index.doc_norms
+            postings = (
+                (index.term_name(index.entry_for_id(term_id)), *index.postings(index.entry_for_id(term_id)))
+                for term_id in range(index.num_terms)
+            )
+        else:
+            vocabulary = Vocabulary.load(options['vocabulary'] or Vocabulary.path_for(index_path))
+            header, stream = InvertedIndex.stream(index_path)
+            doc_ids = vocabulary.doc_ids
+            doc_norms = header.get('doc_norms', [])
+            postings = ((vocabulary.terms[term_id], docs, weights) for term_id, docs, weights in stream)
+
+        document_pks = self.load_documents(options['articles'], doc_ids, doc_norms, progress)
+        self.load_postings(postings, document_pks, progress)
+        # the postings are loaded a term at a time, the forward index needs them all
+        start = time.perf_counter()
+        documents = build_forward_index(self.batch_size)
+        self.stdout.write(f"forward index: {documents} documents in {time.perf_counter() - start:.1f}s")
+
+        IndexStats.objects.update_or_create(pk=1, defaults={'total_docs': Document.objects.count()})
+        IndexStats.objects.filter(pk=1).update(generation=F('generation') + 1)
+        if os.path.exists(self.progress_path):
+            os.remove(self.progress_path)
+        if snapshot_dir():
+            self.stdout.write(f"search snapshot: {write_snapshot()}")
+
+    # creates the documents and returns the primary key of every index doc id (-1 for none)
+    def load_documents(self, articles_path, doc_ids, doc_norms, progress):
+        document_pks = np.full(len(doc_norms), -1, dtype=np.int64)
+        meter = RateMeter(self.stdout, 'documents')
+        batch = []
+        seen = 0
+
+        def flush():
+            urls = [entry.get('url', '') for entry in batch]
+            if seen > progress['articles']:
+                documents = []
+                for entry, url in zip(batch, urls):
+                    doc_id = doc_ids.get(url)
+                    documents.append(Document(
+                        title=entry.get('title', ''),
+                        description=entry.get('content', ''),
+                        url=url,
+                        post_date=convert_amharic_date(entry.get('date', '')),
+                        norm=float(doc_norms[doc_id]) if doc_id is not None and doc_id < len(doc_norms) else 0.0,
+                    ))
+                with transaction.atomic():
+                    Document.objects.bulk_create(documents, ignore_conflicts=True)
+                progress['articles'] = seen
+                self.save_progress(progress)
+                meter.add(len(documents))
+            for url, pk in lookup(Document, 'url', urls):
+                doc_id = doc_ids.get(url)
+                if doc_id is not None and doc_id < len(document_pks):
+                    document_pks[doc_id] = pk
+
+        for entry in iter_records(articles_path):
+            batch.append(entry)
+            seen += 1
+            if len(batch) >= self.batch_size:
+                flush()
+                batch = []
+        if batch:
+            flush()
+        meter.done()
+        return document_pks
+
+    def load_postings(self, postings, document_pks, progress):
+        meter = RateMeter(self.stdout, 'postings')
+        terms = []
+        rows = 0
+
+        def flush(next_term):
+            with transaction.atomic():
+                Term.objects.bulk_create([Term(word=word, df=len(docs)) for word, docs, _ in terms], ignore_conflicts=True)
+                term_pks = dict(lookup(Term, 'word', [word for word, _, _ in terms]))
+                batch = []
+                for word, docs, weights in terms:
+                    pks = document_pks[np.asarray(docs, dtype=np.int64)]
+                    batch.extend(
+                        Posting(term_id=term_pks[word], document_id=pk, tf=weight)
+                        for pk, weight in zip(pks.tolist(), np.asarray(weights, dtype=np.float64).tolist()) if pk >= 0
+                    )
+                Posting.objects.bulk_create(batch, ignore_conflicts=True, batch_size=self.batch_size)
+            progress['terms'] = next_term
+            self.save_progress(progress)
+            meter.add(len(batch))
+
+        term_id = -1
+        for term_id, (word, docs, weights) in enumerate(postings):
+            if term_id < progress['terms'] or not len(docs):
+                continue
+            terms.append((word, docs, weights))
+            rows += len(docs)
+            if rows >= self.batch_size:
+                flush(term_id + 1)
+                terms = []
+                rows = 0
+        if terms:
+            flush(term_id + 1)
+        meter.done()
+
+    def save_progress(self, progress):
+        tmp_path = self.progress_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(progress, f)
+        os.replace(tmp_path, self.progress_path)
+
+
+# (value, primary key) of the rows whose field is in values, in chunks the database accepts
+def lookup(model, field, values):
+    chunk = connection.features.max_query_params or len(values) or 1
+    for start in range(0, len(values), chunk):
+        filters = {f'{field}__in': values[start:start + chunk]}
+        yield from model.objects.filter(**filters).values_list(field, 'pk')
+
+
+# rows inserted and rows per second, printed at most every few seconds
+class RateMeter:
+
+    INTERVAL = 5.0
+
+    def __init__(self, stdout, name):
+        self.stdout = stdout
+        self.name = name
+        self.rows = 0
+        self.start = self.last = time.perf_counter()
+
+    def add(self, rows):
+        self.rows += rows
+        now = time.perf_counter()
+        if now - self.last >= RateMeter.INTERVAL:
+            self.last = now
+            self.report(now)
+
+    def report(self, now):
+        elapsed = now - self.start
+        rate = self.rows / elapsed if elapsed > 0 else 0.0
+        self.stdout.write(f"{self.name}: {self.rows} rows in {elapsed:.1f}s ({rate:.0f} rows/s)")
+
+    def done(self):
+        self.report(time.perf_counter())
@@ -0,0 +1,22 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from documents.packed_postings import pack_postings, unpack_postings
+
+
+class Command(BaseCommand):
+    help = "Packs the Posting rows of every term into a blob on the term, or turns them back into rows"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--unpack', action='store_true', help="write the packed terms back as Posting rows")
+        parser.add_argument('--batch-size', type=int, default=1000, help="terms per transaction")
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        if options['unpack']:
+            rows = unpack_postings(options['batch_size'])
+            self.stdout.write(f"created {rows} posting rows in {time.perf_counter() - start:.1f}s")
+        else:
+            rows = pack_postings(options['batch_size'])
+            self.stdout.write(f"packed {rows} posting rows in {time.perf_counter() - start:.1f}s")
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from retrieval_system.text_operations import TextOperations
+
+
+class Command(BaseCommand):
+    help = "Replaces the stopword file the queries use with a snapshot of the uhhlt/amharic-stopwords dataset"
+
+    def handle(self, *args, **options):
+        refreshed = TextOperations.refresh_amharic_stopwords()
+        self.stdout.write(f"wrote {len(refreshed)} stopwords to {TextOperations.STOPWORDS_PATH}")
+        self.stdout.write("rebuild the index with the same file so documents drop the same words")
@@ -0,0 +1,39 @@
+# Generated by Django 5.0.4 on 2026-10-18 12:39
+
+from django.db import migrations, models
+from django.db.models import F, Sum
+
+
+# fills the norm of documents that were imported before the column existed
+def compute_document_norms(apps, schema_editor):
+    Document = apps.get_model('documents', 'Document')
+    Posting = apps.get_model('documents', 'Posting')
+    squares = (
+        Posting.objects.values('document_id')
+        .annotate(total=Sum(F('tf_idf') * F('tf_idf')))
+        .values_list('document_id', 'total')
+    )
+    batch = []
+    for document_id, total in squares.iterator():
+        batch.append(Document(id=document_id, norm=(total or 0.0) ** 0.5))
+        if len(batch) >= 1000:
+            Document.objects.bulk_update(batch, ['norm'])
+            batch = []
+    if batch:
+        Document.objects.bulk_update(batch, ['norm'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0004_alter_document_post_date'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='norm',
+            field=models.FloatField(default=0.0),
+        ),
+        migrations.RunPython(compute_document_norms, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,66 @@
+# Generated by Django 5.0.4 on 2026-10-18 13:05
+
+import math
+
+from django.db import migrations, models
+from django.db.models import F, Sum
+
+
+# postings stored tf * idf; dividing by the idf they were imported with gives back the
+# normalized tf. the idf of a term only depends on its df, so there is one update per df.
+# postings of terms with an idf of 0 (in every document) can't be recovered and become 0.
+def remove_idf_from_postings(apps, schema_editor):
+    Document = apps.get_model('documents', 'Document')
+    Posting = apps.get_model('documents', 'Posting')
+    Term = apps.get_model('documents', 'Term')
+    IndexStats = apps.get_model('documents', 'IndexStats')
+
+    total_docs = Document.objects.count()
+    for df in Term.objects.values_list('df', flat=True).distinct():
+        idf = math.log2(total_docs / df) if df and total_docs else 0.0
+        postings = Posting.objects.filter(term__df=df)
+        if idf > 0:
+            postings.update(tf=F('tf') / idf)
+        else:
+            postings.update(tf=0.0)
+
+    # the norms were over the tf-idf vectors, they are over tf now
+    squares = (
+        Posting.objects.values('document_id')
+        .annotate(total=Sum(F('tf') * F('tf')))
+        .values_list('document_id', 'total')
+    )
+    batch = []
+    for document_id, total in squares.iterator():
+        batch.append(Document(id=document_id, norm=(total or 0.0) ** 0.5))
+        if len(batch) >= 1000:
+            Document.objects.bulk_update(batch, ['norm'])
+            batch = []
+    if batch:
+        Document.objects.bulk_update(batch, ['norm'])
+
+    # the single row IndexStats.load() reads, created here so searches never write it
+    IndexStats.objects.update_or_create(pk=1, defaults={'total_docs': total_docs})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0005_document_norm'),
+    ]
+
+    operations = [
+        migrations.RenameField(
+            model_name='posting',
+            old_name='tf_idf',
+            new_name='tf',
+        ),
+        migrations.CreateModel(
+            name='IndexStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('total_docs', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(remove_idf_from_postings, migrations.RunPython.noop),
+    ]
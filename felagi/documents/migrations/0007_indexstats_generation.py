@@ -0,0 +1,18 @@
+# Generated by Django 5.0.4 on 2026-10-18 13:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0006_posting_tf_indexstats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='indexstats',
+            name='generation',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+    ]
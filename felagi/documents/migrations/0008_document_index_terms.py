@@ -0,0 +1,45 @@
+# Generated by Django 5.0.4 on 2026-10-18 13:10
+
+import numpy as np
+from django.db import migrations, models
+
+# terms kept per document, FORWARD_INDEX_TERMS when this migration was written
+FORWARD_INDEX_TERMS = 32
+
+
+# documents indexed before the forward index existed get theirs from the postings: the ids of
+# their heaviest terms, ties by lower id, packed as little-endian uint32
+def build_forward_index(apps, schema_editor):
+    Document = apps.get_model('documents', 'Document')
+    Posting = apps.get_model('documents', 'Posting')
+    last = 0
+    while True:
+        ids = list(Document.objects.filter(pk__gt=last).order_by('pk').values_list('pk', flat=True)[:1000])
+        if not ids:
+            return
+        last = ids[-1]
+        weights = {doc_id: [] for doc_id in ids}
+        for doc_id, term_id, tf in Posting.objects.filter(document_id__in=ids).values_list('document_id', 'term_id', 'tf'):
+            weights[doc_id].append((term_id, tf))
+        batch = []
+        for doc_id, pairs in weights.items():
+            ordered = sorted(pairs, key=lambda item: (-item[1], item[0]))[:FORWARD_INDEX_TERMS]
+            index_terms = np.asarray([term_id for term_id, _ in ordered], dtype='<u4').tobytes()
+            batch.append(Document(pk=doc_id, index_terms=index_terms))
+        Document.objects.bulk_update(batch, ['index_terms'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0007_indexstats_generation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='index_terms',
+            field=models.BinaryField(default=b''),
+        ),
+        migrations.RunPython(build_forward_index, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.4 on 2026-10-18 13:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0008_document_index_terms'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='term',
+            name='packed',
+            field=models.BinaryField(null=True),
+        ),
+    ]
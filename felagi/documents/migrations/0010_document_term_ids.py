@@ -0,0 +1,41 @@
+# Generated by Django 5.0.4 on 2026-10-18 13:30
+
+import numpy as np
+from django.db import migrations, models
+
+
+# the term ids of documents indexed before they were recorded, from their Posting rows, packed
+# as little-endian uint32. documents whose terms are already packed keep an empty list and are
+# looked for in every packed term when they are removed.
+def record_term_ids(apps, schema_editor):
+    Document = apps.get_model('documents', 'Document')
+    Posting = apps.get_model('documents', 'Posting')
+    last = 0
+    while True:
+        ids = list(Document.objects.filter(pk__gt=last).order_by('pk').values_list('pk', flat=True)[:1000])
+        if not ids:
+            return
+        last = ids[-1]
+        term_ids = {doc_id: [] for doc_id in ids}
+        for doc_id, term_id in Posting.objects.filter(document_id__in=ids).values_list('document_id', 'term_id'):
+            term_ids[doc_id].append(term_id)
+        Document.objects.bulk_update([
+            Document(pk=doc_id, term_ids=np.asarray(sorted(terms), dtype='<u4').tobytes())
+            for doc_id, terms in term_ids.items()
+        ], ['term_ids'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0009_term_packed'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='term_ids',
+            field=models.BinaryField(default=b''),
+        ),
+        migrations.RunPython(record_term_ids, migrations.RunPython.noop),
+    ]
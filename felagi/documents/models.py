@@ -5,6 +5,12 @@ class Document(models.Model):
     description = models.TextField()
     url = models.CharField(max_length=255, unique=True)
     post_date = models.DateField(blank=True, null=True)
+    # length of the document's vector of normalized term frequencies, computed at index time
+    norm = models.FloatField(default=0.0)
+    # forward index: ids of the document's top terms by weight, packed by documents.forward_index
+    index_terms = models.BinaryField(default=b'')
+    # ids of every term of the document packed the same way, to find it in packed posting lists
+    term_ids = models.BinaryField(default=b'')
 
     def __str__(self):
         return self.title
@@ -12,6 +18,10 @@ class Document(models.Model):
 class Term(models.Model):
     word = models.CharField(max_length=255, unique=True)
     df = models.PositiveIntegerField(default=0)  # Document frequency
+    # the term's posting list packed by documents.packed_postings, null until pack_postings runs.
+    # a packed term can still have Posting rows for the documents indexed since, never for the
+    # same document as its blob
+    packed = models.BinaryField(null=True)
 
     def __str__(self):
         return self.word
@@ -19,7 +29,20 @@ class Term(models.Model):
 class Posting(models.Model):
     term = models.ForeignKey(Term, related_name="postings", on_delete=models.CASCADE)
     document = models.ForeignKey(Document, related_name="postings", on_delete=models.CASCADE)
-    tf_idf = models.FloatField()
+    # length normalized term frequency, idf is applied to the query at search time
+    tf = models.FloatField()
 
     class Meta:
-        unique_together = ('term', 'document')
\ No newline at end of file
+        unique_together = ('term', 'document')
+
+# corpus wide counters kept up to date by documents.indexing, a single row
+class IndexStats(models.Model):
+    total_docs = models.PositiveIntegerField(default=0)
+    # bumped by every change to the postings, cached posting lists of an older generation are stale
+    generation = models.PositiveBigIntegerField(default=0)
+
+    # read only, searches never write: the row is created by migration 0006 and the indexing
+    # code, a database without it reads as the defaults
+    @classmethod
+    def load(cls):
+        return cls.objects.filter(pk=1).first() or cls(pk=1)
@@ -0,0 +1,120 @@
+import struct
+
+import numpy as np
+from django.db import transaction
+
+from retrieval_system.binary_index import WEIGHT_LEVELS, decode_varints, encode_varints
+from .models import Posting, Term
+
+# packed postings: instead of one Posting row per document, a term can carry its whole posting
+# list as one blob in Term.packed, so reading it is a single row fetch and the Posting table
+# and its two indexes shrink to the terms that are not packed. pack_postings() converts the rows
+# (manage.py pack_postings), unpack_postings() turns them back. a document is in either the blob
+# or the rows of a term, never both: the in-place indexing adds rows even to packed terms, since
+# rewriting a blob costs as much as its whole posting list, and the next pack_postings run merges
+# them in. the search reads both kinds.
+#
+# layout: number of postings (u4), weight scale (f8), the document ids as delta + varint
+# bytes, the tf of every posting quantized to uint16 (tf = q * scale, like the binary index of
+# the retrieval system) and the norm of every document as float32, so the cosine needs no
+# other table.
+
+HEADER = struct.Struct('<Id')
+
+
+def pack(doc_ids, tf, norms):
+    doc_ids = np.asarray(doc_ids, dtype=np.int64)
+    tf = np.asarray(tf, dtype=np.float64)
+    max_tf = float(tf.max()) if len(tf) else 0.0
+    scale = max_tf / WEIGHT_LEVELS if max_tf > 0 else 1.0
+    return b''.join((
+        HEADER.pack(len(doc_ids), scale),
+        encode_varints(np.diff(doc_ids, prepend=0)),
+        np.rint(tf / scale).astype('<u2').tobytes(),
+        np.asarray(norms, dtype='<f4').tobytes(),
+    ))
+
+
+# (document ids, tf, document norms) arrays, ordered by document id
+def unpack(blob):
+    blob = bytes(blob)
+    count, scale = HEADER.unpack_from(blob, 0)
+    weights_offset = len(blob) - 6 * count
+    doc_ids = np.cumsum(decode_varints(blob[HEADER.size:weights_offset]))
+    tf = np.frombuffer(blob, dtype='<u2', count=count, offset=weights_offset) * scale
+    norms = np.frombuffer(blob, dtype='<f4', count=count, offset=weights_offset + 2 * count).astype(np.float64)
+    return doc_ids, tf, norms
+
+
+# the postings of a blob and of rows as one list, ordered by document id
+def merge(blob, doc_ids, tf, norms):
+    packed_docs, packed_tf, packed_norms = unpack(blob)
+    doc_ids = np.concatenate([packed_docs, np.asarray(doc_ids, dtype=np.int64)])
+    order = np.argsort(doc_ids, kind='stable')
+    return (
+        doc_ids[order],
+        np.concatenate([packed_tf, np.asarray(tf, dtype=np.float64)])[order],
+        np.concatenate([packed_norms, np.asarray(norms, dtype=np.float64)])[order],
+    )
+
+
+# the blob without a document, or None when the document is not in it
+def remove_posting(blob, doc_id):
+    doc_ids, weights, norms = unpack(blob)
+    i = int(np.searchsorted(doc_ids, doc_id))
+    if i == len(doc_ids) or doc_ids[i] != doc_id:
+        return None
+    return pack(np.delete(doc_ids, i), np.delete(weights, i), np.delete(norms, i))
+
+
+# packs the terms that have Posting rows, merged with their blob when they already have one,
+# batch_size terms per transaction; returns the number of rows removed. an interrupted run
+# leaves every term either with its rows or with them packed.
+def pack_postings(batch_size=1000):
+    removed = 0
+    last = 0
+    while True:
+        ids = list(
+            Term.objects.filter(pk__gt=last, postings__isnull=False).distinct().order_by('pk').values_list('pk', flat=True)[:batch_size]
+        )
+        if not ids:
+            return removed
+        last = ids[-1]
+        with transaction.atomic():
+            columns = {}
+            rows = (
+                Posting.objects.filter(term_id__in=ids)
+                .order_by('term_id', 'document_id')
+                .values_list('term_id', 'document_id', 'tf', 'document__norm')
+            )
+            for term_id, doc_id, tf, norm in rows:
+                doc_ids, weights, norms = columns.setdefault(term_id, ([], [], []))
+                doc_ids.append(doc_id)
+                weights.append(tf)
+                norms.append(norm)
+            blobs = dict(Term.objects.select_for_update().filter(pk__in=ids, packed__isnull=False).values_list('pk', 'packed'))
+            Term.objects.bulk_update([
+                Term(pk=term_id, packed=pack(*merge(blobs[term_id], *lists)) if term_id in blobs else pack(*lists))
+                for term_id, lists in columns.items()
+            ], ['packed'])
+            removed += Posting.objects.filter(term_id__in=list(columns)).delete()[0]
+
+
+# writes the packed terms back as Posting rows; returns the number of rows created
+def unpack_postings(batch_size=1000):
+    created = 0
+    while True:
+        terms = list(Term.objects.filter(packed__isnull=False).order_by('pk').values_list('pk', 'packed')[:batch_size])
+        if not terms:
+            return created
+        with transaction.atomic():
+            rows = []
+            for term_id, blob in terms:
+                doc_ids, weights, _ = unpack(blob)
+                rows.extend(
+                    Posting(term_id=term_id, document_id=doc_id, tf=tf)
+                    for doc_id, tf in zip(doc_ids.tolist(), weights.tolist())
+                )
+            Posting.objects.bulk_create(rows, batch_size=batch_size)
+            Term.objects.filter(pk__in=[term_id for term_id, _ in terms]).update(packed=None)
+            created += len(rows)
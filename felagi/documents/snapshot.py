@@ -0,0 +1,182 @@
+import glob
+import os
+import re
+import threading
+
+import numpy as np
+from django.conf import settings
+from django.db import DatabaseError, connection, transaction
+
+from retrieval_system.binary_index import BinaryIndexWriter
+from retrieval_system.search_engine import IndexReader
+from retrieval_system.vocabulary import Vocabulary
+from .models import Document, IndexStats, Posting, Term
+from .packed_postings import unpack
+
+# search snapshot: the Term, Posting and Document tables written out as a binary index of the
+# retrieval system (term dictionary, delta encoded postings, doc norms and urls), named after
+# the IndexStats generation it was taken at. the file is memory-mapped, so every worker
+# process on the machine shares one copy through the page cache and none of them scans the
+# database. search_view only uses the snapshot of the current generation; after an indexing
+# change it falls back to the database until a new snapshot is written, which the in-place
+# indexing schedules with schedule_snapshot().
+
+FILE_PATTERN = re.compile(r'index-(\d+)\.bin$')
+
+_lock = threading.Lock()
+# (path, reader) of the snapshot this process has mapped
+_current = [None, None]
+# the pending rebuild of this process, and the lock that keeps its rebuilds from overlapping
+_rebuild_lock = threading.Lock()
+_rebuild = [None]
+_write_lock = threading.Lock()
+
+def snapshot_dir():
+    return getattr(settings, 'SEARCH_SNAPSHOT_DIR', None)
+
+
+def snapshot_path(generation):
+    return os.path.join(snapshot_dir(), f'index-{generation}.bin')
+
+
+# writes the snapshot of the current generation and removes the older ones; returns its path
+def write_snapshot(chunk_size=100000):
+    os.makedirs(snapshot_dir(), exist_ok=True)
+    with transaction.atomic():
+        stats = IndexStats.load()
+        generation = stats.generation
+        total_docs = stats.total_docs or Document.objects.count()
+        terms = list(Term.objects.order_by('id').values_list('id', 'word', 'df'))
+        documents = list(Document.objects.order_by('id').values_list('id', 'url', 'norm'))
+        term_pks = np.array([pk for pk, _, _ in terms], dtype=np.int64)
+        doc_pks = np.array([pk for pk, _, _ in documents], dtype=np.int64)
+
+        # postings as three flat arrays, the rows read a chunk at a time and then the packed terms
+        rows = Posting.objects.order_by('term_id', 'document_id').values_list('term_id', 'document_id', 'tf')
+        term_ids, doc_ids, weights = [], [], []
+        chunk = []
+        for row in rows.iterator(chunk_size=chunk_size):
+            chunk.append(row)
+            if len(chunk) == chunk_size:
+                add_chunk(chunk, term_pks, doc_pks, term_ids, doc_ids, weights)
+                chunk = []
+        add_chunk(chunk, term_pks, doc_pks, term_ids, doc_ids, weights)
+        for term_pk, blob in Term.objects.filter(packed__isnull=False).values_list('id', 'packed').iterator(chunk_size=100):
+            packed_docs, packed_weights, _ = unpack(blob)
+            term_ids.append(np.full(len(packed_docs), np.searchsorted(term_pks, term_pk)))
+            doc_ids.append(np.searchsorted(doc_pks, packed_docs))
+            weights.append(packed_weights)
+
+    term_ids = np.concatenate(term_ids)
+    doc_ids = np.concatenate(doc_ids)
+    weights = np.concatenate(weights)
+    # packed terms come after the rows and can have rows of their own, put every posting back
+    # in term then document order
+    order = np.lexsort((doc_ids, term_ids))
+    term_ids, doc_ids, weights = term_ids[order], doc_ids[order], weights[order]
+    bounds = np.searchsorted(term_ids, np.arange(len(terms) + 1))
+    index = {
+        "total_docs": total_docs,
+        "doc_norms": [norm for _, _, norm in documents],
+        "postings": [(doc_ids[a:b], weights[a:b]) for a, b in zip(bounds[:-1], bounds[1:])],
+    }
+    vocabulary = Vocabulary([word for _, word, _ in terms], [url for _, url, _ in documents])
+    path = snapshot_path(generation)
+    BinaryIndexWriter.write(path, index, vocabulary, [df for _, _, df in terms])
+    # processes that still map an older snapshot keep reading it until they move on. another
+    # process can have written a newer one meanwhile, that one stays.
+    for old_path in glob.glob(os.path.join(snapshot_dir(), 'index-*.bin')):
+        match = FILE_PATTERN.search(old_path)
+        if match and int(match.group(1)) < generation:
+            try:
+                os.remove(old_path)
+            except FileNotFoundError:
+                pass
+    return path
+
+
+# seconds between the first indexing change of a process and the snapshot it triggers, the
+# changes made in between share that rebuild; None turns the rebuild off
+def rebuild_delay():
+    return getattr(settings, 'SEARCH_SNAPSHOT_REBUILD_DELAY', 30)
+
+
+# rewrites the snapshot rebuild_delay() seconds from now unless a rebuild is already pending.
+# documents.indexing calls it once a change is committed.
+def schedule_snapshot():
+    if not snapshot_dir() or rebuild_delay() is None:
+        return
+    with _rebuild_lock:
+        if _rebuild[0] is not None:
+            return
+        _rebuild[0] = threading.Timer(rebuild_delay(), rebuild_snapshot)
+        _rebuild[0].daemon = True
+        _rebuild[0].start()
+
+
+# writes the pending rebuild now instead of on its timer thread, which dies with the process:
+# a command that indexes and exits calls it last. returns the path of the snapshot, or None
+# when no rebuild was pending
+def flush_snapshot():
+    # a rebuild already writing on the timer thread is waited for
+    with _write_lock:
+        with _rebuild_lock:
+            pending = _rebuild[0]
+            _rebuild[0] = None
+        if pending is None:
+            return None
+        pending.cancel()
+        return write_snapshot()
+
+
+# runs on the timer thread; changes committed while it writes schedule the next rebuild
+def rebuild_snapshot():
+    with _rebuild_lock:
+        _rebuild[0] = None
+    try:
+        with _write_lock:
+            write_snapshot()
+    except DatabaseError:
+        # the database was busy, e.g. locked by an indexing transaction, try again later
+        schedule_snapshot()
+    finally:
+        connection.close()
+
+
+# primary keys become positions in the snapshot's term and document tables
+def add_chunk(chunk, term_pks, doc_pks, term_ids, doc_ids, weights):
+    rows = np.array(chunk, dtype=np.float64).reshape(-1, 3)
+    term_ids.append(np.searchsorted(term_pks, rows[:, 0].astype(np.int64)))
+    doc_ids.append(np.searchsorted(doc_pks, rows[:, 1].astype(np.int64)))
+    weights.append(rows[:, 2])
+
+
+# maps the newest snapshot on disk, called once per process when the app is ready
+def open_latest():
+    if not snapshot_dir():
+        return None
+    generations = [
+        int(match.group(1))
+        for match in (FILE_PATTERN.search(path) for path in glob.glob(os.path.join(snapshot_dir(), 'index-*.bin')))
+        if match
+    ]
+    return reader(max(generations)) if generations else None
+
+
+# the reader of the snapshot taken at generation, or None when there is none
+def reader(generation):
+    if not snapshot_dir():
+        return None
+    path = snapshot_path(generation)
+    current_path, current = _current
+    if current_path == path:
+        return current
+    if not os.path.exists(path):
+        return None
+    with _lock:
+        if _current[0] != path:
+            try:
+                _current[:] = [path, IndexReader(path, None)]
+            except (OSError, ValueError):
+                return None
+        return _current[1]
@@ -1,3 +1,800 @@
-from django.test import TestCase
+import contextlib
+import io
+import json
+import math
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
 
-# Create your tests here.
+import numpy as np
+
+from django.conf import settings
+from django.core.management import call_command
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from documents.forward_index import build_forward_index, index_terms, pack_terms, unpack_terms
+from documents.indexing import add_document, remove_document
+from documents.models import Document, IndexStats, Posting, Term
+from documents.packed_postings import unpack
+from documents import snapshot
+from documents.snapshot import write_snapshot
+from retrieval_system.abbreviation_expander import AbbreviationExpander
+from retrieval_system.binary_index import BinaryIndexWriter
+from retrieval_system.boolean_query import BooleanQuery
+from retrieval_system.inverted_index import InvertedIndex
+from retrieval_system.search_engine import IndexReader, SearchEngine, TermSource
+from retrieval_system.postings_cache import PostingsCache
+from retrieval_system.records import iter_records
+from retrieval_system.segments import SegmentedIndex
+from retrieval_system.term_weighting import TermWeighting
+from retrieval_system.text_operations import AmharicStemmer, TextOperations
+from retrieval_system.vocabulary import Vocabulary
+
+
+# runs the pipeline over articles and writes inverted_index.json, with the tf as the weights,
+# and its positional index into directory; returns the index path
+def build_index(directory, articles):
+    input_path = os.path.join(directory, "articles.jsonl")
+    with open(input_path, "w", encoding="utf-8") as f:
+        f.writelines(json.dumps(article, ensure_ascii=False) + "\n" for article in articles)
+    with contextlib.redirect_stdout(io.StringIO()):
+        TextOperations.stream_pipeline(input_path, directory, ("term_frequencies", "word_frequencies", "positions"))
+    rows = [
+        {"doc": row["doc"], "terms": row["terms"], "tf_idf": row["tf"]}
+        for row in iter_records(os.path.join(directory, "term_frequencies.jsonl"))
+    ]
+    index_path = os.path.join(directory, "inverted_index.json")
+    InvertedIndex.save(index_path, InvertedIndex.build_inverted_index(rows))
+    return index_path
+
+
+class RetrievalImportTests(SimpleTestCase):
+
+    # the analysis-only libraries must not be imported when a worker loads the views
+    def test_search_engine_import_stays_light(self):
+        code = (
+            "import sys\n"
+            "import retrieval_system.search_engine\n"
+            "print(','.join(m for m in ('matplotlib', 'scipy', 'datasets') if m in sys.modules))\n"
+        )
+        out = subprocess.run(
+            [sys.executable, "-c", code],
+            cwd=settings.BASE_DIR, capture_output=True, text=True, check=True,
+        )
+        self.assertEqual(out.stdout.strip(), "")
+
+
+class TokenizerTests(SimpleTestCase):
+
+    # words joined by punctuation come out as separate tokens, like before the translate table
+    def test_punctuation_splits_words(self):
+        self.assertEqual(
+            TextOperations.clean_and_tokenize('ሰላም.ኢትዮጵያ ቦርድ,ምርጫ (ሰላም)ዜና ኢትዮ-ጂቡቲ ዓመት2015 snake_case'),
+            ['ሰላም', 'ኢትዮጵያ', 'ቦርድ', 'ምርጫ', 'ሰላም', 'ዜና', 'ኢትዮ', 'ጂቡቲ', 'ኣመት', 'snake_case'],
+        )
+
+    # queries drop the stopwords of the pipeline, and a seed list names the command of this app
+    def test_queries_use_the_pipeline_stopwords(self):
+        self.assertEqual(TextOperations.STOPWORDS_PATH, str(settings.AMHARIC_STOPWORDS_PATH))
+        path, stopwords = TextOperations.STOPWORDS_PATH, TextOperations._stopwords
+        try:
+            with tempfile.TemporaryDirectory() as directory:
+                TextOperations.STOPWORDS_PATH = os.path.join(directory, "amharic_stopwords.txt")
+                with open(TextOperations.STOPWORDS_PATH, "w", encoding="utf-8") as f:
+                    f.write(f"{TextOperations.SEED_STOPWORDS_HEADER}\nና\n")
+                TextOperations._stopwords = None
+                with self.assertWarnsRegex(UserWarning, "python manage.py refresh_stopwords"):
+                    self.assertEqual(TextOperations.load_amharic_stopwords(), {"ና"})
+        finally:
+            TextOperations.STOPWORDS_PATH, TextOperations._stopwords = path, stopwords
+
+
+# the stemmer before AmharicStemmer, affix lists and all, as the reference for the trie version
+def reference_stem(word):
+    amharic_suffixes = [
+        'ኝ', 'ህ', 'ሽ', 'ት', 'ች', 'ን', 'ችሁ', 'ቸው',
+        'ልኝ', 'ብኝ', 'ልህ', 'ብህ', 'ልሽ', 'ብሽ',
+        'ዬ', 'ሀ', 'ሺ', 'ዋ', 'ናችን', 'ናችሁ', 'ናቸው',
+        'ኦች', 'ዮች', 'ዎች', 'አን', 'አት',
+        'ኡ', 'ው', 'ዋ', 'እትዋ', 'እጥታ',
+        'ን', "ዬ"
+        'ና',
+        'ነት', 'ነስ', 'አይት', 'ኦች', 'አው',
+    ]
+    amharic_prefixes = [
+        'እ', 'ት', 'ይ', 'እና', 'አይ', 'አል', 'ሰ', 'ራ', 'አስ', 'ታን', 'አን', "የ", "እነ", "ለ", "በ", "ከ",
+    ]
+    prefix_removed = word
+    longest_prefix = ''
+    for prefix in amharic_prefixes:
+        if word.startswith(prefix) and len(prefix) > len(longest_prefix):
+            longest_prefix = prefix
+    if longest_prefix:
+        prefix_removed = word[len(longest_prefix):]
+    stemmed = prefix_removed
+    longest_suffix = ''
+    for suffix in amharic_suffixes:
+        if prefix_removed.endswith(suffix) and len(suffix) > len(longest_suffix):
+            longest_suffix = suffix
+    if longest_suffix:
+        stemmed = prefix_removed[:-len(longest_suffix)]
+    return stemmed
+
+
+class StemmerTests(SimpleTestCase):
+
+    def test_same_stems_as_the_reference_stemmer(self):
+        stems = ["", "ቤት", "ምርጫ", "ሰላም", "ኢትዮጵያ", "መንግስት", "ና", "እ", "ን"]
+        affixes = AmharicStemmer.PREFIXES + AmharicStemmer.SUFFIXES + ["ዬና", "ኦ", "ች"]
+        # every affix around every stem, so each longest match and its shorter rivals come up
+        words = {prefix + stem + suffix for stem in stems for prefix in [""] + affixes for suffix in [""] + affixes}
+        with open(TextOperations.STOPWORDS_PATH, encoding="utf-8") as f:
+            words.update(line.strip() for line in f if not line.startswith("#"))
+        with open(TextOperations.ABBREVATIONS_PATH, encoding="utf-8") as f:
+            words.update(word for full in json.load(f).values() for word in full.split())
+        stemmer = AmharicStemmer()
+        vocabulary = stemmer.stem_vocabulary(words)
+        for word in sorted(words):
+            expected = reference_stem(word)
+            self.assertEqual(stemmer.stem(word), expected, word)
+            self.assertEqual(vocabulary[word], expected, word)
+            self.assertEqual(TextOperations.stemmer(word), expected, word)
+
+    def test_cache_is_bounded_and_counted(self):
+        stemmer = AmharicStemmer(cache_size=2)
+        for word in ["በቤት", "በቤት", "የቤቶች", "ለምርጫ", "በቤት"]:
+            self.assertEqual(stemmer.stem(word), reference_stem(word))
+        # the third word evicted በቤት, so its last lookup missed again
+        self.assertEqual(stemmer.cache_stats(), {"hits": 1, "misses": 4, "size": 2, "max_size": 2, "hit_rate": 0.2})
+        # whole vocabularies bypass the cache
+        stemmer.stem_vocabulary(["በቤት", "ከተማ"])
+        self.assertEqual(stemmer.cache_stats()["misses"], 4)
+
+
+class AbbreviationExpanderTests(SimpleTestCase):
+
+    def setUp(self):
+        self.expander = AbbreviationExpander({
+            "ዓ. ም.": "ዓመተ ምህረት",
+            "ም. ዓ.": "ምስራቅ ዓለም",
+            "ጠ/ሚ": "ጠቅላይ ሚኒስትር",
+            "ጠ/ሚ/ር": "ጠቅላይ ሚኒስትር",
+            "ሚ/ር": "ሚኒስትር",
+            "ም/ጠ/ሚ": "ምክትል ጠቅላይ ሚኒስትር",
+            "ት/ቤት": "ትምህርት ቤት",
+        })
+
+    def test_forms_of_several_tokens(self):
+        self.assertEqual(self.expander.expand("በ2015 ዓ. ም. ተጀመረ"), "በ2015 ዓመተ ምህረት ተጀመረ")
+        self.assertEqual(self.expander.expand("ም. ዓ. ነው"), "ምስራቅ ዓለም ነው")
+
+    def test_forms_next_to_punctuation(self):
+        self.assertEqual(self.expander.expand("(ጠ/ሚ),"), "(ጠቅላይ ሚኒስትር),")
+        self.assertEqual(self.expander.expand("ጠ/ሚ."), "ጠቅላይ ሚኒስትር.")
+        self.assertEqual(self.expander.expand("«ት/ቤት»"), "«ትምህርት ቤት»")
+        # only whole words: letters and / on either side are part of another word
+        self.assertEqual(self.expander.expand("xጠ/ሚ ጠ/ሚx ጠ/ሚ/ሩ"), "xጠ/ሚ ጠ/ሚx ጠ/ሚ/ሩ")
+
+    def test_overlapping_forms_take_the_leftmost_then_longest(self):
+        # ጠ/ሚ and ሚ/ር both end inside ጠ/ሚ/ር, ጠ/ሚ inside ም/ጠ/ሚ
+        self.assertEqual(self.expander.expand("ጠ/ሚ/ር ዐቢይ"), "ጠቅላይ ሚኒስትር ዐቢይ")
+        self.assertEqual(self.expander.expand("ም/ጠ/ሚ ደመቀ"), "ምክትል ጠቅላይ ሚኒስትር ደመቀ")
+        self.assertEqual(self.expander.expand("ሚ/ር"), "ሚኒስትር")
+        # ዓ. ም. and ም. ዓ. overlap on ም., the one that starts first wins
+        self.assertEqual(self.expander.expand("በ2015 ዓ. ም. ዓ. ተጀመረ"), "በ2015 ዓመተ ምህረት ዓ. ተጀመረ")
+
+    def test_bundled_abbreviations(self):
+        expander = AbbreviationExpander.load(TextOperations.ABBREVATIONS_PATH, TextOperations.LETTER_TABLE)
+        # ጠ/ሚ/ሩ is a prefix of ጠ/ሚ/ሩን, the longer entry is used
+        self.assertEqual(expander.expand("ጠ/ሚ/ሩን አነጋገሩ"), "ጠቅላይ ሚኒስትሩን አነጋገሩ")
+        self.assertEqual(expander.expand("ጠ/ሚ/ሩ፣"), "ጠቅላይ ሚኒስትሩ፣")
+        self.assertEqual(expander.expand("በ2015 ዓ/ም"), "በ2015 ዓመተ ምህረት")
+
+
+class PipelineTests(SimpleTestCase):
+
+    # shards analyzed by a process pool are merged in input order, every artifact has to come
+    # out byte for byte like a serial run
+    def test_workers_write_the_same_artifacts_as_a_serial_run(self):
+        words = ["ኢትዮጵያ", "መንግስት", "ምርጫ", "ቦርድ", "ኢኮኖሚ", "ስፖርት", "ጠ/ሚ", "ዓ/ም", "እና", "ጤና", "ግብርና", "2015"]
+        rng = random.Random(8)
+        articles = [
+            {"url": f"https://example.com/{i % 37}", "title": " ".join(rng.choices(words, k=3)),
+             "content": " ".join(rng.choices(words, k=rng.randint(0, 25)))}
+            for i in range(40)
+        ]
+        with tempfile.TemporaryDirectory() as directory:
+            input_path = os.path.join(directory, "articles.jsonl")
+            with open(input_path, "w", encoding="utf-8") as f:
+                f.writelines(json.dumps(article, ensure_ascii=False) + "\n" for article in articles)
+            outputs = {}
+            for workers, shard_size in ((1, 256), (3, 4)):
+                output_dir = os.path.join(directory, f"workers-{workers}")
+                os.makedirs(output_dir)
+                with contextlib.redirect_stdout(io.StringIO()):
+                    TextOperations.stream_pipeline(input_path, output_dir, set(TextOperations.ARTIFACTS),
+                                                   workers=workers, shard_size=shard_size)
+                outputs[workers] = {}
+                for name in sorted(os.listdir(output_dir)):
+                    with open(os.path.join(output_dir, name), "rb") as f:
+                        outputs[workers][name] = f.read()
+        self.assertIn("positions.bin", outputs[1])
+        self.assertEqual(sorted(outputs[3]), sorted(outputs[1]))
+        for name, content in outputs[1].items():
+            self.assertEqual(outputs[3][name], content, name)
+
+
+class WeightingTests(SimpleTestCase):
+
+    # (term_frequencies.jsonl path, word frequencies, luhn cutoffs) of a small corpus with a
+    # repeated url, run through the default pipeline
+    def setUp(self):
+        words = ["ኢትዮጵያ", "መንግስት", "ምርጫ", "ቦርድ", "ኢኮኖሚ", "ስፖርት", "ትምህርት", "ጤና", "ግብርና", "ውሃ", "መብራት"]
+        rng = random.Random(21)
+        articles = [
+            {"url": f"https://example.com/{i % 55}", "title": " ".join(rng.choices(words, k=2)),
+             "content": " ".join(rng.choices(words, weights=range(len(words), 0, -1), k=rng.randint(1, 30)))}
+            for i in range(60)
+        ]
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        input_path = os.path.join(directory, "articles.jsonl")
+        with open(input_path, "w", encoding="utf-8") as f:
+            f.writelines(json.dumps(article, ensure_ascii=False) + "\n" for article in articles)
+        with contextlib.redirect_stdout(io.StringIO()):
+            TextOperations.stream_pipeline(input_path, directory)
+        self.directory = directory
+        self.tf_path = os.path.join(directory, "term_frequencies.jsonl")
+        with open(os.path.join(directory, "word_frequencies.json"), encoding="utf-8") as f:
+            self.word_frequencies = json.load(f)
+        with open(os.path.join(directory, "luhn_cutoffs_results.json"), encoding="utf-8") as f:
+            self.luhn_terms = json.load(f)
+        self.num_terms = len(self.word_frequencies["df"])
+
+    def weigh(self):
+        total_docs = TermWeighting.count_docs(iter_records(self.tf_path))
+        rows, idf = TermWeighting.compute_tf_idf(iter_records(self.tf_path), self.word_frequencies, self.luhn_terms,
+                                                 total_docs=total_docs)
+        return rows, idf, total_docs
+
+    def test_weights_are_streamed(self):
+        rows, _, total_docs = self.weigh()
+        self.assertEqual(total_docs, 55)
+        # rows are computed as they are read, and a one-shot input can't also be counted
+        self.assertIs(iter(rows), rows)
+        self.assertEqual(len(list(rows)), total_docs)
+        with self.assertRaises(ValueError):
+            TermWeighting.compute_tf_idf(iter_records(self.tf_path), self.word_frequencies, self.luhn_terms)
+        rows, _ = TermWeighting.compute_tf_idf(list(iter_records(self.tf_path)), self.word_frequencies, self.luhn_terms)
+        self.assertEqual(len(list(rows)), total_docs)
+
+    def test_spimi_build_equals_the_in_memory_build(self):
+        rows, _, _ = self.weigh()
+        rows = list(rows)
+        expected = InvertedIndex.build_inverted_index(rows, self.num_terms)
+        # a budget of a few postings flushes many runs that the merge has to put back together
+        with tempfile.TemporaryDirectory() as run_dir:
+            index = InvertedIndex.build_spimi(iter(rows), 40 * InvertedIndex.POSTING_BYTES, run_dir, self.num_terms)
+            with index["postings"] as postings:
+                self.assertEqual([postings[term_id] for term_id in range(len(postings))], expected["postings"])
+        self.assertEqual(index["total_docs"], expected["total_docs"])
+        self.assertEqual(index["doc_norms"], expected["doc_norms"])
+        self.assertEqual(index["max_scores"], expected["max_scores"])
+
+
+    def test_matrix_build_equals_the_row_build(self):
+        rows, idf, total_docs = self.weigh()
+        expected = InvertedIndex.build_inverted_index(list(rows), self.num_terms)
+        matrix = TermWeighting.compute_tf_idf_matrix(iter_records(self.tf_path), self.word_frequencies, self.luhn_terms)
+        self.assertTrue(np.allclose(matrix["idf"], idf))
+        index = InvertedIndex.build_from_matrix(matrix)
+        self.assertEqual(index["total_docs"], total_docs)
+        self.assertEqual(len(index["postings"]), len(expected["postings"]))
+        self.assertTrue(np.allclose(index["doc_norms"], expected["doc_norms"]))
+        self.assertTrue(np.allclose(index["max_scores"], expected["max_scores"]))
+        for (docs, weights), (expected_docs, expected_weights) in zip(index["postings"], expected["postings"]):
+            self.assertEqual(docs, expected_docs)
+            self.assertTrue(np.allclose(weights, expected_weights))
+
+
+class IndexReaderTests(SimpleTestCase):
+
+    # an index rebuilt in place is picked up by the next query, without a reload() call
+    def test_rewritten_index_is_reloaded(self):
+        with tempfile.TemporaryDirectory() as directory:
+            index_path = build_index(directory, [
+                {"url": "https://example.com/old", "title": "", "content": "ምርጫ ቦርድ"},
+                {"url": "https://example.com/other", "title": "", "content": "ኢኮኖሚ"},
+            ])
+            reader = IndexReader(index_path, os.path.join(directory, "word_frequencies.json"))
+            generation = reader.generation
+            self.assertEqual([url for url, _ in reader.search("ምርጫ", 5)], ["https://example.com/old"])
+            self.assertEqual(reader.search("ጤና", 5), [])
+
+            build_index(directory, [
+                {"url": "https://example.com/new", "title": "", "content": "ጤና ምርጫ"},
+                {"url": "https://example.com/other", "title": "", "content": "ኢኮኖሚ"},
+                {"url": "https://example.com/third", "title": "", "content": "ጤና"},
+            ])
+            # a rebuild within the same clock tick keeps the size check, move the mtime on anyway
+            for path in (index_path, reader.word_frequencies_path, reader.vocabulary_path):
+                st = os.stat(path)
+                os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+            self.assertEqual([url for url, _ in reader.search("ምርጫ", 5)], ["https://example.com/new"])
+            self.assertEqual(sorted(url for url, _ in reader.search("ጤና", 5)),
+                             ["https://example.com/new", "https://example.com/third"])
+            self.assertEqual(reader.total_docs, 3)
+            self.assertEqual(reader.generation, generation + 1)
+            # an unchanged index is not parsed again
+            reader.search("ምርጫ", 5)
+            self.assertEqual(reader.generation, generation + 1)
+
+    # lnc.ltc worked out by hand: documents store tf / length, the query is (tf / max tf) *
+    # log2(N / df), and the cosine divides by both vector lengths
+    def test_scores_are_lnc_ltc_cosines(self):
+        # term ids 0..2 are a, b, c
+        tf_data = [
+            {"doc": 0, "terms": [0, 1], "tf": [2, 1]},
+            {"doc": 1, "terms": [1, 2], "tf": [1, 3]},
+            {"doc": 2, "terms": [0], "tf": [1]},
+            {"doc": 3, "terms": [1, 2], "tf": [1, 1]},
+        ]
+        df = [2, 3, 2]
+        luhn_terms = {"index_terms": [{"term": term_id} for term_id in range(3)]}
+        rows, _ = TermWeighting.compute_tf_idf(tf_data, {"cf": df, "df": df}, luhn_terms)
+        rows = list(rows)
+        self.assertEqual(rows[0]["tf_idf"], [2 / 3, 1 / 3])
+        self.assertEqual(rows[1]["tf_idf"], [1 / 4, 3 / 4])
+
+        with tempfile.TemporaryDirectory() as directory:
+            Vocabulary(["a", "b", "c"], [f"https://example.com/{i}" for i in range(4)]).save(
+                os.path.join(directory, Vocabulary.FILE_NAME))
+            wf_path = os.path.join(directory, "word_frequencies.json")
+            with open(wf_path, "w", encoding="utf-8") as f:
+                json.dump({"cf": df, "df": df}, f)
+            index_path = os.path.join(directory, "inverted_index.json")
+            InvertedIndex.save(index_path, InvertedIndex.build_inverted_index(rows, 3))
+            reader = IndexReader(index_path, wf_path)
+
+            # query "a a b": a has tf 2 = max tf and idf log2(4/2) = 1, b has tf 1 and idf log2(4/3)
+            query_vec = reader.term_vector(["a", "a", "b"])
+            b = 0.5 * math.log2(4 / 3)
+            self.assertEqual(query_vec, {0: 1.0, 1: b})
+            query_norm = math.sqrt(1 + b * b)
+            expected = [
+                (2, 1 / query_norm),
+                (0, (2 / 3 + b / 3) / (query_norm * math.sqrt(5) / 3)),
+                (3, (b / 2) / (query_norm * math.sqrt(2) / 2)),
+                (1, (b / 4) / (query_norm * math.sqrt(10) / 4)),
+            ]
+            for prune in (True, False):
+                ranked = reader.rank(query_vec, 10, prune=prune)
+                self.assertEqual([doc_id for doc_id, _ in ranked], [doc_id for doc_id, _ in expected])
+                for (_, sim), (_, expected_sim) in zip(ranked, expected):
+                    self.assertAlmostEqual(sim, expected_sim)
+            self.assertEqual([doc_id for doc_id, _ in reader.rank(query_vec, 2)], [2, 0])
+
+
+class PrunedRankingTests(SimpleTestCase):
+
+    # a small corpus with a skewed term distribution, so a few terms are in most documents
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        rng = random.Random(7)
+        num_docs, num_terms = 2000, 400
+        cls.num_terms = num_terms
+        rows = []
+        for doc_id in range(num_docs):
+            terms = sorted({int(rng.paretovariate(0.8)) % num_terms for _ in range(rng.randint(5, 40))})
+            rows.append({"doc": doc_id, "terms": terms, "tf_idf": [rng.uniform(0.01, 1.0) for _ in terms]})
+        index = InvertedIndex.build_inverted_index(rows, num_terms)
+        vocabulary = Vocabulary([f"t{i}" for i in range(num_terms)], [f"https://example.com/{i}" for i in range(num_docs)])
+        df = [len(docs) for docs, _ in index["postings"]]
+
+        cls.tmp = tempfile.TemporaryDirectory()
+        vocabulary.save(os.path.join(cls.tmp.name, Vocabulary.FILE_NAME))
+        wf_path = os.path.join(cls.tmp.name, "word_frequencies.json")
+        with open(wf_path, "w", encoding="utf-8") as f:
+            json.dump({"cf": df, "df": df}, f)
+        json_path = os.path.join(cls.tmp.name, "inverted_index.json")
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(index, f)
+        bin_path = os.path.join(cls.tmp.name, "inverted_index.bin")
+        BinaryIndexWriter.write(bin_path, index, vocabulary, df)
+        cls.readers = [IndexReader(json_path, wf_path), IndexReader(bin_path, wf_path)]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.readers = None
+        cls.tmp.cleanup()
+        super().tearDownClass()
+
+    def test_pruned_ranking_matches_exhaustive_scoring(self):
+        rng = random.Random(11)
+        for reader in self.readers:
+            pruned = 0
+            for _ in range(200):
+                terms = rng.sample(range(8), 2) + rng.sample(range(self.num_terms), rng.randint(0, 3))
+                query_vec = {term_id: rng.uniform(0.1, 3.0) for term_id in terms}
+                top_k = rng.choice([1, 5, 10, 50])
+                exhaustive = reader.rank(query_vec, top_k, prune=False)
+                self.assertEqual(reader.rank(query_vec, top_k, prune=True), exhaustive)
+
+                snapshot = reader.current()
+                lists = {term_id: reader.postings(term_id, snapshot) for term_id in query_vec}
+                bounds = {term_id: query_vec[term_id] * reader.max_score(term_id, snapshot) for term_id in lists}
+                if SearchEngine.max_score_candidates(query_vec, lists, bounds, snapshot["doc_norms"], top_k) is not None:
+                    pruned += 1
+            # the comparison is only meaningful if pruning actually happened
+            self.assertGreater(pruned, 0)
+
+    def test_boolean_queries_match_set_operations(self):
+        snapshot = self.readers[0].current()
+        live = set(range(len(snapshot["doc_norms"])))
+        docs = [set(snapshot["postings"][term_id][0].tolist()) for term_id in range(self.num_terms)]
+        rng = random.Random(13)
+        for reader in self.readers:
+            snapshot = reader.current()
+            for _ in range(50):
+                # a frequent term with long, skip-listed posting lists and two rarer ones
+                a, b, c = rng.randrange(4), rng.randrange(4, 40), rng.randrange(40, self.num_terms)
+                for query, expected in (
+                    (f"+t{a} +t{b} t{c}", docs[a] & docs[b]),
+                    (f"t{a} AND (t{b} OR t{c})", docs[a] & (docs[b] | docs[c])),
+                    (f"+t{b} -t{a}", docs[b] - docs[a]),
+                    (f"NOT t{a} OR t{c}", (live - docs[a]) | docs[c]),
+                ):
+                    tree, words = BooleanQuery.parse(query, lambda word: [word])
+                    within = BooleanQuery.matching_docs(tree, TermSource(reader, snapshot))
+                    self.assertEqual(set(within.tolist()), expected, query)
+                    query_vec = {int(word[1:]): 1.0 for word in words}
+                    ranked = reader.rank(query_vec, len(live), snapshot, within=within)
+                    self.assertEqual(sorted(doc_id for doc_id, _ in ranked), sorted(expected), query)
+
+
+class SegmentedIndexTests(SimpleTestCase):
+
+    def test_added_replaced_and_deleted_documents_survive_merges(self):
+        words = ["ኢትዮጵያ", "መንግስት", "ምርጫ", "ኢኮኖሚ", "ስፖርት", "ትምህርት", "ጤና", "ግብርና"]
+        rng = random.Random(3)
+        with tempfile.TemporaryDirectory() as directory:
+            for batch in range(SegmentedIndex.MERGE_FACTOR):
+                articles = [
+                    {"url": f"https://example.com/{batch}/{i}", "title": "", "content": " ".join(rng.choices(words, k=4))}
+                    for i in range(5)
+                ]
+                SegmentedIndex.add_documents(directory, articles, background=False)
+            # a full tier was merged into one segment
+            self.assertEqual(len(SegmentedIndex.read_manifest(directory)["segments"]), 1)
+
+            reader = IndexReader(directory, None)
+            SegmentedIndex.add_documents(directory, [
+                {"url": "https://example.com/0/0", "title": "", "content": "ሰላም ሰላም ኢትዮጵያ"},
+            ], merge=False)
+            self.assertEqual(SegmentedIndex.delete_documents(directory, ["https://example.com/1/1"]), 1)
+            self.assertEqual(reader.total_docs, 4 * 5 - 1)
+            self.assertEqual(reader.search("ሰላም", 5)[0][0], "https://example.com/0/0")
+            before = [url for url, _ in reader.search("ኢትዮጵያ ምርጫ", 100)]
+            self.assertTrue(before)
+            self.assertNotIn("https://example.com/1/1", before)
+
+            SegmentedIndex.merge_segments(directory, [info["name"] for info in SegmentedIndex.read_manifest(directory)["segments"]])
+            self.assertEqual(reader.total_docs, 4 * 5 - 1)
+            self.assertEqual(sorted(url for url, _ in reader.search("ኢትዮጵያ ምርጫ", 100)), sorted(before))
+
+
+class PhraseQueryTests(SimpleTestCase):
+
+    def test_phrases_and_proximity_filter_the_ranked_documents(self):
+        articles = [
+            {"url": "https://example.com/1", "title": "ምርጫ", "content": "ብሔራዊ ምርጫ ቦርድ ዛሬ ተሰበሰበ"},
+            {"url": "https://example.com/2", "title": "ቦርድ", "content": "ምርጫ ተካሄደ ብሔራዊ ቦርድ"},
+            {"url": "https://example.com/3", "title": "ምርጫ ቦርድ", "content": "ኢኮኖሚ"},
+            {"url": "https://example.com/4", "title": "", "content": "ቦርድ ምርጫ ኢኮኖሚ ግብርና"},
+            {"url": "https://example.com/5", "title": "ጤና", "content": "ግብርና ትምህርት"},
+        ]
+        with tempfile.TemporaryDirectory() as directory:
+            index_path = build_index(directory, articles)
+            reader = IndexReader(index_path, os.path.join(directory, "word_frequencies.json"))
+
+            def urls(query):
+                return sorted(url for url, _ in reader.search(query))
+
+            self.assertEqual(urls("ምርጫ ቦርድ"), [f"https://example.com/{i}" for i in range(1, 5)])
+            # a phrase doesn't run from the title into the content
+            self.assertEqual(urls('"ምርጫ ቦርድ"'), ["https://example.com/1", "https://example.com/3"])
+            self.assertEqual(urls('"ምርጫ ቦርድ"~1'), ["https://example.com/1", "https://example.com/3", "https://example.com/4"])
+            self.assertEqual(urls('"ምርጫ ቦርድ"~2'), [f"https://example.com/{i}" for i in range(1, 5)])
+            self.assertEqual(urls('"ቦርድ ምርጫ" ግብርና'), ["https://example.com/4"])
+
+
+class PostingsCacheTests(SimpleTestCase):
+
+    def test_eviction_keeps_the_cache_within_its_byte_budget(self):
+        entry_bytes = PostingsCache.size_of((np.zeros(100, dtype=np.int64),))
+        cache = PostingsCache(max_bytes=10 * entry_bytes)
+        # an expensive list that keeps being used and a stream of cheap ones used once
+        cache.put("hot", (np.zeros(100, dtype=np.int64),), cost=1.0)
+        for i in range(100):
+            cache.put(i, (np.zeros(100, dtype=np.int64),), cost=0.001)
+            self.assertIsNotNone(cache.get("hot"))
+            self.assertLessEqual(cache.bytes, cache.max_bytes)
+        stats = cache.stats()
+        self.assertEqual(stats["entries"], 10)
+        self.assertEqual(stats["hits"], 100)
+        self.assertEqual(stats["evictions"], 91)
+        self.assertIsNone(cache.get(0))
+        self.assertEqual(cache.stats()["misses"], 1)
+
+
+# a snapshot left in the project directory must not answer the test searches
+@override_settings(SEARCH_SNAPSHOT_DIR=None)
+class IndexingTests(TestCase):
+
+    def test_add_and_remove_only_update_counters(self):
+        add_document({"url": "https://example.com/1", "title": "ምርጫ", "content": "ምርጫ ቦርድ ምርጫ"})
+        add_document({"url": "https://example.com/2", "title": "", "content": "ምርጫ ኢኮኖሚ"})
+        election = Term.objects.get(word="ምርጫ")
+        self.assertEqual(election.df, 2)
+        self.assertEqual(IndexStats.load().total_docs, 2)
+
+        def search(query):
+            response = self.client.get(reverse("search_view", args=[query]))
+            return [r["url"] for r in response.json()["results"]]
+
+        self.assertEqual(search("ቦርድ"), ["https://example.com/1"])
+        self.assertEqual(search("ኢኮኖሚ"), ["https://example.com/2"])
+
+        # re-adding a url replaces it instead of counting it twice
+        add_document({"url": "https://example.com/2", "title": "", "content": "ኢኮኖሚ"})
+        self.assertEqual(Term.objects.get(word="ምርጫ").df, 1)
+        self.assertEqual(IndexStats.load().total_docs, 2)
+        # the cached postings of the old copy are not used anymore
+        self.assertEqual(search("ኢኮኖሚ"), ["https://example.com/2"])
+
+        self.assertTrue(remove_document("https://example.com/1"))
+        self.assertFalse(remove_document("https://example.com/1"))
+        self.assertEqual(Term.objects.get(word="ምርጫ").df, 0)
+        self.assertEqual(IndexStats.load().total_docs, 1)
+        self.assertEqual(list(Document.objects.values_list("url", flat=True)), ["https://example.com/2"])
+
+    def test_search_queries_do_not_grow_with_the_candidates(self):
+        add_document({"url": "https://example.com/other", "title": "", "content": "ግብርና"})
+
+        def search():
+            SearchEngine.postings_cache.clear()
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(reverse("search_view", args=["ምርጫ ቦርድ"]))
+            return response.json()["results"], len(queries)
+
+        add_document({"url": "https://example.com/0", "title": "ምርጫ", "content": "ቦርድ"})
+        results, few = search()
+        self.assertEqual(results[0]["url"], "https://example.com/0")
+        self.assertEqual(sorted(results[0]["index_terms"]), ["ምርጫ", "ቦርድ"])
+
+        for i in range(1, 40):
+            add_document({"url": f"https://example.com/{i}", "title": "", "content": "ምርጫ ቦርድ " * (i % 3 + 1)})
+        results, many = search()
+        self.assertEqual(len(results), 10)
+        self.assertEqual(many, few)
+
+    def test_search_does_not_write(self):
+        add_document({"url": "https://example.com/1", "title": "ምርጫ", "content": "ቦርድ"})
+        add_document({"url": "https://example.com/2", "title": "", "content": "ግብርና"})
+        IndexStats.objects.all().delete()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("search_view", args=["ምርጫ"]))
+        self.assertEqual([r["url"] for r in response.json()["results"]], ["https://example.com/1"])
+        self.assertFalse([query for query in queries if not query["sql"].lstrip().upper().startswith("SELECT")])
+        self.assertFalse(IndexStats.objects.exists())
+
+    def test_forward_index_keeps_the_heaviest_terms_first(self):
+        document = add_document({"url": "https://example.com/1", "title": "ምርጫ", "content": "ቦርድ ምርጫ ግብርና ምርጫ ቦርድ"})
+        term_ids = unpack_terms(Document.objects.get(pk=document.pk).index_terms).tolist()
+        self.assertEqual(index_terms([pack_terms(zip(term_ids, [1, 1, 1]), limit=2)]), [["ምርጫ", "ቦርድ"]])
+        self.assertEqual(index_terms([Document.objects.get(pk=document.pk).index_terms]), [["ምርጫ", "ቦርድ", "ግብርና"]])
+
+        # rebuilding from the postings gives the same lists
+        Document.objects.update(index_terms=b"")
+        self.assertEqual(build_forward_index(), 1)
+        self.assertEqual(unpack_terms(Document.objects.get(pk=document.pk).index_terms).tolist(), term_ids)
+
+
+class LoadIndexTests(TestCase):
+
+    def test_load_index_is_complete_and_can_be_run_again(self):
+        articles = [
+            {"url": f"https://example.com/{i}", "title": "", "content": " ".join(words)}
+            for i, words in enumerate([["ምርጫ", "ቦርድ"], ["ምርጫ", "ኢኮኖሚ"], ["ግብርና"], ["ቦርድ", "ጤና", "ቦርድ"]])
+        ]
+        with tempfile.TemporaryDirectory() as directory:
+            index_path = build_index(directory, articles)
+            _, postings = InvertedIndex.stream(index_path)
+            expected = sum(len(docs) for _, docs, _ in postings)
+            for _ in range(2):
+                # one row per batch, and a second run only finds rows that already exist
+                with override_settings(SEARCH_SNAPSHOT_DIR=None):
+                    call_command("load_index", articles=os.path.join(directory, "articles.jsonl"), index=index_path,
+                                 batch_size=1, stdout=io.StringIO())
+                self.assertEqual(Document.objects.count(), 4)
+                self.assertEqual(Posting.objects.count(), expected)
+                self.assertEqual(Term.objects.get(word="ቦርድ").df, 2)
+            self.assertFalse(os.path.exists(index_path + ".load_progress.json"))
+        self.assertEqual(IndexStats.load().total_docs, 4)
+        response = self.client.get(reverse("search_view", args=["ጤና"]))
+        self.assertEqual([r["url"] for r in response.json()["results"]], ["https://example.com/3"])
+        self.assertEqual(response.json()["results"][0]["index_terms"], ["ቦርድ", "ጤና"])
+
+
+@override_settings(SEARCH_SNAPSHOT_DIR=None)
+class PackedPostingsTests(TestCase):
+
+    def test_packed_terms_search_and_index_like_rows(self):
+        words = ["ኢትዮጵያ", "መንግስት", "ምርጫ", "ኢኮኖሚ", "ስፖርት", "ትምህርት", "ጤና", "ግብርና"]
+        rng = random.Random(9)
+        for i in range(9):
+            add_document({"url": f"https://example.com/{i}", "title": "", "content": " ".join(rng.choices(words, k=6))})
+        queries = ["ምርጫ ኢኮኖሚ", "ጤና", "ስፖርት ትምህርት ግብርና"]
+
+        def search(query):
+            SearchEngine.postings_cache.clear()
+            response = self.client.get(reverse("search_view", args=[query]))
+            return sorted((r["url"], r["score"]) for r in response.json()["results"])
+
+        def assertSameResults(found, expected):
+            self.assertEqual([url for url, _ in found], [url for url, _ in expected])
+            for (_, score), (_, expected_score) in zip(found, expected):
+                self.assertAlmostEqual(score, expected_score, places=3)
+
+        expected = [search(query) for query in queries]
+        rows = Posting.objects.count()
+        call_command("pack_postings", batch_size=3, stdout=io.StringIO())
+        self.assertEqual(Posting.objects.count(), 0)
+        for query, results in zip(queries, expected):
+            assertSameResults(search(query), results)
+
+        # in-place indexing adds rows, to packed terms too, until the next pack_postings merges them
+        add_document({"url": "https://example.com/new", "title": "ጤና", "content": "ጤና ክትባት"})
+        self.assertEqual(Term.objects.get(word="ጤና").df, len(expected[1]) + 1)
+        self.assertEqual(Posting.objects.count(), 2)
+        with_new = search("ጤና")
+        self.assertIn("https://example.com/new", [url for url, _ in with_new])
+        call_command("pack_postings", stdout=io.StringIO())
+        self.assertEqual(Posting.objects.count(), 0)
+        assertSameResults(search("ጤና"), with_new)
+        # removal goes through the term ids recorded at indexing, not the text as analyzed now
+        new = Document.objects.get(url="https://example.com/new")
+        Document.objects.filter(pk=new.pk).update(title="", description="")
+        self.assertTrue(remove_document("https://example.com/new"))
+        self.assertEqual(Term.objects.get(word="ጤና").df, len(expected[1]))
+        for blob in Term.objects.filter(packed__isnull=False).values_list("packed", flat=True):
+            self.assertNotIn(new.pk, unpack(blob)[0].tolist())
+        assertSameResults(search("ጤና"), expected[1])
+
+        call_command("pack_postings", unpack=True, stdout=io.StringIO())
+        self.assertEqual(Posting.objects.count(), rows)
+        self.assertFalse(Term.objects.filter(packed__isnull=False).exists())
+        for query, results in zip(queries, expected):
+            assertSameResults(search(query), results)
+
+
+class SnapshotTests(TestCase):
+
+    def test_search_uses_the_snapshot_of_the_current_generation(self):
+        words = ["ኢትዮጵያ", "መንግስት", "ምርጫ", "ኢኮኖሚ", "ስፖርት", "ትምህርት", "ጤና", "ግብርና"]
+        rng = random.Random(5)
+        # fewer documents than a result page, so weights quantized in the snapshot can only reorder ties
+        for i in range(9):
+            add_document({"url": f"https://example.com/{i}", "title": "", "content": " ".join(rng.choices(words, k=6))})
+
+        def search(query):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(reverse("search_view", args=[query]))
+            results = sorted((r["url"], r["score"], r["index_terms"]) for r in response.json()["results"])
+            return results, len(queries)
+
+        def assertSameResults(found, expected):
+            self.assertEqual([(url, terms) for url, _, terms in found], [(url, terms) for url, _, terms in expected])
+            for (_, score, _), (_, expected_score, _) in zip(found, expected):
+                self.assertAlmostEqual(score, expected_score, places=3)
+
+        with tempfile.TemporaryDirectory() as directory, override_settings(SEARCH_SNAPSHOT_DIR=directory):
+            queries = ["ምርጫ ኢኮኖሚ", "ጤና", "ስፖርት ትምህርት ግብርና"]
+            expected = [search(query)[0] for query in queries]
+            write_snapshot(chunk_size=7)
+            for query, results in zip(queries, expected):
+                found, count = search(query)
+                assertSameResults(found, results)
+                # the stats, the documents and the words of their index terms
+                self.assertEqual(count, 3)
+
+            # an indexing change makes the snapshot stale until the next one is written; with
+            # packed postings the new document's rows are merged with the blobs
+            call_command("pack_postings", stdout=io.StringIO())
+            add_document({"url": "https://example.com/new", "title": "ጤና", "content": "ጤና"})
+            found, count = search("ጤና")
+            self.assertIn("https://example.com/new", [url for url, _, _ in found])
+            self.assertGreater(count, 3)
+            write_snapshot()
+            results, count = search("ጤና")
+            assertSameResults(results, found)
+            self.assertEqual(count, 3)
+            self.assertEqual(len(os.listdir(directory)), 1)
+
+    def test_boolean_queries_match_in_the_database_and_the_snapshot(self):
+        add_document({"url": "https://example.com/election", "title": "ምርጫ", "content": "ምርጫ ቦርድ"})
+        add_document({"url": "https://example.com/sport", "title": "ምርጫ", "content": "ስፖርት ስፖርት ምርጫ"})
+        add_document({"url": "https://example.com/board", "title": "", "content": "ቦርድ ጤና"})
+        add_document({"url": "https://example.com/health", "title": "", "content": "ጤና ግብርና"})
+
+        def search(query):
+            SearchEngine.postings_cache.clear()
+            response = self.client.get(reverse("search_view", args=[query]))
+            return sorted(r["url"] for r in response.json()["results"])
+
+        queries = {
+            "+ምርጫ -ስፖርት": ["https://example.com/election"],
+            "ምርጫ AND (ቦርድ OR ጤና)": ["https://example.com/election"],
+            "ቦርድ -ምርጫ": ["https://example.com/board"],
+            "NOT ምርጫ": ["https://example.com/board", "https://example.com/health"],
+            "ጤና OR ስፖርት": ["https://example.com/board", "https://example.com/health", "https://example.com/sport"],
+        }
+        with override_settings(SEARCH_SNAPSHOT_DIR=None):
+            for query, expected in queries.items():
+                self.assertEqual(search(query), expected, query)
+        with tempfile.TemporaryDirectory() as directory, override_settings(SEARCH_SNAPSHOT_DIR=directory):
+            write_snapshot()
+            for query, expected in queries.items():
+                self.assertEqual(search(query), expected, query)
+
+
+# committed indexing changes, so the rebuild thread sees them
+class SnapshotRebuildTests(TransactionTestCase):
+
+    def test_indexing_changes_rebuild_the_snapshot(self):
+        with tempfile.TemporaryDirectory() as directory, \
+                override_settings(SEARCH_SNAPSHOT_DIR=directory, SEARCH_SNAPSHOT_REBUILD_DELAY=0):
+            add_document({"url": "https://example.com/1", "title": "ምርጫ", "content": "ቦርድ"})
+            add_document({"url": "https://example.com/2", "title": "", "content": "ግብርና"})
+            # a rebuild runs on its timer thread and a retry starts a new timer before it ends
+            timers = True
+            while timers:
+                timers = [thread for thread in threading.enumerate() if isinstance(thread, threading.Timer)]
+                for timer in timers:
+                    timer.join()
+            self.assertIsNone(snapshot._rebuild[0])
+            self.assertEqual(os.listdir(directory), [f"index-{IndexStats.load().generation}.bin"])
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(reverse("search_view", args=["ምርጫ"]))
+            self.assertEqual([r["url"] for r in response.json()["results"]], ["https://example.com/1"])
+            # the stats, the documents and the words of their index terms
+            self.assertEqual(len(queries), 3)
+
+    def test_index_documents_writes_the_snapshot_before_it_exits(self):
+        with tempfile.TemporaryDirectory() as directory, \
+                override_settings(SEARCH_SNAPSHOT_DIR=directory, SEARCH_SNAPSHOT_REBUILD_DELAY=3600):
+            input_path = os.path.join(directory, "articles.jsonl")
+            with open(input_path, "w", encoding="utf-8") as f:
+                f.write(json.dumps({"url": "https://example.com/1", "title": "ምርጫ", "content": "ቦርድ"}) + "\n")
+            write_snapshot()
+            # a timer left behind would outlive the test
+            def cancel_rebuild():
+                if snapshot._rebuild[0] is not None:
+                    snapshot._rebuild[0].cancel()
+                    snapshot._rebuild[0] = None
+            self.addCleanup(cancel_rebuild)
+            call_command("index_documents", "add", input=input_path, stdout=io.StringIO())
+            self.assertIsNone(snapshot._rebuild[0])
+            self.assertEqual(
+                sorted(name for name in os.listdir(directory) if name.endswith(".bin")),
+                [f"index-{IndexStats.load().generation}.bin"],
+            )
+            self.assertGreater(IndexStats.load().generation, 0)
@@ -4,10 +4,22 @@ from rest_framework.permissions import AllowAny
 from rest_framework.response import Response
 
 import json
+import time
+import numpy as np
+from django.conf import settings
+from django.db.models import Q
 from django.http import JsonResponse
-from .models import Document,Term, Posting
+from .forward_index import index_terms
+from .models import Document, IndexStats, Term, Posting
+from .packed_postings import merge
+from .snapshot import reader
+from retrieval_system.boolean_query import BooleanQuery
 from retrieval_system.search_engine import SearchEngine
-import math
+
+# decoded postings of the database index share the retrieval system's cache, keyed by the
+# IndexStats generation so an indexing change anywhere makes the cached lists stale
+POSTINGS_CACHE = SearchEngine.postings_cache
+POSTINGS_CACHE.resize(getattr(settings, 'POSTINGS_CACHE_BYTES', POSTINGS_CACHE.max_bytes))
 # the months in the date field in the articles that were scraped from VOA had been written in amharic I had to write a simple script to convert them to english when adding them to the database.
 AMHARIC_MONTHS = {
     "ጃንዩወሪ": "January",
@@ -57,63 +69,134 @@ def import_voa_articles(request):
     return JsonResponse({'status': 'success', 'created': created_count})
 
 
-def import_data(request):
+# (document ids, tf, document norms) arrays of the postings of every term id, ordered by
+# document id, with one query for the Posting rows and one for the blobs of the packed terms;
+# a packed term also has rows for the documents added since it was packed
+def load_postings(term_ids, packed_ids=()):
+    columns = {term_id: ([], [], []) for term_id in term_ids}
+    rows = (
+        Posting.objects.filter(term_id__in=list(columns))
+        .order_by('term_id', 'document_id')
+        .values_list('term_id', 'document_id', 'tf', 'document__norm')
+    )
+    for term_id, doc_id, tf, norm in rows:
+        doc_ids, weights, norms = columns[term_id]
+        doc_ids.append(doc_id)
+        weights.append(tf)
+        norms.append(norm)
+    postings = {
+        term_id: (np.array(doc_ids, dtype=np.int64), np.array(weights, dtype=np.float64), np.array(norms, dtype=np.float64))
+        for term_id, (doc_ids, weights, norms) in columns.items()
+    }
+    packed_ids = [term_id for term_id in term_ids if term_id in packed_ids]
+    if packed_ids:
+        postings.update(
+            (term_id, merge(blob, *postings[term_id]))
+            for term_id, blob in Term.objects.filter(id__in=packed_ids).values_list('id', 'packed')
+        )
+    return postings
+
+# postings of the term ids, from the cache or read with load_postings and then cached
+def cached_postings(term_ids, packed_ids, generation):
+    lists = {}
+    missing = []
+    for term_id in term_ids:
+        cached = POSTINGS_CACHE.get(('db', generation, term_id))
+        if cached is None:
+            missing.append(term_id)
+        else:
+            lists[term_id] = cached
+    if missing:
+        start = time.perf_counter()
+        loaded = load_postings(missing, packed_ids)
+        cost = (time.perf_counter() - start) / len(missing)
+        for term_id, postings in loaded.items():
+            POSTINGS_CACHE.put(('db', generation, term_id), postings, cost)
+        lists.update(loaded)
+    return lists
+
+
+# posting lists of the database index by analyzed token, for BooleanQuery.matching_docs, like
+# the TermSource of the retrieval system. there are no positions, phrases match as their words.
+class DatabaseTermSource:
+
+    def __init__(self, generation):
+        self.generation = generation
+        self.terms = {}
+
+    # (term id, df, packed) of a token, None when it is not indexed
+    def term(self, token):
+        if token not in self.terms:
+            self.terms[token] = Term.objects.filter(word=token).values_list('id', 'df', Q(packed__isnull=False)).first()
+        return self.terms[token]
+
+    def cost(self, token):
+        term = self.term(token)
+        return 0 if term is None else term[1]
+
+    def docs(self, token):
+        term = self.term(token)
+        if term is None:
+            return np.zeros(0, dtype=np.int64)
+        term_id, _, packed = term
+        return cached_postings([term_id], {term_id} if packed else set(), self.generation)[term_id][0]
+
+    def contains(self, token, docs):
+        return SearchEngine.sorted_contains(self.docs(token), docs)
+
+    def phrase_docs(self, tokens, slop):
+        return None
 
+    def universe(self):
+        return np.array(Document.objects.order_by('id').values_list('id', flat=True), dtype=np.int64)
 
-    with open(r'C:\Users\Edeal\Documents\Felagi\isr_system\combined_articles.json', encoding='utf-8') as f:
-        articles = json.load(f)
 
-    with open(r'C:\Users\Edeal\Documents\Felagi\outputs\inverted_index.json', encoding='utf-8') as f:
-        inverted_index = json.load(f)
+# (document id, cosine) of the 10 best documents, scored from the Posting table, only among
+# the document ids in within (sorted) when given
+def rank_documents(tokens, stats, within=None):
+    # Get the terms of the query
+    terms = list(Term.objects.filter(word__in=tokens).values_list('id', 'word', 'df', Q(packed__isnull=False)))
+    term_ids = {word: term_id for term_id, word, _, _ in terms}
+    packed_ids = {term_id for term_id, _, _, packed in terms if packed}
 
-    created_count = 0
+    # Compute total_docs for IDF calculation, from the counter kept by the indexing code
+    total_docs = stats.total_docs or Document.objects.count()
 
-    for entry in articles:
-        date_str = entry.get('date', '')
-        converted_date = convert_amharic_date(date_str)
-        Document.objects.create(
-            title=entry.get('title', ''),
-            description=entry.get('content', ''),
-            url=entry.get('url', ''),
-            post_date=converted_date,
-        )
-        created_count += 1
+    # Compute query tf-idf vector keyed by term id, postings hold normalized tf so idf is only applied here
+    tokens = [term_ids[t] for t in tokens if t in term_ids]
+    query_vec = SearchEngine.query_tfidf(tokens, {term_id: df for term_id, _, df, _ in terms}, total_docs)
 
-    print('created documents: ', created_count)
+    # Get the postings of the query terms; frequent terms usually come from the cache and the
+    # rest are read with one query for each kind of storage, whatever the number of terms and documents
+    lists = cached_postings([term_id for term_id, weight in query_vec.items() if weight != 0], packed_ids, stats.generation)
+    if within is not None:
+        for term_id, postings in lists.items():
+            keep = SearchEngine.sorted_contains(within, postings[0])
+            lists[term_id] = tuple(column[keep] for column in postings)
 
-    created_count = 0
-    for term, entry in inverted_index.items():
-        df = entry.get('df', 0)
-        if df == 0:
-            continue
-        try:
-            term_obj, created = Term.objects.get_or_create(word=term, defaults={'df': df})
-            if not created:
-                # If term exists, optionally update df if needed
-                pass
-        except Exception:
-            continue  # Skip if any error occurs
-
-        for url, data in entry['postings'].items():
-            try:
-                doc = Document.objects.get(url=url)
-                # Skip if posting already exists
-                if Posting.objects.filter(term=term_obj, document=doc).exists():
-                    continue
-                posting = Posting.objects.create(
-                    term=term_obj,
-                    document=doc,
-                    tf_idf=data['tf_idf'],
-                )
-                posting.save()
-            except Exception:
-                continue  # Skip if any error occurs
-        created_count += 1
-        if created_count % 100 == 0:
-            print(f'Processed {created_count} terms')
-        term_obj.save()
+    # Compute the cosine similarity against the stored norm of the whole document, documents
+    # are numbered by their position among the sorted candidate ids
+    ranked = []
+    if lists:
+        doc_ids = np.concatenate([postings[0] for postings in lists.values()])
+        weights = np.concatenate([postings[1] * query_vec[term_id] for term_id, postings in lists.items()])
+        norms = np.concatenate([postings[2] for postings in lists.values()])
+        candidates, first, position = np.unique(doc_ids, return_index=True, return_inverse=True)
+        scores = np.bincount(position, weights=weights, minlength=len(candidates))
+        norms = norms[first]
+        # documents added without a norm fall back to the norm of their query terms
+        unset = norms == 0
+        if unset.any():
+            tf = np.concatenate([postings[1] for postings in lists.values()])
+            norms[unset] = np.sqrt(np.bincount(position, weights=tf * tf, minlength=len(candidates)))[unset]
+        top = SearchEngine.top_k(scores, norms, SearchEngine.vector_norm(query_vec), 10)
+        ranked = [(int(candidates[i]), sim) for i, sim in top]
+    # matching documents that no ranked word scores come after the others, by id
+    if within is not None and len(ranked) < 10:
+        scored = {doc_id for doc_id, _ in ranked}
+        ranked += [(int(doc_id), 0.0) for doc_id in within[:10] if int(doc_id) not in scored][:10 - len(ranked)]
+    return ranked
 
-    return JsonResponse({'status': 'success'})
 
 # Example Django view using your models and the SearchEngine logic
 # filepath: c:\Users\Edeal\Documents\Felagi\felagi\documents\views.py
@@ -127,65 +210,35 @@ def search_view(request, query):
     if not query:
         return Response({"error": "No query provided"}, status=400)
 
-    # Get all terms in the query after preprocessing
-    tokens = SearchEngine.preprocess_text(query)
-    terms = Term.objects.filter(word__in=tokens)
-    term_map = {t.word: t for t in terms}
-
-    # Compute total_docs for IDF calculation
-    total_docs = Document.objects.count()
-
-    # Compute query tf-idf vector
-    df_data = {t.word: t.df for t in terms}
-    tf_counts = {t: tokens.count(t) for t in tokens}
-    max_tf = max(tf_counts.values()) if tf_counts else 1
-    query_vec = {}
-    for term, tf in tf_counts.items():
-        normalized_tf = tf / max_tf
-        df = df_data.get(term, 0)
-        if df > 0:
-            idf = math.log2(total_docs / df)
-            query_vec[term] = normalized_tf * idf
-        else:
-            query_vec[term] = 0.0
-
-    # Get all postings for the query terms
-    postings = Posting.objects.filter(term__word__in=query_vec.keys())
-    doc_vectors = {}
-    for posting in postings:
-        doc_url = posting.document.url
-        term = posting.term.word
-        if doc_url not in doc_vectors:
-            doc_vectors[doc_url] = {}
-        doc_vectors[doc_url][term] = posting.tf_idf
-
-    # Compute cosine similarity and rank
-    ranked = []
-    for doc_url, doc_vec in doc_vectors.items():
-        sim = SearchEngine.cosine_similarity(query_vec, doc_vec)
-        if sim > 0:
-            ranked.append((doc_url, sim))
-    ranked.sort(key=lambda x: x[1], reverse=True)
-    ranked = ranked[:10]
-
-    # Fetch document info and index terms
-    docs = Document.objects.filter(url__in=[url for url, _ in ranked])
-    doc_map = {doc.url: doc for doc in docs}
-
-    # For each document, get its index terms (all terms with postings for this doc)
-    doc_terms_map = {}
-    for doc in docs:
-        index_terms = Term.objects.filter(postings__document=doc).values_list('word', flat=True)
-        doc_terms_map[doc.url] = list(index_terms)
+    stats = IndexStats.load()
+
+    # Score against the memory-mapped snapshot when it is up to date with the database; a query
+    # with boolean syntax (see boolean_query.py) only ranks the documents that match it
+    snapshot = reader(stats.generation)
+    if snapshot is not None:
+        ranked = snapshot.search(query, 10)
+        docs = Document.objects.filter(url__in=[url for url, _ in ranked])
+        key = 'url'
+    else:
+        tree, tokens = BooleanQuery.parse(query, SearchEngine.preprocess_text)
+        within = None if tree is None else BooleanQuery.matching_docs(tree, DatabaseTermSource(stats.generation))
+        ranked = rank_documents(tokens, stats, within)
+        docs = Document.objects.filter(id__in=[doc_id for doc_id, _ in ranked])
+        key = 'id'
+
+    # Fetch document info of the results with their forward index, and the words of its terms
+    docs = list(docs.values('id', 'url', 'title', 'description', 'index_terms'))
+    doc_map = {doc[key]: doc for doc in docs}
+    doc_terms_map = dict(zip(doc_map, index_terms([doc['index_terms'] for doc in docs])))
 
     response = [
         {
-            "url": url,
+            "url": doc_map[doc_id]['url'],
             "score": score,
-            "title": doc_map[url].title if url in doc_map else "",
-            "description": doc_map[url].description if url in doc_map else "",
-            "index_terms": doc_terms_map.get(url, []),
+            "title": doc_map[doc_id]['title'],
+            "description": doc_map[doc_id]['description'],
+            "index_terms": doc_terms_map.get(doc_id, []),
         }
-        for url, score in ranked
+        for doc_id, score in ranked if doc_id in doc_map
     ]
-    return Response({"results": response})
\ No newline at end of file
+    return Response({"results": response})
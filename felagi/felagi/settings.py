@@ -129,3 +129,18 @@ STATIC_URL = 'static/'
 # https://docs.djangoproject.com/en/5.0/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+# Bytes of decoded posting lists each process keeps in memory for search_view
+POSTINGS_CACHE_BYTES = 64 * 1024 * 1024
+
+# Terms kept per document in the forward index, returned as the index terms of a search result
+FORWARD_INDEX_TERMS = 32
+
+# Memory-mapped search snapshots written by `manage.py build_snapshot`, shared by the worker processes
+SEARCH_SNAPSHOT_DIR = BASE_DIR / 'snapshots'
+
+# Seconds after an in-place indexing change before the snapshot is rewritten, None to only rebuild with build_snapshot
+SEARCH_SNAPSHOT_REBUILD_DELAY = 30
+
+# Stopwords of the pipeline that builds the index, so queries drop the same words; the copy in retrieval_system is used when the file doesn't exist
+AMHARIC_STOPWORDS_PATH = BASE_DIR.parent / 'isr_system' / 'amharic_stopwords.txt'
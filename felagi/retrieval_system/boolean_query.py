@@ -0,0 +1,200 @@
+import re
+import numpy as np
+
+# boolean query language on top of the ranked search.
+#
+#   ምርጫ ቦርድ                 any of the words (a plain ranked query)
+#   +ምርጫ ቦርድ -ስፖርት          ምርጫ required, ስፖርት excluded, ቦርድ only counts for the score
+#   ምርጫ AND (ቦርድ OR ኮሚሽን)   operators in capitals, AND binds tighter than OR
+#   NOT ስፖርት                 same as -ስፖርት
+#   "ብሔራዊ ምርጫ ቦርድ"          phrase, "ምርጫ ቦርድ"~3 for the words within 3 positions
+#
+# words next to each other form a group: a document has to match every + word and phrase,
+# none of the - words and, when nothing is required, at least one of the others. parse()
+# turns the query into a tree of ("term", token), ("phrase", tokens, slop), ("and", [nodes]),
+# ("or", [nodes]) and ("not", node), with words already analyzed like the documents.
+#
+# matching_docs() evaluates a tree against a source of posting lists (the term sources in
+# search_engine.py). conjunctions start from the shortest list and only probe the longer ones
+# for the documents still left, so the more restrictive a query is, the less it decodes.
+
+TOKEN_PATTERN = re.compile(r'"([^"]*)"(?:~(\d+))?|([()])|(?<!\S)([+-])(?=[^\s+-])|([^\s()"]+)')
+OPERATORS = ("AND", "OR", "NOT")
+
+
+class BooleanQuery:
+
+    def tokenize(query):
+        tokens = []
+        for phrase, slop, paren, prefix, word in TOKEN_PATTERN.findall(query):
+            if paren or prefix:
+                tokens.append((paren or prefix, None))
+            elif word in OPERATORS:
+                tokens.append((word, None))
+            elif word:
+                tokens.append(("word", word))
+            else:
+                tokens.append(("phrase", (phrase, int(slop) if slop else None)))
+        return tokens
+
+    # (tree, words): words are the analyzed words that are not excluded, for the query vector.
+    # tree is None for a plain query of words only, which the ranking alone already answers.
+    def parse(query, analyze):
+        tokens = BooleanQuery.tokenize(query)
+        if all(kind == "word" for kind, _ in tokens):
+            return None, [token for _, word in tokens for token in analyze(word)]
+        words = []
+        position = [0]
+
+        def peek():
+            return tokens[position[0]][0] if position[0] < len(tokens) else None
+
+        def take():
+            position[0] += 1
+            return tokens[position[0] - 1]
+
+        def parse_or(negated):
+            children = [parse_and(negated)]
+            while peek() == "OR":
+                take()
+                children.append(parse_and(negated))
+            children = [child for child in children if child is not None]
+            return children[0] if len(children) == 1 else ("or", children) if children else None
+
+        def parse_and(negated):
+            children = [parse_group(negated)]
+            while peek() == "AND":
+                take()
+                children.append(parse_group(negated))
+            children = [child for child in children if child is not None]
+            return children[0] if len(children) == 1 else ("and", children) if children else None
+
+        def parse_group(negated):
+            must, should, must_not = [], [], []
+            while peek() not in (None, ")", "OR", "AND"):
+                kind = peek()
+                if kind in ("+", "-", "NOT"):
+                    take()
+                node = parse_primary(negated != (kind in ("-", "NOT")))
+                if node is None:
+                    continue
+                if kind in ("+", "phrase"):
+                    must.append(node)
+                elif kind in ("-", "NOT"):
+                    must_not.append(("not", node))
+                else:
+                    should.append(node)
+            if should and not must:
+                must.append(should[0] if len(should) == 1 else ("or", should))
+            children = must + must_not
+            if not children:
+                return None
+            return children[0] if len(children) == 1 else ("and", children)
+
+        def parse_primary(negated):
+            if peek() in (None, ")", "OR", "AND"):
+                return None
+            kind, value = take()
+            if kind == "(":
+                node = parse_or(negated)
+                # a missing closing parenthesis is closed at the end of the query
+                if peek() == ")":
+                    take()
+                return node
+            if kind == "phrase":
+                analyzed = analyze(value[0])
+                if not negated:
+                    words.extend(analyzed)
+                return ("phrase", analyzed, value[1]) if analyzed else None
+            if kind == "word":
+                analyzed = analyze(value)
+                if not negated:
+                    words.extend(analyzed)
+                terms = [("term", token) for token in analyzed]
+                return terms[0] if len(terms) == 1 else ("and", terms) if terms else None
+            # an operator without an operand
+            return None
+
+        tree = None
+        while position[0] < len(tokens):
+            node = parse_or(False)
+            if node is not None:
+                tree = node if tree is None else ("and", [tree, node])
+            if peek() is not None:
+                take()
+        return tree, words
+
+    # sorted ids of the documents that match the tree
+    def matching_docs(tree, source):
+        docs, negated = BooleanQuery.evaluate(tree, source)
+        if negated:
+            return np.setdiff1d(source.universe(), docs, assume_unique=True)
+        return docs
+
+    # (docs, negated): negated means every document except docs, so NOT never has to list
+    # the whole collection until the very end
+    def evaluate(node, source):
+        kind = node[0]
+        if kind == "term":
+            return source.docs(node[1]), False
+        if kind == "phrase":
+            docs = source.phrase_docs(node[1], node[2])
+            if docs is None:
+                # no positions, the phrase is matched as its words
+                return BooleanQuery.evaluate(("and", [("term", token) for token in node[1]]), source)
+            return docs, False
+        if kind == "not":
+            docs, negated = BooleanQuery.evaluate(node[1], source)
+            return docs, not negated
+        if kind == "or":
+            results = [BooleanQuery.evaluate(child, source) for child in node[1]]
+            matched = np.zeros(0, dtype=np.int64)
+            for docs, negated in results:
+                if not negated:
+                    matched = np.union1d(matched, docs)
+            excluded = None
+            for docs, negated in results:
+                if negated:
+                    excluded = docs if excluded is None else np.intersect1d(excluded, docs, assume_unique=True)
+            if excluded is None:
+                return matched, False
+            return np.setdiff1d(excluded, matched, assume_unique=True), True
+        return BooleanQuery.evaluate_and(node[1], source)
+
+    def evaluate_and(children, source):
+        terms, not_terms, sets, excluded = [], [], [], []
+        for child in children:
+            if child[0] == "term":
+                terms.append(child[1])
+            elif child[0] == "not" and child[1][0] == "term":
+                not_terms.append(child[1][1])
+            else:
+                docs, negated = BooleanQuery.evaluate(child, source)
+                (excluded if negated else sets).append(docs)
+
+        if not terms and not sets:
+            # nothing to start from, the result is everything except the excluded documents
+            docs = np.zeros(0, dtype=np.int64)
+            for other in excluded + [source.docs(token) for token in not_terms]:
+                docs = np.union1d(docs, other)
+            return docs, True
+
+        terms.sort(key=source.cost)
+        sets.sort(key=len)
+        if sets and (not terms or len(sets[0]) <= source.cost(terms[0])):
+            docs = sets.pop(0)
+        else:
+            docs = source.docs(terms.pop(0))
+        for other in sets:
+            docs = np.intersect1d(docs, other, assume_unique=True)
+        for token in terms:
+            if not len(docs):
+                break
+            docs = docs[source.contains(token, docs)]
+        for token in not_terms:
+            if not len(docs):
+                break
+            docs = docs[~source.contains(token, docs)]
+        for other in excluded:
+            docs = np.setdiff1d(docs, other, assume_unique=True)
+        return docs, False
@@ -1,25 +1,346 @@
+import heapq
+import itertools
 import json
+import math
+import os
+import struct
+import numpy as np
+from array import array
 from collections import defaultdict
 
 # this module builds an inverted index from the TF-IDF results.
+# the index is a list indexed by term id; each entry holds the ids of the documents that
+# contain the term (ascending) and the matching tf-idf weights in two parallel lists.
+# doc_norms holds the length of every document's full tf-idf vector, indexed by doc id, so
+# cosine scoring never has to rebuild document vectors at query time.
+# max_scores holds, per term, the largest weight / doc norm in its posting list: the most the
+# term can add to any document's cosine (per unit of query weight), which lets the search
+# engine skip documents that cannot reach the top-k.
+#
+# build_spimi builds the same index out of core for corpora that don't fit in memory:
+# postings are collected in memory until a budget is used up, then flushed to disk as a run
+# sorted by term id, and at the end the runs are k-way merged into one postings file that is
+# read back one term at a time.
+
+# run and postings files are a sequence of (term id, count) headers, each followed by count
+# doc ids (int64) and count weights (float64)
+RUN_HEADER = struct.Struct("<qq")
+
+
+# read-only view of a merged postings file, indexed by term id like the in-memory postings list
+class PostingsFile:
+
+    def __init__(self, path, offsets, counts):
+        self.path = path
+        self.offsets = offsets
+        self.counts = counts
+        self._file = open(path, "rb")
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, term_id):
+        docs, weights = array("q"), array("d")
+        if self.counts[term_id]:
+            self._file.seek(self.offsets[term_id])
+            docs.fromfile(self._file, self.counts[term_id])
+            weights.fromfile(self._file, self.counts[term_id])
+        return docs.tolist(), weights.tolist()
+
+    def __iter__(self):
+        for term_id in range(len(self)):
+            yield self[term_id]
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
 
 class InvertedIndex:
 
     @staticmethod
-    def build_inverted_index(data):
-        index = {}
+    def build_inverted_index(data, num_terms=0):
+        postings = [([], []) for _ in range(num_terms)]
+        doc_norms = []
+        total_docs = 0
+        last_doc = -1
         for entry in data:
-            url = entry.get("url", "")
-            terms = entry.get("terms", [])
-            for term_entry in terms:
-                word = term_entry["term"]
-                tf_idf = term_entry["tf_idf"]
-                if word not in index:
-                    index[word] = {"df": 0, "postings": {}}
-                if url not in index[word]["postings"]:
-                    index[word]["df"] += 1
-                    index[word]["postings"][url] = {
-                        "tf_idf": tf_idf
-                    }
-        return index
+            doc_id = entry["doc"]
+            # doc ids are handed out in input order, an id we already passed is a repeated url
+            # and only its first occurrence is indexed
+            if doc_id <= last_doc:
+                continue
+            last_doc = doc_id
+            total_docs += 1
+            while doc_id >= len(doc_norms):
+                doc_norms.append(0.0)
+            doc_norms[doc_id] = math.sqrt(sum(w * w for w in entry["tf_idf"]))
+            for term_id, tf_idf in zip(entry["terms"], entry["tf_idf"]):
+                while term_id >= len(postings):
+                    postings.append(([], []))
+                docs, weights = postings[term_id]
+                docs.append(doc_id)
+                weights.append(tf_idf)
+        return {
+            "total_docs": total_docs,
+            "doc_norms": doc_norms,
+            "max_scores": InvertedIndex.max_scores(postings, doc_norms),
+            "postings": postings,
+        }
+
+    @staticmethod
+    def max_scores(postings, doc_norms):
+        return [
+            max((w / doc_norms[d] for d, w in zip(docs, weights) if doc_norms[d] > 0), default=0.0)
+            for docs, weights in postings
+        ]
+
+    # same index from the sparse tf-idf matrix of TermWeighting.compute_tf_idf_matrix.
+    # a stable sort of the entries by term id keeps the doc ids of every term ascending.
+    @staticmethod
+    def build_from_matrix(matrix):
+        num_docs, num_terms = (int(n) for n in matrix["shape"])
+        rows = np.repeat(np.arange(num_docs), np.diff(matrix["indptr"]))
+        order = np.argsort(matrix["indices"], kind="stable")
+        docs = matrix["doc_ids"][rows[order]]
+        weights = matrix["data"][order]
+        bounds = np.concatenate(([0], np.cumsum(np.bincount(matrix["indices"], minlength=num_terms))))
+        postings = [
+            (docs[start:end].tolist(), weights[start:end].tolist())
+            for start, end in zip(bounds[:-1], bounds[1:])
+        ]
+        doc_norms = np.zeros(int(matrix["doc_ids"].max()) + 1 if num_docs else 0)
+        doc_norms[matrix["doc_ids"]] = matrix["doc_norms"]
+        doc_norms = doc_norms.tolist()
+        return {
+            "total_docs": num_docs,
+            "doc_norms": doc_norms,
+            "max_scores": InvertedIndex.max_scores(postings, doc_norms),
+            "postings": postings,
+        }
+
+    # rough memory held by a run under construction: the doc id and weight of a posting,
+    # and the two arrays plus dict slot of a term
+    POSTING_BYTES = 16
+    TERM_BYTES = 200
+
+    # same index as build_inverted_index, holding at most about memory_budget bytes of
+    # postings at a time. runs and the merged postings file are written to run_dir; the
+    # postings of the returned index are a PostingsFile the caller has to close.
+    @staticmethod
+    def build_spimi(data, memory_budget, run_dir, num_terms=0):
+        doc_norms = []
+        max_scores = [0.0] * num_terms
+        runs = []
+        block = {}
+        used = 0
+        total_docs = 0
+        last_doc = -1
+        for entry in data:
+            doc_id = entry["doc"]
+            if doc_id <= last_doc:
+                continue
+            last_doc = doc_id
+            total_docs += 1
+            while doc_id >= len(doc_norms):
+                doc_norms.append(0.0)
+            norm = math.sqrt(sum(w * w for w in entry["tf_idf"]))
+            doc_norms[doc_id] = norm
+            for term_id, tf_idf in zip(entry["terms"], entry["tf_idf"]):
+                lists = block.get(term_id)
+                if lists is None:
+                    lists = block[term_id] = (array("q"), array("d"))
+                    used += InvertedIndex.TERM_BYTES
+                lists[0].append(doc_id)
+                lists[1].append(tf_idf)
+                used += InvertedIndex.POSTING_BYTES
+                while term_id >= len(max_scores):
+                    max_scores.append(0.0)
+                if norm > 0:
+                    max_scores[term_id] = max(max_scores[term_id], tf_idf / norm)
+            if used >= memory_budget:
+                runs.append(InvertedIndex.flush_run(block, os.path.join(run_dir, f"run{len(runs)}.bin")))
+                block = {}
+                used = 0
+        if block:
+            runs.append(InvertedIndex.flush_run(block, os.path.join(run_dir, f"run{len(runs)}.bin")))
+        postings = InvertedIndex.merge_runs(runs, os.path.join(run_dir, "postings.bin"), len(max_scores))
+        return {"total_docs": total_docs, "doc_norms": doc_norms, "max_scores": max_scores, "postings": postings}
+
+    @staticmethod
+    def flush_run(block, path):
+        with open(path, "wb") as f:
+            for term_id in sorted(block):
+                docs, weights = block[term_id]
+                f.write(RUN_HEADER.pack(term_id, len(docs)))
+                docs.tofile(f)
+                weights.tofile(f)
+        return path
+
+    @staticmethod
+    def iter_run(path, run_number):
+        with open(path, "rb") as f:
+            while True:
+                header = f.read(RUN_HEADER.size)
+                if not header:
+                    break
+                term_id, count = RUN_HEADER.unpack(header)
+                yield term_id, run_number, f.read(count * 8), f.read(count * 8)
+
+    # k-way merge of the runs by term id. runs hold consecutive ranges of documents, so
+    # appending the lists of a term in run order keeps its doc ids ascending. only the lists
+    # of one term are in memory at a time, and the runs are removed once merged. with more
+    # than MERGE_FAN_IN runs, consecutive groups are merged into bigger runs first so the
+    # number of open files stays bounded.
+    MERGE_FAN_IN = 64
+
+    @staticmethod
+    def merge_runs(runs, path, num_terms):
+        level = 0
+        while len(runs) > InvertedIndex.MERGE_FAN_IN:
+            fan_in = InvertedIndex.MERGE_FAN_IN
+            groups = [runs[start:start + fan_in] for start in range(0, len(runs), fan_in)]
+            runs = []
+            for number, group in enumerate(groups):
+                merged_path = os.path.join(os.path.dirname(path), f"merge{level}_{number}.bin")
+                InvertedIndex.write_merged(group, merged_path, num_terms)
+                runs.append(merged_path)
+            level += 1
+        offsets, counts = InvertedIndex.write_merged(runs, path, num_terms)
+        return PostingsFile(path, offsets, counts)
+
+    # merges runs into one file of the same format, returns the offset and count of every term
+    @staticmethod
+    def write_merged(runs, path, num_terms):
+        offsets = array("q", bytes(8 * num_terms))
+        counts = array("q", bytes(8 * num_terms))
+        merged = heapq.merge(
+            *(InvertedIndex.iter_run(run, number) for number, run in enumerate(runs)),
+            key=lambda item: item[:2],
+        )
+        with open(path, "wb") as f:
+            for term_id, parts in itertools.groupby(merged, key=lambda item: item[0]):
+                parts = list(parts)
+                count = sum(len(docs) for _, _, docs, _ in parts) // 8
+                f.write(RUN_HEADER.pack(term_id, count))
+                offsets[term_id] = f.tell()
+                counts[term_id] = count
+                for _, _, docs, _ in parts:
+                    f.write(docs)
+                for _, _, _, weights in parts:
+                    f.write(weights)
+        for run in runs:
+            os.remove(run)
+        return offsets, counts
+
+    # writes the index as json one posting list at a time, the output is the same as
+    # json.dump(index) but the postings never have to be in memory together
+    @staticmethod
+    def save(path, index):
+        with open(path, "w", encoding="utf-8") as f:
+            f.write('{"total_docs":%d' % index["total_docs"])
+            for key in ("doc_norms", "max_scores"):
+                f.write(f',"{key}":')
+                f.write(json.dumps(index[key], separators=(",", ":")))
+            f.write(',"postings":[')
+            for term_id, (docs, weights) in enumerate(index["postings"]):
+                if term_id:
+                    f.write(",")
+                f.write(json.dumps([docs, weights], separators=(",", ":")))
+            f.write("]}")
+
+    # reads an index written by save (or json.dump) back without holding the postings in
+    # memory: returns the other top-level fields, which come before "postings", and an
+    # iterator over the (term id, doc ids, weights) of every term
+    @staticmethod
+    def stream(path, chunk_size=1 << 20):
+        reader = JsonStream(open(path, "r", encoding="utf-8"), chunk_size)
+        header = {}
+        reader.expect("{")
+        while True:
+            key = reader.value()
+            reader.expect(":")
+            if key == "postings":
+                break
+            header[key] = reader.value()
+            if reader.expect(",}") == "}":
+                reader.close()
+                return header, iter(())
+
+        def postings():
+            with reader:
+                reader.expect("[")
+                term_id = 0
+                while reader.peek() != "]":
+                    docs, weights = reader.value()
+                    yield term_id, docs, weights
+                    term_id += 1
+                    if reader.expect(",]") == "]":
+                        break
+        return header, postings()
+
+
+# incremental json reader over a file, one value at a time
+class JsonStream:
+
+    def __init__(self, f, chunk_size):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        if self.pos > self.chunk_size:
+            self.buffer = self.buffer[self.pos:]
+            self.pos = 0
+        chunk = self.f.read(self.chunk_size)
+        self.eof = not chunk
+        self.buffer += chunk
+        return not self.eof
+
+    def peek(self):
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                raise ValueError("unexpected end of the index file")
+
+    # consumes one of the given characters and returns it
+    def expect(self, chars):
+        char = self.peek()
+        if char not in chars:
+            raise ValueError(f"expected one of {chars!r} in the index file, found {char!r}")
+        self.pos += 1
+        return char
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # a number at the end of the buffer might continue in the next chunk
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.fill()
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
 
+    def __exit__(self, *exc):
+        self.close()
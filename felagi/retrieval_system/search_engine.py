@@ -1,43 +1,365 @@
 import json
 import math
+import os
 import re
+import threading
+import numpy as np
 from collections import Counter
+from .binary_index import BinaryIndex
+from .boolean_query import BooleanQuery
+from .inverted_index import InvertedIndex
+from .positional_index import PositionalIndex
+from .postings_cache import PostingsCache
+from .segments import SegmentedIndex
 from .text_operations import TextOperations
-from datasets import load_dataset
+from .vocabulary import Vocabulary
+
+
+# keeps the inverted index, the df table and the vocabulary in memory between queries.
+# the files are only parsed again when their mtime or size changes on disk, and the
+# new copy is swapped in as a whole so a running query never sees a half loaded index.
+# a binary index (see binary_index.py) carries its own term dictionary, df and doc table,
+# it is memory-mapped instead of parsed and the other two files are not read at all.
+# a directory with a segments.json (see segments.py) is searched segment by segment; only
+# the manifest is watched, segment files never change once written.
+# the positional index (positions.bin next to the index) is only opened by the first query of
+# a snapshot that has a phrase in it. lists decoded from a binary index or a segment go
+# through SearchEngine.postings_cache.
+class IndexReader:
+
+    def __init__(self, inverted_index_path, word_frequencies_path, vocabulary_path=None):
+        self.inverted_index_path = inverted_index_path
+        self.word_frequencies_path = word_frequencies_path
+        self.vocabulary_path = vocabulary_path or Vocabulary.path_for(inverted_index_path)
+        self.positions_path = PositionalIndex.path_for(inverted_index_path)
+        self.segmented = SegmentedIndex.is_segmented_index(inverted_index_path)
+        self.binary = not self.segmented and BinaryIndex.is_binary_index(inverted_index_path)
+        self.generation = 0
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self.reload()
+
+    def _file_stamp(self):
+        stamp = []
+        paths = (self.inverted_index_path,)
+        if self.segmented:
+            paths = (SegmentedIndex.manifest_path(self.inverted_index_path),)
+        elif not self.binary:
+            paths += (self.word_frequencies_path, self.vocabulary_path)
+        for path in paths:
+            st = os.stat(path)
+            stamp.append((st.st_mtime_ns, st.st_size))
+        return tuple(stamp)
+
+    def _load_snapshot(self, stamp):
+        if self.segmented:
+            segments = SegmentedIndex(self.inverted_index_path)
+            return {
+                "stamp": stamp,
+                "segments": segments,
+                "binary": None,
+                "total_docs": max(segments.total_docs, 1),
+            }
+        if self.binary:
+            index = BinaryIndex(self.inverted_index_path)
+            return {
+                "stamp": stamp,
+                "segments": None,
+                "binary": index,
+                "doc_norms": index.doc_norms,
+                "total_docs": max(index.total_docs, 1),
+            }
+
+        with open(self.inverted_index_path, "r", encoding="utf-8") as f:
+            inverted_index = json.load(f)
+        vocabulary = Vocabulary.load(self.vocabulary_path)
+
+        # corpus stats are computed once per load instead of once per query, and the posting
+        # lists become arrays once so scoring can work on them in bulk
+        postings = [
+            (np.asarray(docs, dtype=np.int64), np.asarray(weights, dtype=np.float64))
+            for docs, weights in inverted_index["postings"]
+        ]
+        max_scores = inverted_index.get("max_scores")
+        if max_scores is None:
+            # index written before max scores were stored
+            max_scores = InvertedIndex.max_scores(inverted_index["postings"], inverted_index["doc_norms"])
+        return {
+            "stamp": stamp,
+            "postings": postings,
+            "max_scores": max_scores,
+            "doc_norms": np.asarray(inverted_index["doc_norms"], dtype=np.float64),
+            "df": SearchEngine.load_df_table(self.word_frequencies_path),
+            "vocabulary": vocabulary,
+            "segments": None,
+            "binary": None,
+            "total_docs": max(inverted_index["total_docs"], 1),
+        }
+
+    def reload(self):
+        with self._lock:
+            stamp = self._file_stamp()
+            self._snapshot = self._load_snapshot(stamp)
+            self.generation += 1
+        return self._snapshot
+
+    # cheap stat() check on every query, the expensive parse only happens after a change
+    def current(self):
+        snapshot = self._snapshot
+        try:
+            stamp = self._file_stamp()
+        except OSError:
+            # the files are being replaced, keep serving the copy we have
+            return snapshot
+        if stamp == snapshot["stamp"]:
+            return snapshot
+        with self._lock:
+            if self._snapshot["stamp"] != stamp:
+                try:
+                    self._snapshot = self._load_snapshot(stamp)
+                    self.generation += 1
+                except (OSError, ValueError, KeyError):
+                    pass
+            return self._snapshot
+
+    @property
+    def total_docs(self):
+        return self.current()["total_docs"]
+
+    # query tf-idf keyed by term id (by term for a segmented index), terms that are not in
+    # the vocabulary can't match anything
+    def query_vector(self, query, snapshot=None):
+        return self.term_vector(SearchEngine.preprocess_text(query), snapshot)
+
+    # the same from already analyzed query tokens
+    def term_vector(self, tokens, snapshot=None):
+        snapshot = snapshot or self.current()
+        segments = snapshot["segments"]
+        if segments is not None:
+            # df still counts documents deleted since their segment was merged, capping it at the
+            # live document count keeps idf from going negative
+            df = {term: min(segments.df(term), segments.total_docs) for term in set(tokens)}
+            tokens = [term for term in tokens if df[term] > 0]
+            return SearchEngine.query_tfidf(tokens, df, snapshot["total_docs"])
+        index = snapshot["binary"]
+        if index is not None:
+            entries = [index.lookup(t) for t in tokens]
+            entries = [entry for entry in entries if entry is not None]
+            tokens = [int(index.terms[entry]["term_id"]) for entry in entries]
+            df = {term_id: index.df(entry) for term_id, entry in zip(tokens, entries)}
+            return SearchEngine.query_tfidf(tokens, df, snapshot["total_docs"])
+        term_ids = snapshot["vocabulary"].term_ids
+        tokens = [term_ids[t] for t in tokens if t in term_ids]
+        df = snapshot["df"]
+        return SearchEngine.query_tfidf(tokens, {t: df[t] for t in tokens}, snapshot["total_docs"])
+
+    def term_id(self, term, snapshot=None):
+        snapshot = snapshot or self.current()
+        index = snapshot["binary"]
+        if index is None:
+            return snapshot["vocabulary"].term_id(term)
+        entry = index.lookup(term)
+        return None if entry is None else int(index.terms[entry]["term_id"])
+
+    # the positional index of the snapshot, or None when the pipeline didn't write one
+    def positions(self, snapshot=None):
+        snapshot = snapshot or self.current()
+        if "positions" not in snapshot:
+            with self._lock:
+                if "positions" not in snapshot:
+                    path = self.positions_path
+                    snapshot["positions"] = PositionalIndex(path) if os.path.exists(path) else None
+        return snapshot["positions"]
+
+    # (doc ids, weights) arrays of one term, decoded from the mapped file for a binary index
+    def postings(self, term_id, snapshot=None):
+        snapshot = snapshot or self.current()
+        index = snapshot["binary"]
+        if index is None:
+            return snapshot["postings"][term_id]
+        return SearchEngine.cached_postings(index, index.entry_for_id(term_id), snapshot["stamp"])
+
+    # upper bound of weight / doc norm over the posting list of a term
+    def max_score(self, term_id, snapshot=None):
+        snapshot = snapshot or self.current()
+        index = snapshot["binary"]
+        if index is None:
+            return snapshot["max_scores"][term_id]
+        return index.max_score(index.entry_for_id(term_id))
+
+    def url(self, doc_id, snapshot=None):
+        snapshot = snapshot or self.current()
+        if snapshot["binary"] is not None:
+            return snapshot["binary"].url(doc_id)
+        return snapshot["vocabulary"].docs[doc_id]
+
+    # a query with boolean syntax (see boolean_query.py) is first evaluated to the set of
+    # matching documents and only that set is ranked, by the words that are not excluded.
+    # segments carry no positions, so a segmented index matches phrases as their words.
+    def search(self, query, top_k=100, prune=True):
+        snapshot = self.current()
+        tree, words = BooleanQuery.parse(query, SearchEngine.preprocess_text)
+        query_vec = self.term_vector(words, snapshot)
+        if snapshot["segments"] is not None:
+            return self.rank_segments(query_vec, top_k, snapshot, prune, tree)
+        within = None if tree is None else BooleanQuery.matching_docs(tree, TermSource(self, snapshot))
+        ranked = self.rank(query_vec, top_k, snapshot, prune, within)
+        return [(self.url(doc_id, snapshot), sim) for doc_id, sim in ranked]
+
+    # (doc id, cosine) pairs of the best top_k documents for a query vector keyed by term id,
+    # only among the documents in within (sorted doc ids) when given. a binary index then
+    # only decodes the blocks of each list that hold one of those documents.
+    def rank(self, query_vec, top_k=100, snapshot=None, prune=True, within=None):
+        snapshot = snapshot or self.current()
+        index = snapshot["binary"]
+        lists = {
+            term_id: self.postings(term_id, snapshot) if within is None or index is None
+            else index.postings_for(index.entry_for_id(term_id), within)
+            for term_id, query_weight in query_vec.items() if query_weight != 0
+        }
+        max_scores = {term_id: self.max_score(term_id, snapshot) for term_id in lists}
+        return SearchEngine.rank_lists(query_vec, lists, max_scores, snapshot["doc_norms"], top_k, prune, within=within)
+
+    # fan out over the segments: every segment ranks its own live documents against the same
+    # query vector and query norm, and the per-segment top_k lists are merged into (url, cosine).
+    # a boolean query tree is evaluated segment by segment.
+    def rank_segments(self, query_vec, top_k=100, snapshot=None, prune=True, tree=None):
+        snapshot = snapshot or self.current()
+        query_norm = SearchEngine.vector_norm(query_vec)
+        ranked = []
+        for number, (_, index, live_norms, _) in enumerate(snapshot["segments"].segments):
+            within = None
+            if tree is not None:
+                within = BooleanQuery.matching_docs(tree, SegmentTermSource(index, live_norms))
+            segment_vec = {}
+            for term, query_weight in query_vec.items():
+                entry = index.lookup(term)
+                if entry is not None and query_weight != 0:
+                    segment_vec[entry] = query_weight
+            lists = {
+                entry: SearchEngine.cached_postings(index, entry) if within is None else index.postings_for(entry, within)
+                for entry in segment_vec
+            }
+            max_scores = {entry: index.max_score(entry) for entry in segment_vec}
+            for doc_id, sim in SearchEngine.rank_lists(segment_vec, lists, max_scores, live_norms, top_k, prune,
+                                                       query_norm, within):
+                ranked.append((-sim, number, doc_id))
+        ranked.sort()
+        segments = snapshot["segments"].segments
+        return [(segments[number][1].url(doc_id), -sim) for sim, number, doc_id in ranked[:top_k]]
+
+
+# posting lists of a reader snapshot by analyzed token, for BooleanQuery.matching_docs
+class TermSource:
+
+    def __init__(self, reader, snapshot):
+        self.reader = reader
+        self.snapshot = snapshot
+        self.index = snapshot["binary"]
+
+    def key(self, token):
+        if self.index is not None:
+            return self.index.lookup(token)
+        return self.snapshot["vocabulary"].term_id(token)
+
+    # length of the posting list, what it costs to read it
+    def cost(self, token):
+        key = self.key(token)
+        if key is None:
+            return 0
+        if self.index is not None:
+            return int(self.index.terms[key]["count"])
+        return len(self.snapshot["postings"][key][0])
+
+    def docs(self, token):
+        key = self.key(token)
+        if key is None:
+            return np.zeros(0, dtype=np.int64)
+        if self.index is not None:
+            return SearchEngine.cached_postings(self.index, key, self.snapshot["stamp"])[0]
+        return self.snapshot["postings"][key][0]
+
+    def contains(self, token, docs):
+        key = self.key(token)
+        if key is None:
+            return np.zeros(len(docs), dtype=bool)
+        if self.index is not None:
+            return self.index.contains(key, docs)
+        return SearchEngine.sorted_contains(self.snapshot["postings"][key][0], docs)
+
+    # None without a positional index
+    def phrase_docs(self, tokens, slop):
+        positions = self.reader.positions(self.snapshot)
+        if positions is None:
+            return None
+        return positions.phrase_docs([self.reader.term_id(token, self.snapshot) for token in tokens], slop)
+
+    def universe(self):
+        return np.flatnonzero(self.snapshot["doc_norms"] > 0)
+
+
+# the same for one segment, whose deleted documents have a live norm of 0
+class SegmentTermSource:
+
+    def __init__(self, index, live_norms):
+        self.index = index
+        self.live_norms = live_norms
+
+    def cost(self, token):
+        entry = self.index.lookup(token)
+        return 0 if entry is None else int(self.index.terms[entry]["count"])
+
+    def docs(self, token):
+        entry = self.index.lookup(token)
+        return np.zeros(0, dtype=np.int64) if entry is None else SearchEngine.cached_postings(self.index, entry)[0]
+
+    def contains(self, token, docs):
+        entry = self.index.lookup(token)
+        return np.zeros(len(docs), dtype=bool) if entry is None else self.index.contains(entry, docs)
+
+    def phrase_docs(self, tokens, slop):
+        return None
+
+    def universe(self):
+        return np.flatnonzero(self.live_norms > 0)
+
+
 class SearchEngine:
-    
 
+    # one reader per (index, word frequencies) pair, shared by every query in the process
+    _readers = {}
+    _readers_lock = threading.Lock()
+
+    # decoded posting lists shared by every reader in the process, see postings_cache.py
+    postings_cache = PostingsCache()
 
-    @staticmethod
-    def load_amharic_stopwords():
-        # loading amharic stopwords from a hugging face dataset
-        dataset = load_dataset("uhhlt/amharic-stopwords")
-        stopwords = [row['text'] for row in dataset["train"]]
-        return stopwords
-    #doing the same text operations that have been done in the dataset 
+    # (doc ids, weights) of an entry of a binary index through the cache. generation tells
+    # apart versions of the same file; segment files never change and need none.
+    def cached_postings(index, entry, generation=None):
+        key = (index.path, generation, entry)
+        return SearchEngine.postings_cache.get_or_load(key, lambda: index.postings(entry))
+
+    #doing the same text operations that have been done in the dataset
     def preprocess_text(text):
         text = TextOperations.clean_and_tokenize(text)
         text = [t.lower() for t in text]
-        stopwords = SearchEngine.load_amharic_stopwords()
+        stopwords = TextOperations.load_amharic_stopwords()
         text = [t for t in text if t not in stopwords]
 
         text = [TextOperations.stemmer(t) for t in text]
 
         return text
 
-    #computing the tf-idf for the query
-    def compute_query_tfidf(query, word_frequencies_path, total_docs):
-        tokens = SearchEngine.preprocess_text(query)
+    # df by term id from the {"cf": [...], "df": [...]} word frequencies of the pipeline
+    def load_df_table(word_frequencies_path):
+        with open(word_frequencies_path, "r", encoding="utf-8") as f:
+            return json.load(f)["df"]
+
+    #computing the tf-idf for already preprocessed query tokens
+    def query_tfidf(tokens, df_data, total_docs):
         tf_counts = Counter(tokens)
         max_tf = max(tf_counts.values()) if tf_counts else 1
 
-        with open(word_frequencies_path, "r", encoding="utf-8") as f:
-            wf_data = json.load(f)
-        if isinstance(wf_data, list):
-            df_data = {entry["term"]: entry["df"] for entry in wf_data}
-        else:
-            df_data = wf_data
-
         tfidf_query = {}
         for term, tf in tf_counts.items():
             normalized_tf = tf / max_tf
@@ -49,47 +371,137 @@ class SearchEngine:
                 tfidf_query[term] = 0.0
         return tfidf_query
 
-    #computing the cosine similarity between the query and the documents
-    def cosine_similarity(query_vec, doc_vec):
-        dot_product = sum(query_vec[t] * doc_vec.get(t, 0.0) for t in query_vec)
-        query_norm = math.sqrt(sum(v**2 for v in query_vec.values()))
-        doc_norm = math.sqrt(sum(v**2 for v in doc_vec.values()))
+    #computing the tf-idf for the query, keyed by term id
+    def compute_query_tfidf(query, word_frequencies_path, total_docs, vocabulary_path=None):
+        vocabulary = Vocabulary.load(vocabulary_path or Vocabulary.path_for(word_frequencies_path))
+        tokens = [vocabulary.term_ids[t] for t in SearchEngine.preprocess_text(query) if t in vocabulary.term_ids]
+        df = SearchEngine.load_df_table(word_frequencies_path)
+        return SearchEngine.query_tfidf(tokens, {t: df[t] for t in tokens}, total_docs)
+
+    def vector_norm(vec):
+        return math.sqrt(sum(v**2 for v in vec.values()))
+
+    def cosine_from_dot(dot_product, query_norm, doc_norm):
         if query_norm == 0 or doc_norm == 0:
             return 0.0
         return dot_product / (query_norm * doc_norm)
 
-    # ranking and displaying the results using the inverted index
-    def ranked_query(query, inverted_index_path, word_frequencies_path, top_k=100):
-        with open(inverted_index_path, "r", encoding="utf-8") as f:
-            inverted_index = json.load(f)
+    # term at a time: one pass over the posting list of every query term adds into an
+    # accumulator indexed by doc id, the document side of the cosine comes from the norms
+    # stored in the index. with prune, max_score_candidates first narrows the documents
+    # that can still reach the top-k and only those are looked up in the lists; the dot
+    # products are summed in the same order either way, so the results are identical.
+    # query_norm defaults to the norm of query_vec. within (sorted doc ids) limits the ranking
+    # to those documents, they are probed the same way as pruning candidates, and every one of
+    # them is a result even when the query words don't score it.
+    def rank_lists(query_vec, lists, max_scores, doc_norms, top_k, prune=True, query_norm=None, within=None):
+        candidates = None
+        if within is not None:
+            candidates = np.asarray(within, dtype=np.int64)
+        elif prune and len(lists) > 1:
+            bounds = {term_id: query_vec[term_id] * max_scores[term_id] for term_id in lists}
+            candidates = SearchEngine.max_score_candidates(query_vec, lists, bounds, doc_norms, top_k)
 
-        # Collect all unique document URLs that share at least one query term
-        doc_vectors = {}
-        total_docs = 0
-        for term_data in inverted_index.values():
-            total_docs += len(term_data["postings"])
-        total_docs = max(total_docs, 1)  # avoid division by zero
+        scores = np.zeros(len(doc_norms), dtype=np.float64)
+        for term_id, (docs, weights) in lists.items():
+            if candidates is not None and len(docs):
+                # binary search of the candidates in the sorted doc ids instead of a full scan
+                positions = np.minimum(np.searchsorted(docs, candidates), len(docs) - 1)
+                found = docs[positions] == candidates
+                docs, weights = candidates[found], weights[positions[found]]
+            # doc ids are unique within a posting list, so the fancy-indexed add is safe
+            scores[docs] += query_vec[term_id] * weights
 
-        query_vec = SearchEngine.compute_query_tfidf(query, word_frequencies_path, total_docs)
+        if query_norm is None:
+            query_norm = SearchEngine.vector_norm(query_vec)
+        return SearchEngine.top_k(scores, doc_norms, query_norm, top_k, within)
 
-        # Build doc vectors for only docs that share terms with the query
-        docs_with_terms = set()
-        for term in query_vec:
-            if term in inverted_index:
-                docs_with_terms.update(inverted_index[term]["postings"].keys())
+    # maxscore pruning. bounds[t] is the most term t can add to any document's score (query
+    # weight times the term's max score). the terms are scanned in full from the highest bound
+    # down, keeping partial scores; the k-th best partial score is a lower bound of the final
+    # k-th score. as soon as the bounds of the remaining terms add up to less than that, no
+    # unseen document can make the top-k, and neither can a seen one whose partial score plus
+    # those bounds stays below it. returns the doc ids that survive, or None when every list
+    # had to be scanned anyway.
+    # scores here are cosines without the query norm, which is the same for every document.
+    # the slack keeps rounding in the partial sums from ever dropping a tied document.
+    PRUNE_SLACK = 1e-9
 
-        for doc_url in docs_with_terms:
-            doc_vec = {}
-            for term in query_vec:
-                if term in inverted_index and doc_url in inverted_index[term]["postings"]:
-                    doc_vec[term] = inverted_index[term]["postings"][doc_url]["tf_idf"]
-            doc_vectors[doc_url] = doc_vec
+    def max_score_candidates(query_vec, lists, bounds, doc_norms, k):
+        if k <= 0:
+            return None
+        order = sorted(lists, key=lambda term_id: bounds[term_id], reverse=True)
+        remaining = [0.0] * (len(order) + 1)
+        for i in range(len(order) - 1, -1, -1):
+            remaining[i] = remaining[i + 1] + bounds[order[i]]
 
-        ranked = []
-        for doc_url, doc_vec in doc_vectors.items():
-            sim = SearchEngine.cosine_similarity(query_vec, doc_vec)
-            if sim > 0:
-                ranked.append((doc_url, sim))
-        ranked.sort(key=lambda x: x[1], reverse=True)
-        return ranked[:top_k]
+        partial = np.zeros(len(doc_norms), dtype=np.float64)
+        for i, term_id in enumerate(order[:-1]):
+            docs, weights = lists[term_id]
+            norms = doc_norms[docs]
+            partial[docs] += query_vec[term_id] * np.divide(weights, norms, out=np.zeros(len(docs)), where=norms > 0)
+            seen = np.flatnonzero(partial > 0)
+            if len(seen) < k:
+                continue
+            theta = np.partition(partial[seen], len(seen) - k)[len(seen) - k] * (1 - SearchEngine.PRUNE_SLACK)
+            rest = remaining[i + 1] * (1 + SearchEngine.PRUNE_SLACK)
+            if rest < theta:
+                return seen[partial[seen] + rest >= theta]
+        return None
+
+    # which of docs (sorted) are in the sorted doc ids of a posting list
+    def sorted_contains(list_docs, docs):
+        if not len(list_docs):
+            return np.zeros(len(docs), dtype=bool)
+        positions = np.minimum(np.searchsorted(list_docs, docs), len(list_docs) - 1)
+        return list_docs[positions] == docs
 
+    # best k documents of a dot product accumulator, as (doc id, cosine) pairs.
+    # argpartition finds the k best in linear time and only those k get sorted; equal
+    # scores are ordered by doc id. with within, the candidates are those documents
+    # whether they scored or not.
+    def top_k(scores, doc_norms, query_norm, k, within=None):
+        if within is None:
+            candidates = np.flatnonzero((scores > 0) & (doc_norms > 0))
+            if query_norm == 0:
+                return []
+        else:
+            candidates = np.asarray(within, dtype=np.int64)
+            candidates = candidates[doc_norms[candidates] > 0]
+        if not len(candidates) or k <= 0:
+            return []
+        sims = np.zeros(len(candidates))
+        if query_norm > 0:
+            sims = scores[candidates] / (query_norm * doc_norms[candidates])
+        if len(candidates) > k:
+            # keep every document tied with the k-th score so the doc id order decides
+            kth = sims[np.argpartition(-sims, k - 1)[k - 1]]
+            keep = sims >= kth
+            candidates, sims = candidates[keep], sims[keep]
+        order = np.lexsort((candidates, -sims))[:k]
+        return [(int(doc_id), float(sim)) for doc_id, sim in zip(candidates[order], sims[order])]
+
+    #computing the cosine similarity between the query and the documents
+    # doc_norm is the stored norm of the whole document; without it the norm of doc_vec is used
+    def cosine_similarity(query_vec, doc_vec, doc_norm=None):
+        dot_product = sum(query_vec[t] * doc_vec.get(t, 0.0) for t in query_vec)
+        if doc_norm is None:
+            doc_norm = SearchEngine.vector_norm(doc_vec)
+        return SearchEngine.cosine_from_dot(dot_product, SearchEngine.vector_norm(query_vec), doc_norm)
+
+    # word_frequencies_path can be None for a binary or segmented index
+    def get_reader(inverted_index_path, word_frequencies_path=None):
+        key = (os.path.abspath(inverted_index_path), word_frequencies_path and os.path.abspath(word_frequencies_path))
+        reader = SearchEngine._readers.get(key)
+        if reader is None:
+            with SearchEngine._readers_lock:
+                reader = SearchEngine._readers.get(key)
+                if reader is None:
+                    reader = IndexReader(*key)
+                    SearchEngine._readers[key] = reader
+        return reader
+
+    # ranking and displaying the results using the inverted index
+    def ranked_query(query, inverted_index_path, word_frequencies_path=None, top_k=100):
+        reader = SearchEngine.get_reader(inverted_index_path, word_frequencies_path)
+        return reader.search(query, top_k)
@@ -1,11 +1,18 @@
+import functools
 import json
+import multiprocessing
+import os
 import re
 import string
-from collections import Counter
-import matplotlib.pyplot as plt
-import numpy as np
-from scipy.stats import linregress
-from datasets import load_dataset
+import warnings
+from collections import Counter, deque
+from .abbreviation_expander import AbbreviationExpander
+from .records import RecordWriter, iter_records, write_records
+from .vocabulary import Vocabulary
+
+# matplotlib, numpy, scipy and datasets are only needed for the zipf analysis and for
+# refreshing the stopword file, so they are imported inside those functions. this
+# module is imported by every django worker and should stay cheap to import.
 
 # For this project, I used a set of articles I scraped from voa and ethiopian reporter. I've also attached the code for the scrapers.
 
@@ -13,14 +20,111 @@ from datasets import load_dataset
 
 
 
+# rule based amharic stemmer. the longest matching prefix is stripped first and then the
+# longest matching suffix of what is left. prefixes and suffixes are compiled into tries once
+# so a word is matched in a single walk, and stems are memoized in a bounded lru cache.
+class AmharicStemmer:
+
+    SUFFIXES = [
+        'ኝ', 'ህ', 'ሽ', 'ት', 'ች', 'ን', 'ችሁ', 'ቸው', 
+        'ልኝ', 'ብኝ', 'ልህ', 'ብህ', 'ልሽ', 'ብሽ',
+        'ዬ', 'ሀ', 'ሺ', 'ዋ', 'ናችን', 'ናችሁ', 'ናቸው', 
+        'ኦች', 'ዮች', 'ዎች', 'አን', 'አት',            
+        'ኡ', 'ው', 'ዋ', 'እትዋ', 'እጥታ',       
+        'ን', "ዬ"                         
+        'ና',                            
+        'ነት', 'ነስ', 'አይት', 'ኦች', 'አው',          
+    ]
+    PREFIXES = [
+        'እ',
+        'ት',
+        'ይ', 
+        'እና', 
+        'አይ',  
+        'አል', 
+        'ሰ',    
+        'ራ', 
+        'አስ',  
+        'ታን', 
+        'አን',
+        "የ", 
+        "እነ",  
+        "ለ",
+        "በ",
+        "ከ",
+    
+    ]
+
+    _END = ""
+
+    def __init__(self, prefixes=None, suffixes=None, cache_size=200000):
+        self.prefix_trie = AmharicStemmer.build_trie(prefixes or AmharicStemmer.PREFIXES)
+        # suffixes are stored reversed so they can be matched walking the word backwards
+        self.suffix_trie = AmharicStemmer.build_trie(
+            suffix[::-1] for suffix in (suffixes or AmharicStemmer.SUFFIXES)
+        )
+        self.stem = functools.lru_cache(maxsize=cache_size)(self.stem_uncached)
+
+    @staticmethod
+    def build_trie(affixes):
+        trie = {}
+        for affix in affixes:
+            if not affix:
+                continue
+            node = trie
+            for char in affix:
+                node = node.setdefault(char, {})
+            node[AmharicStemmer._END] = True
+        return trie
+
+    # length of the longest affix in the trie that the character sequence starts with
+    @staticmethod
+    def longest_match(trie, chars):
+        node = trie
+        longest = 0
+        for depth, char in enumerate(chars, 1):
+            node = node.get(char)
+            if node is None:
+                break
+            if AmharicStemmer._END in node:
+                longest = depth
+        return longest
+
+    def stem_uncached(self, word):
+        prefix_length = AmharicStemmer.longest_match(self.prefix_trie, word)
+        prefix_removed = word[prefix_length:]
+        suffix_length = AmharicStemmer.longest_match(self.suffix_trie, reversed(prefix_removed))
+        if suffix_length:
+            return prefix_removed[:-suffix_length]
+        return prefix_removed
+
+    # stems every distinct word once, used for whole vocabularies where most tokens repeat
+    def stem_vocabulary(self, words):
+        return {word: self.stem_uncached(word) for word in set(words)}
+
+    def cache_stats(self):
+        info = self.stem.cache_info()
+        lookups = info.hits + info.misses
+        return {
+            "hits": info.hits,
+            "misses": info.misses,
+            "size": info.currsize,
+            "max_size": info.maxsize,
+            "hit_rate": info.hits / lookups if lookups else 0.0,
+        }
+
+
 class TextOperations:
 
 
     # to increase accuracy in tokenization I used the amharic abbrevations dataset avaliable at the below link, it converts the abbreviation to its full form
     # https://raw.githubusercontent.com/geezorg/data/refs/heads/master/amharic/abbreviations/Amharic-Abbreviations.xlsx
+    # the file is resolved relative to this module and only read the first time it is needed
 
-    with open('c:\\Users\\Edeal\\Documents\\Felagi\\isr_system\\abbrevations.json', 'r', encoding='utf-8') as f:
-            ABBREVATIONS = json.load(f)
+    RESOURCE_DIR = os.path.dirname(os.path.abspath(__file__))
+    ABBREVATIONS_PATH = os.path.join(RESOURCE_DIR, "abbrevations.json")
+    _abbrevations = None
+    _abbreviation_expander = None
 
     interchangeable_letters = {
     'ሐ': 'ሀ', 'ሑ': 'ሁ', 'ሒ': 'ሂ', 'ሓ': 'ሃ', 'ሔ': 'ሄ', 'ሕ': 'ህ', 'ሖ': 'ሆ',
@@ -31,36 +135,56 @@ class TextOperations:
     'ፀ': 'ጸ', 'ፁ': 'ጹ', 'ፂ': 'ጺ', 'ፃ': 'ጻ', 'ፄ': 'ጼ', 'ፅ': 'ጽ', 'ፆ': 'ጾ',
     }
 
+    def load_abbreviations():
+        if TextOperations._abbrevations is None:
+            with open(TextOperations.ABBREVATIONS_PATH, 'r', encoding='utf-8') as f:
+                TextOperations._abbrevations = json.load(f)
+        return TextOperations._abbrevations
+
     def replace_abbreviation(word):
-        return TextOperations.ABBREVATIONS.get(word, word)
-            # normalize each token using interchangeable_letters
-    
+        return TextOperations.load_abbreviations().get(word, word)
+
+    def abbreviation_expander():
+        if TextOperations._abbreviation_expander is None:
+            TextOperations._abbreviation_expander = AbbreviationExpander.load(
+                TextOperations.ABBREVATIONS_PATH, TextOperations.LETTER_TABLE
+            )
+        return TextOperations._abbreviation_expander
+
+    # abbreviations are expanded on the raw text, before punctuation like / is touched
+    def expand_abbreviations(text):
+        return TextOperations.abbreviation_expander().expand(text)
+
+    # the whole cleaning step is a single str.translate call: english and amharic digits
+    # are deleted, english (except for / and _, which the token pattern keeps) and amharic
+    # punctuation become a word break, so words joined by punctuation still come out as
+    # separate tokens, and interchangeable letters are folded to their canonical form.
+    # the table and the token pattern are built once with the class.
+    DIGITS = "0123456789" + "".join(chr(c) for c in range(ord('፩'), ord('፻') + 1))
+    PUNCTUATION = "!\"#$%&'()*+,-.:;<=>?@[\\]^`{|}~"
+    AMHARIC_PUNCTUATION = "፡፣፤፥፦፨"
+    LETTER_TABLE = str.maketrans(interchangeable_letters)
+    CLEAN_TABLE = dict.fromkeys(map(ord, DIGITS))
+    CLEAN_TABLE.update(dict.fromkeys(map(ord, PUNCTUATION + AMHARIC_PUNCTUATION), " "))
+    CLEAN_TABLE.update(LETTER_TABLE)
+
+    #selecting amharic and english words
+    TOKEN_PATTERN = re.compile(r'\b[\u1200-\u137F\w]+\b')
+
     def interchange_letters(token):
-        return ''.join(TextOperations.interchangeable_letters.get(char, char) for char in token)
+        return token.translate(TextOperations.LETTER_TABLE)
 
     def clean_and_tokenize(text):
+        text = TextOperations.expand_abbreviations(text)
+        return TextOperations.TOKEN_PATTERN.findall(text.translate(TextOperations.CLEAN_TABLE))
 
-        #using regex to remove amharic and english numbers in cases where they occur
-        text = re.sub(r'[0-9፩-፻]', '', text)
-        # removing amharic and english punctuation except for /
-
-        text = re.sub(r'[!"#$%&\'()*+,\-.:;<=>?@[\\]^_`{|}~፡፣፤፥፦፨]', '', text)
-
-        #selecting amharic and english words
-
-        tokens = re.findall(r'\b[\u1200-\u137F\w]+\b', text)
-
-        # call the replace_abbreviation function for tokens containing / and replacing remaning / symbols after
-
-        tokens = [
-            TextOperations.replace_abbreviation(token).replace('/', '') if '/' in token else token
-            for token in tokens
-        ]
-
-
-        tokens = [TextOperations.interchange_letters(token) for token in tokens]
-        return tokens
-
+    # tokenizes many texts with the table and the compiled pattern bound once
+    def tokenize_batch(texts):
+        expand = TextOperations.abbreviation_expander().expand
+        table = TextOperations.CLEAN_TABLE
+        findall = TextOperations.TOKEN_PATTERN.findall
+        for text in texts:
+            yield findall(expand(text).translate(table))
 
 
     def tokenize_dataset(input_path):
@@ -85,16 +209,51 @@ class TextOperations:
                 entry["url"] = ""
         return data
 
+    # the stopwords are read from a file next to this one, so loading them never touches the
+    # network; it is read once per process and lines starting with # are comments. the bundled
+    # file is only a hand-picked seed list, not the uhhlt/amharic-stopwords dataset: indexes
+    # built against the dataset drop more words than the queries do, so a warning is given
+    # until --refresh-stopwords replaces the file with a snapshot of the dataset. the django
+    # app points STOPWORDS_PATH at this file and names its own refresh command.
+    STOPWORDS_PATH = os.path.join(RESOURCE_DIR, "amharic_stopwords.txt")
+    REFRESH_STOPWORDS_COMMAND = "python isr_system/text_operations.py --refresh-stopwords"
+    SEED_STOPWORDS_HEADER = "# seed list"
+    DATASET_STOPWORDS_HEADER = "# snapshot of the uhhlt/amharic-stopwords dataset"
+    _stopwords = None
+
     def load_amharic_stopwords():
-        # loading amharic stopwords from a hugging face dataset
+        if TextOperations._stopwords is None:
+            with open(TextOperations.STOPWORDS_PATH, "r", encoding="utf-8") as f:
+                lines = [line.strip() for line in f]
+            if lines and lines[0].startswith(TextOperations.SEED_STOPWORDS_HEADER):
+                warnings.warn(
+                    f"{TextOperations.STOPWORDS_PATH} is a seed list, not the uhhlt/amharic-stopwords dataset; "
+                    f"run {TextOperations.REFRESH_STOPWORDS_COMMAND} to match indexes built against the dataset",
+                    stacklevel=2,
+                )
+            TextOperations._stopwords = frozenset(line for line in lines if line and not line.startswith("#"))
+        return TextOperations._stopwords
+
+    # replaces the stopword file with a snapshot of the hugging face dataset, only run on demand
+    def refresh_amharic_stopwords(path=None):
+        from datasets import load_dataset
+
+        path = path or TextOperations.STOPWORDS_PATH
         dataset = load_dataset("uhhlt/amharic-stopwords")
         stopwords = []
+        seen = set()
         for row in dataset["train"]:
-            stopwords.append(row['text'])
-        # Write stopwords to a txt file each time the function is called
-        with open("output/amharic_stopwords.txt", "w", encoding="utf-8") as f:
+            word = row['text'].strip()
+            if word and word not in seen:
+                seen.add(word)
+                stopwords.append(word)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(f"{TextOperations.DATASET_STOPWORDS_HEADER}\n")
             for word in stopwords:
                 f.write(f"{word}\n")
+        os.replace(tmp_path, path)
+        TextOperations._stopwords = None
         return stopwords
 
 
@@ -105,60 +264,23 @@ class TextOperations:
         return data
 
 
+    STEMMER = AmharicStemmer()
+
     def stemmer(word):
-        amharic_suffixes = [
-            'ኝ', 'ህ', 'ሽ', 'ት', 'ች', 'ን', 'ችሁ', 'ቸው', 
-            'ልኝ', 'ብኝ', 'ልህ', 'ብህ', 'ልሽ', 'ብሽ',
-            'ዬ', 'ሀ', 'ሺ', 'ዋ', 'ናችን', 'ናችሁ', 'ናቸው', 
-            'ኦች', 'ዮች', 'ዎች', 'አን', 'አት',            
-            'ኡ', 'ው', 'ዋ', 'እትዋ', 'እጥታ',       
-            'ን', "ዬ"                         
-            'ና',                            
-            'ነት', 'ነስ', 'አይት', 'ኦች', 'አው',          
-        ]
-        amharic_prefixes = [
-            'እ',
-            'ት',
-            'ይ', 
-            'እና', 
-            'አይ',  
-            'አል', 
-            'ሰ',    
-            'ራ', 
-            'አስ',  
-            'ታን', 
-            'አን',
-            "የ", 
-            "እነ",  
-            "ለ",
-            "በ",
-            "ከ",
-        
-        ]
-        prefix_removed = word
-        longest_prefix = ''
-        for prefix in amharic_prefixes:
-            if word.startswith(prefix) and len(prefix) > len(longest_prefix):
-                longest_prefix = prefix
-        if longest_prefix:
-            prefix_removed = word[len(longest_prefix):]
-
-        stemmed = prefix_removed
-        longest_suffix = ''
-        for suffix in amharic_suffixes:
-            if prefix_removed.endswith(suffix) and len(suffix) > len(longest_suffix):
-                longest_suffix = suffix
-        if longest_suffix:
-            stemmed = prefix_removed[:-len(longest_suffix)]
-
-        return stemmed
+        return TextOperations.STEMMER.stem(word)
 
+    # each distinct token in the corpus is stemmed once and the results are mapped back
     def stem_words_from_dataset(data):
+        vocabulary = set()
+        for entry in data:
+            vocabulary.update(entry["title"])
+            vocabulary.update(entry["content"])
+        stems = TextOperations.STEMMER.stem_vocabulary(vocabulary)
         for entry in data:
-            entry["title"] = [TextOperations.stemmer(token) for token in entry["title"]]
-            entry["content"] = [TextOperations.stemmer(token) for token in entry["content"]]
+            entry["title"] = [stems[token] for token in entry["title"]]
+            entry["content"] = [stems[token] for token in entry["content"]]
         return data
-    
+
 
     # calculating cf and df for each word
     def word_frequencies(data):
@@ -204,6 +326,10 @@ class TextOperations:
             for rank, term in enumerate(sorted_terms)
         ]
         if plot:
+            import matplotlib.pyplot as plt
+            import numpy as np
+            from scipy.stats import linregress
+
             # plotting zipf's law 
             ranks = np.array([item["rank"] for item in ranked_words])
             frequencies = np.array([item["frequency"] for item in ranked_words])
@@ -250,4 +376,177 @@ class TextOperations:
         print(f"- upper Cutoff (top {int(upper_percent*100)}% unique words): removed {len(upper_cutoff_words)} words")
         print(f"- lower Cutoff (words with df < {lower_cutoff}): removed {len(lower_cutoff_words)} words")
         print(f"- final index terms: {len(index_terms)} words")
-        return {"index_terms": index_terms, "stats": stats}
\ No newline at end of file
+        return {"index_terms": index_terms, "stats": stats}
+
+    # streaming build. every article goes through tokenize -> normalize -> stopword -> stem
+    # -> count in one pass, so memory is bounded by one article plus the cf/df counters.
+    # only the requested artifacts are written, as compact jsonl.
+    ARTIFACTS = {
+        "tokenized": "dataset_tokenized.jsonl",
+        "normalized": "dataset_normalized.jsonl",
+        "no_stopwords": "dataset_no_stopwords.jsonl",
+        "stemmed": "dataset_stemmed.jsonl",
+        "term_frequencies": "term_frequencies.jsonl",
+        "word_frequencies": "word_frequencies.json",
+        "ranked_words": "ranked_words.jsonl",
+        "luhn": "luhn_cutoffs_results.json",
+        "positions": "positions.bin",
+    }
+    STAGE_ARTIFACTS = ("tokenized", "normalized", "no_stopwords", "stemmed")
+    DEFAULT_ARTIFACTS = ("term_frequencies", "word_frequencies", "luhn")
+
+    # emit(stage, url, title, content) is called after each stage when given
+    def analyze_entry(entry, stopwords, emit=None):
+        url = entry.get("url", "")
+        title, content = TextOperations.tokenize_batch((entry.get("title", ""), entry.get("content", "")))
+        if emit:
+            emit("tokenized", url, title, content)
+
+        title = [token.lower() for token in title]
+        content = [token.lower() for token in content]
+        if emit:
+            emit("normalized", url, title, content)
+
+        title = [token for token in title if token not in stopwords]
+        content = [token for token in content if token not in stopwords]
+        if emit:
+            emit("no_stopwords", url, title, content)
+
+        stem = TextOperations.STEMMER.stem
+        title = [stem(token) for token in title]
+        content = [stem(token) for token in content]
+        if emit:
+            emit("stemmed", url, title, content)
+        return url, title, content
+
+    # runs a shard of articles through the analyzer. returns the requested stage records and
+    # the (url, terms, tfs) row of every article in input order, plus the shard's cf and df counters.
+    # with "positions" among the stages the staged records also hold the analyzed (title, content).
+    # this is the unit of work for both the serial and the multi-process build.
+    def analyze_shard(job):
+        entries, stages = job
+        stopwords = TextOperations.load_amharic_stopwords()
+        cf_counter = Counter()
+        df_counter = Counter()
+        rows = []
+        for entry in entries:
+            staged = {}
+
+            def emit(stage, url, title, content):
+                if stage in stages:
+                    staged[stage] = {"url": url, "title": title, "content": content}
+
+            url, title, content = TextOperations.analyze_entry(entry, stopwords, emit if stages else None)
+            if "positions" in stages:
+                staged["positions"] = (title, content)
+            tf_counter = Counter(title)
+            tf_counter.update(content)
+            cf_counter.update(tf_counter)
+            df_counter.update(tf_counter.keys())
+            rows.append((staged, (url, list(tf_counter), list(tf_counter.values()))))
+        return rows, cf_counter, df_counter
+
+    def iter_shards(entries, shard_size):
+        shard = []
+        for entry in entries:
+            shard.append(entry)
+            if len(shard) >= shard_size:
+                yield shard
+                shard = []
+        if shard:
+            yield shard
+
+    # analyzed shards in input order. with workers > 1 the shards are spread over a process
+    # pool, with at most two shards per worker in flight so the corpus is never queued whole
+    def iter_analyzed_shards(input_path, stages, workers=1, shard_size=256):
+        shards = TextOperations.iter_shards(iter_records(input_path), shard_size)
+        if workers <= 1:
+            for shard in shards:
+                yield TextOperations.analyze_shard((shard, stages))
+            return
+
+        with multiprocessing.Pool(workers) as pool:
+            pending = deque()
+            for shard in shards:
+                pending.append(pool.apply_async(TextOperations.analyze_shard, ((shard, stages),)))
+                if len(pending) >= workers * 2:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+
+    def stream_pipeline(input_path, output_dir="outputs", artifacts=DEFAULT_ARTIFACTS, plot=False,
+                        workers=1, shard_size=256):
+        stages = tuple(name for name in TextOperations.STAGE_ARTIFACTS if name in artifacts)
+        stage_writers = {
+            name: RecordWriter(os.path.join(output_dir, TextOperations.ARTIFACTS[name]))
+            for name in stages
+        }
+        positions = None
+        if "positions" in artifacts:
+            from .positional_index import PositionalIndexWriter
+            positions = PositionalIndexWriter()
+            stages += ("positions",)
+        tf_writer = None
+        if "term_frequencies" in artifacts:
+            tf_writer = RecordWriter(os.path.join(output_dir, TextOperations.ARTIFACTS["term_frequencies"]))
+
+        # shards come back in input order and counters are merged in that order, so the
+        # first-seen order of terms (and every artifact) is the same as a serial run.
+        # term ids are handed out in that same order and cf/df live in lists indexed by id.
+        vocabulary = Vocabulary()
+        term_ids = vocabulary.term_ids
+        cf = []
+        df = []
+        documents = 0
+        try:
+            for rows, shard_cf, shard_df in TextOperations.iter_analyzed_shards(
+                input_path, stages, workers, shard_size
+            ):
+                for word, count in shard_cf.items():
+                    term_id = vocabulary.add_term(word)
+                    if term_id == len(cf):
+                        cf.append(0)
+                        df.append(0)
+                    cf[term_id] += count
+                    df[term_id] += shard_df[word]
+                for staged, (url, words, tfs) in rows:
+                    analyzed = staged.pop("positions", None)
+                    for stage, record in staged.items():
+                        stage_writers[stage].write(record)
+                    # like the index, only the first occurrence of a repeated url gets positions
+                    if positions is not None and vocabulary.doc_id(url) is None:
+                        title, content = analyzed
+                        positions.add(vocabulary.num_docs, [term_ids[word] for word in title],
+                                      [term_ids[word] for word in content])
+                    doc_id = vocabulary.add_doc(url)
+                    if tf_writer is not None:
+                        tf_writer.write({"doc": doc_id, "terms": [term_ids[word] for word in words], "tf": tfs})
+                documents += len(rows)
+        finally:
+            for writer in stage_writers.values():
+                writer.close()
+            if tf_writer is not None:
+                tf_writer.close()
+
+        vocabulary.save(os.path.join(output_dir, Vocabulary.FILE_NAME))
+        if positions is not None:
+            positions.save(os.path.join(output_dir, TextOperations.ARTIFACTS["positions"]), vocabulary.num_terms)
+        terms = [
+            {"term": term_id, "cf": cf[term_id], "df": df[term_id]}
+            for term_id in range(vocabulary.num_terms)
+        ]
+        if "word_frequencies" in artifacts:
+            with open(os.path.join(output_dir, TextOperations.ARTIFACTS["word_frequencies"]), "w", encoding="utf-8") as f:
+                json.dump({"cf": cf, "df": df}, f, separators=(",", ":"))
+        if "ranked_words" in artifacts or plot:
+            ranked_words = TextOperations.rank_frequencies(terms, plot=plot)
+            for item in ranked_words:
+                item["word"] = vocabulary.terms[item["word"]]
+            if "ranked_words" in artifacts:
+                write_records(os.path.join(output_dir, TextOperations.ARTIFACTS["ranked_words"]), ranked_words)
+        if "luhn" in artifacts:
+            luhn_results = TextOperations.luhn_index_terms(terms)
+            with open(os.path.join(output_dir, TextOperations.ARTIFACTS["luhn"]), "w", encoding="utf-8") as f:
+                json.dump(luhn_results, f, ensure_ascii=False, separators=(",", ":"))
+        print(f"processed {documents} documents, {len(terms)} unique terms")
+        return terms
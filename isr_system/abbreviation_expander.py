@@ -0,0 +1,114 @@
+import json
+
+# this module expands amharic abbreviations (ጠ/ሚ, ዓ/ም, ...) in raw text before tokenization.
+# every entry of abbrevations.json is compiled into an aho-corasick automaton so the text is
+# expanded in one left to right scan, whatever the number of entries. matches are only
+# accepted on word boundaries and overlapping matches resolve to the leftmost, then longest one.
+# building the automaton takes a few milliseconds, so every process builds it on first use
+# and nothing is written to disk.
+
+
+class AbbreviationExpander:
+
+    def __init__(self, abbreviations, letter_table=None):
+        self.patterns = []
+        seen = set()
+        for short, full in abbreviations.items():
+            forms = [short]
+            # the spelling of the text is only normalized after expansion, so the folded
+            # spelling of every abbreviation is accepted as well
+            if letter_table is not None:
+                forms.append(short.translate(letter_table))
+            for form in forms:
+                if form and form not in seen:
+                    seen.add(form)
+                    self.patterns.append((form, full))
+        self._build()
+
+    def _build(self):
+        goto = [{}]
+        output = [-1]
+        for pattern_id, (form, _) in enumerate(self.patterns):
+            state = 0
+            for char in form:
+                next_state = goto[state].get(char)
+                if next_state is None:
+                    next_state = len(goto)
+                    goto[state][char] = next_state
+                    goto.append({})
+                    output.append(-1)
+                state = next_state
+            output[state] = pattern_id
+
+        # breadth first pass for the failure links, dict_link points to the nearest state on
+        # the failure chain that ends a pattern
+        fail = [0] * len(goto)
+        dict_link = [-1] * len(goto)
+        queue = list(goto[0].values())
+        for state in queue:
+            for char, next_state in goto[state].items():
+                queue.append(next_state)
+                f = fail[state]
+                while f and char not in goto[f]:
+                    f = fail[f]
+                fail[next_state] = goto[f].get(char, 0)
+                target = fail[next_state]
+                dict_link[next_state] = target if output[target] != -1 else dict_link[target]
+
+        self.goto = goto
+        self.fail = fail
+        self.output = output
+        self.dict_link = dict_link
+        # characters every pattern contains, a text without them can be skipped entirely
+        required = None
+        for form, _ in self.patterns:
+            required = set(form) if required is None else required & set(form)
+        self.required_chars = frozenset(required or ())
+
+    def is_word_char(char):
+        return char.isalnum() or char in "/_"
+
+    def expand(self, text):
+        if self.required_chars and not any(char in text for char in self.required_chars):
+            return text
+
+        goto, fail, output, dict_link = self.goto, self.fail, self.output, self.dict_link
+        patterns = self.patterns
+        is_word_char = AbbreviationExpander.is_word_char
+        length = len(text)
+        matches = []
+        state = 0
+        for end, char in enumerate(text, 1):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            candidate = state if output[state] != -1 else dict_link[state]
+            if candidate == -1 or (end < length and is_word_char(text[end])):
+                continue
+            # longest pattern ending here that also starts on a word boundary
+            while candidate != -1:
+                form, full = patterns[output[candidate]]
+                start = end - len(form)
+                if start == 0 or not is_word_char(text[start - 1]):
+                    matches.append((start, end, full))
+                    break
+                candidate = dict_link[candidate]
+
+        if not matches:
+            return text
+        matches.sort(key=lambda match: (match[0], match[0] - match[1]))
+        pieces = []
+        position = 0
+        for start, end, full in matches:
+            if start < position:
+                continue
+            pieces.append(text[position:start])
+            pieces.append(full)
+            position = end
+        pieces.append(text[position:])
+        return "".join(pieces)
+
+    @classmethod
+    def load(cls, abbreviations_path, letter_table=None):
+        with open(abbreviations_path, "r", encoding="utf-8") as f:
+            return cls(json.load(f), letter_table)
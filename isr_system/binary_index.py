@@ -0,0 +1,332 @@
+import mmap
+import os
+import struct
+import numpy as np
+
+# compact binary, memory-mapped inverted index.
+#
+# layout (little endian, sections aligned to 8 bytes):
+#   header      magic, version, counts, the offset of every section and flags
+#   strings     utf-8 term strings and document urls
+#   terms       one fixed size entry per vocabulary term, sorted by the utf-8 bytes of the term,
+#               with the term's max score (largest dequantized weight / doc norm)
+#   term ids    entry number for every term id, so the vocabulary ids keep working
+#   docs        url and norm of every document, indexed by doc id. when the doc ids follow
+#               the url order (FLAG_DOCS_SORTED) urls can be looked up by binary search
+#   postings    per term: doc ids as delta + varint bytes, then one uint16 weight per posting.
+#               lists longer than SKIP_INTERVAL are followed by a skip table (FLAG_SKIPS): the
+#               last doc id and the byte offset of every block of SKIP_INTERVAL doc ids, so a
+#               lookup of a few documents only decodes the blocks they fall in
+#
+# weights are quantized per term: weight = q * scale, with scale = max weight / 65535.
+# the file is opened with mmap, so processes share it through the page cache and posting
+# lists are only decoded when a query asks for them.
+
+MAGIC = b"FLGIDX01"
+VERSION = 2
+HEADER = struct.Struct("<8sIIII6Q")
+TERM_DTYPE = np.dtype([
+    ("name_offset", "<u8"),
+    ("name_length", "<u4"),
+    ("term_id", "<u4"),
+    ("df", "<u4"),
+    ("count", "<u4"),
+    ("postings_offset", "<u8"),
+    ("doc_bytes", "<u4"),
+    ("scale", "<f8"),
+    ("max_score", "<f8"),
+])
+DOC_DTYPE = np.dtype([
+    ("url_offset", "<u8"),
+    ("url_length", "<u4"),
+    ("norm", "<f8"),
+])
+WEIGHT_LEVELS = 65535
+FLAG_DOCS_SORTED = 1
+FLAG_SKIPS = 2
+SKIP_INTERVAL = 32
+
+
+def varint_lengths(values):
+    lengths = np.ones(len(values), dtype=np.int64)
+    for shift in (7, 14, 21, 28, 35, 42, 49, 56):
+        lengths += values >= (1 << shift)
+    return lengths
+
+
+def encode_varints(values):
+    values = np.asarray(values, dtype=np.uint64)
+    if not len(values):
+        return b""
+    lengths = varint_lengths(values)
+    starts = np.cumsum(lengths) - lengths
+    out = np.empty(int(lengths.sum()), dtype=np.uint8)
+    for k in range(int(lengths.max())):
+        mask = lengths > k
+        chunk = (values[mask] >> np.uint64(7 * k)) & np.uint64(0x7F)
+        more = (lengths[mask] > k + 1).astype(np.uint64) << np.uint64(7)
+        out[starts[mask] + k] = (chunk | more).astype(np.uint8)
+    return out.tobytes()
+
+
+def decode_varints(buffer):
+    data = np.frombuffer(buffer, dtype=np.uint8)
+    if not len(data):
+        return np.zeros(0, dtype=np.int64)
+    # a byte below 0x80 is the last byte of a value
+    ends = np.flatnonzero(data < 0x80)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    group = np.repeat(np.arange(len(ends)), ends - starts + 1)
+    position = np.arange(len(data)) - starts[group]
+    parts = (data & 0x7F).astype(np.int64) << (7 * position)
+    return np.add.reduceat(parts, starts)
+
+
+def align(f):
+    padding = -f.tell() % 8
+    if padding:
+        f.write(b"\0" * padding)
+    return f.tell()
+
+
+class BinaryIndexWriter:
+
+    # index is the {"total_docs", "doc_norms", "postings"} dict of InvertedIndex, df the global
+    # document frequency of every vocabulary term (word_frequencies["df"])
+    def write(path, index, vocabulary, df):
+        num_terms = vocabulary.num_terms
+        num_docs = vocabulary.num_docs
+        postings = index["postings"]
+        doc_norms = np.zeros(num_docs, dtype=np.float64)
+        stored_norms = index.get("doc_norms", [])[:num_docs]
+        doc_norms[:len(stored_norms)] = stored_norms
+
+        encoded_terms = [term.encode("utf-8") for term in vocabulary.terms]
+        order = sorted(range(num_terms), key=encoded_terms.__getitem__)
+        encoded_urls = [url.encode("utf-8") for url in vocabulary.docs]
+        flags = FLAG_SKIPS
+        if all(a < b for a, b in zip(encoded_urls, encoded_urls[1:])):
+            flags |= FLAG_DOCS_SORTED
+
+        terms = np.zeros(num_terms, dtype=TERM_DTYPE)
+        docs = np.zeros(num_docs, dtype=DOC_DTYPE)
+        entry_of_term = np.zeros(num_terms, dtype="<u4")
+
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(b"\0" * HEADER.size)
+
+            strings_offset = align(f)
+            for entry, term_id in enumerate(order):
+                terms[entry]["name_offset"] = f.tell()
+                terms[entry]["name_length"] = len(encoded_terms[term_id])
+                f.write(encoded_terms[term_id])
+            for doc_id, url in enumerate(encoded_urls):
+                docs[doc_id]["url_offset"] = f.tell()
+                docs[doc_id]["url_length"] = len(url)
+                f.write(url)
+
+            postings_offset = align(f)
+            for entry, term_id in enumerate(order):
+                entry_of_term[term_id] = entry
+                terms[entry]["term_id"] = term_id
+                terms[entry]["df"] = df[term_id] if term_id < len(df) else 0
+                doc_ids, weights = postings[term_id] if term_id < len(postings) else ([], [])
+                if not len(doc_ids):
+                    continue
+                doc_ids = np.asarray(doc_ids, dtype=np.int64)
+                weights = np.asarray(weights, dtype=np.float64)
+                deltas = np.diff(doc_ids, prepend=0)
+                doc_bytes = encode_varints(deltas)
+                max_weight = float(weights.max())
+                scale = max_weight / WEIGHT_LEVELS if max_weight > 0 else 1.0
+                quantized = np.rint(weights / scale).astype("<u2")
+                # the bound has to hold for the weights a reader gets back, not the exact ones
+                norms = doc_norms[doc_ids]
+                impact = np.divide(quantized * scale, norms, out=np.zeros(len(norms)), where=norms > 0)
+                terms[entry]["max_score"] = impact.max()
+                terms[entry]["count"] = len(doc_ids)
+                terms[entry]["postings_offset"] = f.tell()
+                terms[entry]["doc_bytes"] = len(doc_bytes)
+                terms[entry]["scale"] = scale
+                f.write(doc_bytes)
+                f.write(quantized.tobytes())
+                if len(doc_ids) > SKIP_INTERVAL:
+                    ends = np.cumsum(varint_lengths(deltas.astype(np.uint64)))
+                    block_ends = np.arange(SKIP_INTERVAL - 1, len(doc_ids) + SKIP_INTERVAL - 1, SKIP_INTERVAL)
+                    f.write(doc_ids[np.minimum(block_ends, len(doc_ids) - 1)].astype("<u4").tobytes())
+                    f.write(np.concatenate(([0], ends[SKIP_INTERVAL - 1:-1:SKIP_INTERVAL])).astype("<u4").tobytes())
+
+            docs["norm"] = doc_norms
+
+            terms_offset = align(f)
+            f.write(terms.tobytes())
+            ids_offset = align(f)
+            f.write(entry_of_term.tobytes())
+            docs_offset = align(f)
+            f.write(docs.tobytes())
+
+            f.seek(0)
+            f.write(HEADER.pack(
+                MAGIC, VERSION, num_terms, num_docs, index["total_docs"],
+                strings_offset, terms_offset, ids_offset, docs_offset, postings_offset, flags,
+            ))
+        # replacing the file keeps readers that still map the old one working
+        os.replace(tmp_path, path)
+
+
+class BinaryIndex:
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, self.num_terms, self.num_docs, self.total_docs,
+         _, terms_offset, ids_offset, docs_offset, _, self.flags) = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a version {VERSION} binary index")
+        self.terms = np.frombuffer(self._mmap, dtype=TERM_DTYPE, count=self.num_terms, offset=terms_offset)
+        self.entry_of_term = np.frombuffer(self._mmap, dtype="<u4", count=self.num_terms, offset=ids_offset)
+        self.docs = np.frombuffer(self._mmap, dtype=DOC_DTYPE, count=self.num_docs, offset=docs_offset)
+        self.doc_norms = self.docs["norm"]
+
+    def is_binary_index(path):
+        try:
+            with open(path, "rb") as f:
+                return f.read(len(MAGIC)) == MAGIC
+        except OSError:
+            return False
+
+    def term_name(self, entry):
+        offset = int(self.terms[entry]["name_offset"])
+        return self._mmap[offset:offset + int(self.terms[entry]["name_length"])].decode("utf-8")
+
+    def url(self, doc_id):
+        return self._url_bytes(doc_id).decode("utf-8")
+
+    def _url_bytes(self, doc_id):
+        offset = int(self.docs[doc_id]["url_offset"])
+        return self._mmap[offset:offset + int(self.docs[doc_id]["url_length"])]
+
+    # doc id of a url or None, a binary search when the doc table is in url order
+    def find_doc(self, url):
+        key = url.encode("utf-8")
+        if not self.flags & FLAG_DOCS_SORTED:
+            for doc_id in range(self.num_docs):
+                if self._url_bytes(doc_id) == key:
+                    return doc_id
+            return None
+        lo, hi = 0, self.num_docs
+        while lo < hi:
+            mid = (lo + hi) // 2
+            name = self._url_bytes(mid)
+            if name < key:
+                lo = mid + 1
+            elif name > key:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    # binary search of the sorted term dictionary, returns the entry number or None
+    def lookup(self, term):
+        key = term.encode("utf-8")
+        lo, hi = 0, self.num_terms
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset = int(self.terms[mid]["name_offset"])
+            name = self._mmap[offset:offset + int(self.terms[mid]["name_length"])]
+            if name < key:
+                lo = mid + 1
+            elif name > key:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    def entry_for_id(self, term_id):
+        if 0 <= term_id < self.num_terms:
+            return int(self.entry_of_term[term_id])
+        return None
+
+    def df(self, entry):
+        return int(self.terms[entry]["df"])
+
+    def max_score(self, entry):
+        return float(self.terms[entry]["max_score"])
+
+    # decodes the posting list of one term into (doc ids, weights) arrays
+    def postings(self, entry):
+        record = self.terms[entry]
+        count = int(record["count"])
+        if not count:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+        offset = int(record["postings_offset"])
+        doc_bytes = int(record["doc_bytes"])
+        doc_ids = np.cumsum(decode_varints(self._mmap[offset:offset + doc_bytes]))
+        quantized = np.frombuffer(self._mmap, dtype="<u2", count=count, offset=offset + doc_bytes)
+        return doc_ids, quantized * float(record["scale"])
+
+    # (last doc id, byte offset) of every block of a posting list, or None without a skip table
+    def skips(self, entry):
+        record = self.terms[entry]
+        count = int(record["count"])
+        if not self.flags & FLAG_SKIPS or count <= SKIP_INTERVAL:
+            return None
+        blocks = -(-count // SKIP_INTERVAL)
+        offset = int(record["postings_offset"]) + int(record["doc_bytes"]) + 2 * count
+        lasts = np.frombuffer(self._mmap, dtype="<u4", count=blocks, offset=offset)
+        starts = np.frombuffer(self._mmap, dtype="<u4", count=blocks, offset=offset + 4 * blocks)
+        return lasts, starts
+
+    # the postings of one term restricted to docs (sorted doc ids). with a skip table only the
+    # blocks that can hold one of the docs are decoded, which is what makes a selective
+    # conjunction cheaper than reading the lists in full
+    def postings_for(self, entry, docs):
+        docs = np.asarray(docs, dtype=np.int64)
+        skips = self.skips(entry)
+        blocks = None
+        if skips is not None and len(docs):
+            lasts, starts = skips
+            blocks = np.unique(np.searchsorted(lasts, docs))
+            blocks = blocks[blocks < len(lasts)]
+            # touching most blocks anyway, one vectorized decode of the whole list is faster
+            if 2 * len(blocks) > len(lasts):
+                blocks = None
+        if blocks is None:
+            doc_ids, weights = self.postings(entry)
+            keep = np.isin(doc_ids, docs, assume_unique=True)
+            return doc_ids[keep], weights[keep]
+
+        # varints are self-delimiting, so the bytes of the chosen blocks are gathered into one
+        # buffer and decoded together; each block's deltas continue from the last doc id of
+        # the block before it
+        record = self.terms[entry]
+        offset = int(record["postings_offset"])
+        doc_bytes = int(record["doc_bytes"])
+        count = int(record["count"])
+        lasts, starts = skips
+        byte_starts = starts[blocks].astype(np.int64)
+        byte_ends = np.append(starts, doc_bytes)[blocks + 1].astype(np.int64)
+        lengths = byte_ends - byte_starts
+        gather = np.repeat(byte_starts - (np.cumsum(lengths) - lengths), lengths) + np.arange(int(lengths.sum()))
+        data = np.frombuffer(self._mmap, dtype=np.uint8, count=doc_bytes, offset=offset)
+        deltas = decode_varints(data[gather])
+        sizes = np.minimum(SKIP_INTERVAL, count - blocks * SKIP_INTERVAL)
+        first = np.cumsum(sizes) - sizes
+        bases = np.where(blocks > 0, lasts[np.maximum(blocks - 1, 0)].astype(np.int64), 0)
+        running = np.cumsum(deltas)
+        before = np.where(first > 0, running[np.maximum(first - 1, 0)], 0)
+        doc_ids = running + np.repeat(bases - before, sizes)
+        indices = np.repeat(blocks * SKIP_INTERVAL - first, sizes) + np.arange(len(doc_ids))
+        keep = np.isin(doc_ids, docs, assume_unique=True)
+        quantized = np.frombuffer(self._mmap, dtype="<u2", count=count, offset=offset + doc_bytes)
+        return doc_ids[keep], quantized[indices[keep]] * float(record["scale"])
+
+    # which of docs (sorted doc ids) are in the posting list of a term
+    def contains(self, entry, docs):
+        return np.isin(docs, self.postings_for(entry, docs)[0], assume_unique=True)
+
+    def close(self):
+        self.terms = self.entry_of_term = self.docs = self.doc_norms = None
+        self._mmap.close()
@@ -0,0 +1,185 @@
+import heapq
+import mmap
+import os
+import struct
+from array import array
+from bisect import bisect_left
+import numpy as np
+from binary_index import align, decode_varints, encode_varints
+
+# optional positional index for phrase and proximity queries, written by the text pipeline
+# (artifact "positions") next to the other outputs and keyed by the same term and doc ids.
+#
+# positions count the analyzed tokens of a document, after stopword removal and stemming, so
+# a query phrase matches when its analyzed tokens are consecutive. the content starts one
+# position after the end of the title, so no phrase runs from the title into the content.
+#
+# layout: header, then one block per term of varints
+#   [number of docs] [doc id gaps] [positions per doc] [position gaps, restarting at every doc]
+# and a table with the offset and length of every term's block. the file is memory-mapped
+# and a block is only decoded when a phrase needs the term.
+
+MAGIC = b"FLGPOS01"
+VERSION = 1
+HEADER = struct.Struct("<8sIIQ")
+TABLE_DTYPE = np.dtype([("offset", "<u8"), ("length", "<u4")])
+
+
+class PositionalIndexWriter:
+
+    def __init__(self):
+        self.docs = []
+        self.counts = []
+        self.gaps = []
+
+    def _term(self, term_id):
+        while term_id >= len(self.docs):
+            self.docs.append(array("I"))
+            self.counts.append(array("I"))
+            self.gaps.append(array("I"))
+
+    # title and content are the term ids of the analyzed tokens, in order
+    def add(self, doc_id, title, content):
+        positions = {}
+        for position, term_id in enumerate(title):
+            positions.setdefault(term_id, []).append(position)
+        for position, term_id in enumerate(content, len(title) + 1):
+            positions.setdefault(term_id, []).append(position)
+        for term_id, term_positions in positions.items():
+            self._term(term_id)
+            self.docs[term_id].append(doc_id)
+            self.counts[term_id].append(len(term_positions))
+            last = 0
+            for position in term_positions:
+                self.gaps[term_id].append(position - last)
+                last = position
+
+    def save(self, path, num_terms=0):
+        self._term(num_terms - 1)
+        table = np.zeros(len(self.docs), dtype=TABLE_DTYPE)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(b"\0" * HEADER.size)
+            for term_id, docs in enumerate(self.docs):
+                if not docs:
+                    continue
+                doc_ids = np.frombuffer(docs, dtype=np.uint32).astype(np.int64)
+                block = encode_varints(np.concatenate((
+                    [len(doc_ids)],
+                    np.diff(doc_ids, prepend=0),
+                    np.frombuffer(self.counts[term_id], dtype=np.uint32),
+                    np.frombuffer(self.gaps[term_id], dtype=np.uint32),
+                )))
+                table[term_id] = (f.tell(), len(block))
+                f.write(block)
+            table_offset = align(f)
+            f.write(table.tobytes())
+            f.seek(0)
+            f.write(HEADER.pack(MAGIC, VERSION, len(table), table_offset))
+        os.replace(tmp_path, path)
+
+
+class PositionalIndex:
+
+    FILE_NAME = "positions.bin"
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.num_terms, table_offset = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a version {VERSION} positional index")
+        self.table = np.frombuffer(self._mmap, dtype=TABLE_DTYPE, count=self.num_terms, offset=table_offset)
+
+    # the positional index is written next to the other artifacts of the same build
+    def path_for(artifact_path):
+        return os.path.join(os.path.dirname(os.path.abspath(artifact_path)), PositionalIndex.FILE_NAME)
+
+    # (doc ids, start of every doc's positions, positions) of a term, all arrays
+    def postings(self, term_id):
+        if term_id is None or not 0 <= term_id < self.num_terms or not self.table[term_id]["length"]:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, np.zeros(1, dtype=np.int64), empty
+        offset, length = int(self.table[term_id]["offset"]), int(self.table[term_id]["length"])
+        values = decode_varints(self._mmap[offset:offset + length])
+        n = int(values[0])
+        docs = np.cumsum(values[1:1 + n])
+        counts = values[1 + n:1 + 2 * n]
+        starts = np.concatenate(([0], np.cumsum(counts)))
+        # the gaps restart at every document: a running sum minus the sum where the doc starts
+        running = np.cumsum(values[1 + 2 * n:])
+        base = np.concatenate(([0], running[starts[1:-1] - 1]))
+        return docs, starts, running - np.repeat(base, counts)
+
+    # docs that contain the terms as a phrase or, with a slop, all of them within slop positions
+    # of each other in any order. term ids that are None (not in the vocabulary) match nothing.
+    def phrase_docs(self, term_ids, slop=None):
+        if not term_ids:
+            return np.zeros(0, dtype=np.int64)
+        lists = {term_id: self.postings(term_id) for term_id in set(term_ids)}
+        docs = PositionalIndex.intersect([lists[term_id][0] for term_id in lists])
+        matches = []
+        for doc_id in docs:
+            positions = {}
+            for term_id, (term_docs, starts, term_positions) in lists.items():
+                i = int(np.searchsorted(term_docs, doc_id))
+                positions[term_id] = term_positions[starts[i]:starts[i + 1]]
+            if slop is None:
+                found = PositionalIndex.match_phrase([positions[term_id] for term_id in term_ids])
+            else:
+                found = PositionalIndex.min_window(list(positions.values())) <= max(slop, len(lists) - 1)
+            if found:
+                matches.append(doc_id)
+        return np.asarray(matches, dtype=np.int64)
+
+    # galloping intersection of sorted doc id lists, shortest first: every doc of the running
+    # result is searched in the next list with an exponential probe from the last match, so a
+    # short list costs O(m log(n/m)) against a long one instead of a full merge
+    def intersect(lists):
+        lists = sorted(lists, key=len)
+        result = lists[0].tolist() if lists else []
+        for other in lists[1:]:
+            if not result:
+                break
+            other = other.tolist()
+            matched = []
+            lo = 0
+            for doc_id in result:
+                step = 1
+                while lo + step < len(other) and other[lo + step] < doc_id:
+                    step *= 2
+                lo = bisect_left(other, doc_id, lo, min(lo + step + 1, len(other)))
+                if lo == len(other):
+                    break
+                if other[lo] == doc_id:
+                    matched.append(doc_id)
+            result = matched
+        return np.asarray(result, dtype=np.int64)
+
+    # the first term's positions that are followed by every other term at the next offsets
+    def match_phrase(positions):
+        starts = positions[0]
+        for offset, term_positions in enumerate(positions[1:], 1):
+            starts = starts[np.isin(starts + offset, term_positions)]
+            if not len(starts):
+                return False
+        return True
+
+    # span (last - first position) of the smallest window holding every list at least once
+    def min_window(positions):
+        heap = [(int(p[0]), i, 0) for i, p in enumerate(positions)]
+        heapq.heapify(heap)
+        high = max(position for position, _, _ in heap)
+        best = high - heap[0][0]
+        while True:
+            low, i, j = heapq.heappop(heap)
+            best = min(best, high - low)
+            if j + 1 == len(positions[i]):
+                return best
+            position = int(positions[i][j + 1])
+            high = max(high, position)
+            heapq.heappush(heap, (position, i, j + 1))
+
+    def close(self):
+        self.table = None
+        self._mmap.close()
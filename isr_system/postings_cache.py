@@ -0,0 +1,119 @@
+import heapq
+import itertools
+import threading
+import time
+import numpy as np
+
+# in-process cache of decoded posting lists, bounded by the bytes of the cached arrays.
+#
+# keys carry the generation of the index they were decoded from (the file stamp of an index,
+# the generation counter of the database), so a rebuilt index never serves stale lists; the
+# old entries are simply never asked for again and age out.
+#
+# eviction is greedy dual size: an entry's priority is the clock plus the time its decode
+# took divided by its size, and the lowest priority goes first. the clock moves up to the
+# priority of every evicted entry, so lists that are not used again lose to new ones, while a
+# frequent term that is expensive to decode per byte stays. a hit renews the priority.
+
+
+class PostingsCache:
+
+    DEFAULT_BYTES = 64 * 1024 * 1024
+    # rough bytes of the key, tuple and dict slot of an entry
+    ENTRY_OVERHEAD = 200
+
+    def __init__(self, max_bytes=DEFAULT_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = {}
+        self._heap = []
+        self._clock = 0.0
+        self._order = itertools.count()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes = 0
+
+    def size_of(value):
+        return PostingsCache.ENTRY_OVERHEAD + sum(part.nbytes for part in value if isinstance(part, np.ndarray))
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            value, size, cost, _ = entry
+            self._push(key, value, size, cost)
+            return value
+
+    # value is a tuple of arrays; they are made read-only since every caller shares them
+    def put(self, key, value, cost):
+        size = PostingsCache.size_of(value)
+        if size > self.max_bytes:
+            return
+        for part in value:
+            if isinstance(part, np.ndarray):
+                part.setflags(write=False)
+        with self._lock:
+            old = self._entries.get(key)
+            if old is not None:
+                self.bytes -= old[1]
+            self._push(key, value, size, cost)
+            self.bytes += size
+            self._evict()
+
+    # the cached value, or load() with its run time as the cost
+    def get_or_load(self, key, load):
+        value = self.get(key)
+        if value is None:
+            start = time.perf_counter()
+            value = load()
+            self.put(key, value, time.perf_counter() - start)
+        return value
+
+    def _push(self, key, value, size, cost):
+        priority = self._clock + cost / size
+        order = next(self._order)
+        self._entries[key] = (value, size, cost, order)
+        heapq.heappush(self._heap, (priority, order, key))
+        # every hit leaves an outdated heap item behind, drop them once they pile up
+        if len(self._heap) > 2 * len(self._entries) + 64:
+            self._heap = [item for item in self._heap if self._entries.get(item[2], (None,) * 4)[3] == item[1]]
+            heapq.heapify(self._heap)
+
+    def _evict(self):
+        while self.bytes > self.max_bytes and self._heap:
+            priority, order, key = heapq.heappop(self._heap)
+            entry = self._entries.get(key)
+            if entry is None or entry[3] != order:
+                continue
+            del self._entries[key]
+            self.bytes -= entry[1]
+            self.evictions += 1
+            self._clock = priority
+
+    def resize(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._heap = []
+            self.bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+            }
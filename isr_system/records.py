@@ -0,0 +1,111 @@
+import json
+import os
+
+# helpers for reading and writing the pipeline artifacts.
+# artifacts are written as compact jsonl, one record per line, so every stage can stream
+# them. plain json arrays (the scraper output and older artifacts) are still readable, and
+# are decoded one element at a time instead of being parsed as a whole.
+
+
+def iter_json_array(f, chunk_size=1 << 20):
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = 0
+    started = False
+    eof = False
+    while True:
+        # skip whitespace and separators up to the next value
+        while True:
+            while position < len(buffer) and buffer[position] in " \t\r\n,":
+                position += 1
+            if position < len(buffer) or eof:
+                break
+            chunk = f.read(chunk_size)
+            buffer, position = buffer[position:] + chunk, 0
+            eof = not chunk
+        if position >= len(buffer):
+            return
+        if not started:
+            if buffer[position] != "[":
+                raise ValueError("expected a json array")
+            started = True
+            position += 1
+            continue
+        if buffer[position] == "]":
+            return
+        try:
+            value, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            chunk = f.read(chunk_size)
+            buffer, position = buffer[position:] + chunk, 0
+            eof = not chunk
+            continue
+        # a value that touches the end of the buffer may be a truncated number
+        if end == len(buffer) and not eof:
+            chunk = f.read(chunk_size)
+            buffer, position = buffer[position:] + chunk, 0
+            eof = not chunk
+            continue
+        yield value
+        position = end
+        if position > chunk_size:
+            buffer, position = buffer[position:], 0
+
+
+def is_jsonl(path):
+    return path.endswith(".jsonl")
+
+
+def iter_records(path):
+    with open(path, "r", encoding="utf-8") as f:
+        if is_jsonl(path):
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+        else:
+            yield from iter_json_array(f)
+
+
+def load_records(path):
+    return list(iter_records(path))
+
+
+# finds an artifact whether it was written as .jsonl or by the older .json pipeline
+def resolve(path):
+    if os.path.exists(path):
+        return path
+    root, ext = os.path.splitext(path)
+    alternative = root + (".json" if ext == ".jsonl" else ".jsonl")
+    return alternative if os.path.exists(alternative) else path
+
+
+class RecordWriter:
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self._file = open(path, "w", encoding="utf-8")
+
+    def write(self, record):
+        self._file.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")))
+        self._file.write("\n")
+        self.count += 1
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def write_records(path, records):
+    with RecordWriter(path) as writer:
+        for record in records:
+            writer.write(record)
+    return writer.count
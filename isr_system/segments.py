@@ -0,0 +1,299 @@
+import argparse
+import json
+import math
+import os
+import threading
+import numpy as np
+from binary_index import BinaryIndex, BinaryIndexWriter
+from records import iter_records
+from text_operations import TextOperations
+from vocabulary import Vocabulary
+
+# an index made of immutable segments, so new articles don't mean rebuilding the archive.
+#
+# every segment is a self-contained binary index (see binary_index.py) with its own term
+# dictionary and doc table, its doc ids in url order. segments.json lists the live segments
+# and, per segment, the doc ids that were deleted (tombstones); it is the only file that ever
+# changes and it is replaced atomically, so readers see either the old or the new set.
+#
+# adding articles analyzes only the new ones and writes them as a new small segment. postings
+# hold length normalized tf (see term_weighting.py) and idf is applied to the query, from
+# the df kept in the segments' term dictionaries and the live document count of the
+# manifest, so an add never touches the existing segments beyond tombstones. an article
+# whose url is already indexed replaces the old copy, which gets a tombstone. new segments
+# index every non-stopword stem; the luhn cutoffs only apply to the full pipeline build.
+#
+# merging is tiered by size: segments are grouped by the order of magnitude of their live
+# documents, and MERGE_FACTOR segments of the same tier are merged into one, dropping their
+# deleted documents. a segment with EXPUNGE_RATIO of its documents deleted is rewritten on
+# its own. merges run in a background thread after every add.
+# one writer process at a time is assumed; inside it the manifest updates are serialized.
+
+class SegmentedIndex:
+
+    MANIFEST = "segments.json"
+    MERGE_FACTOR = 4
+    EXPUNGE_RATIO = 0.5
+
+    _write_lock = threading.Lock()
+    _merge_lock = threading.Lock()
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.manifest = SegmentedIndex.read_manifest(directory)
+        self.segments = []
+        for info in self.manifest["segments"]:
+            index = BinaryIndex(os.path.join(directory, info["name"]))
+            # norms of deleted documents are 0, which keeps them out of every ranking
+            live_norms = np.array(index.doc_norms)
+            live_norms[np.asarray(info["deleted"], dtype=np.int64)] = 0.0
+            self.segments.append((info, index, live_norms, set(info["deleted"])))
+        self.total_docs = sum(info["docs"] - len(info["deleted"]) for info in self.manifest["segments"])
+
+    # df over all segments; documents deleted since a segment was written still count until
+    # the segment is merged
+    def df(self, term):
+        total = 0
+        for _, index, _, _ in self.segments:
+            entry = index.lookup(term)
+            if entry is not None:
+                total += index.df(entry)
+        return total
+
+    # (segment number, doc id) of the live copy of a url
+    def find(self, url):
+        for number, (_, index, _, deleted) in enumerate(self.segments):
+            doc_id = index.find_doc(url)
+            if doc_id is not None and doc_id not in deleted:
+                return number, doc_id
+        return None
+
+    def manifest_path(directory):
+        return os.path.join(directory, SegmentedIndex.MANIFEST)
+
+    def is_segmented_index(path):
+        return os.path.isfile(SegmentedIndex.manifest_path(path))
+
+    def read_manifest(directory):
+        try:
+            with open(SegmentedIndex.manifest_path(directory), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {"next_segment": 0, "segments": []}
+
+    def write_manifest(directory, manifest):
+        path = SegmentedIndex.manifest_path(directory)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, separators=(",", ":"))
+        os.replace(tmp_path, path)
+
+    # renumbers the documents of an index in url order, so deletes can find them by binary search
+    def sort_docs_by_url(index, vocabulary):
+        order = sorted(range(vocabulary.num_docs), key=vocabulary.docs.__getitem__)
+        new_ids = np.empty(len(order), dtype=np.int64)
+        new_ids[order] = np.arange(len(order))
+        postings = []
+        for docs, weights in index["postings"]:
+            docs = new_ids[np.asarray(docs, dtype=np.int64)]
+            weights = np.asarray(weights, dtype=np.float64)
+            by_doc = np.argsort(docs)
+            postings.append((docs[by_doc], weights[by_doc]))
+        doc_norms = np.zeros(len(order))
+        stored_norms = np.asarray(index["doc_norms"], dtype=np.float64)
+        doc_norms[new_ids[:len(stored_norms)]] = stored_norms
+        sorted_index = {"total_docs": index["total_docs"], "doc_norms": doc_norms, "postings": postings}
+        return sorted_index, Vocabulary(vocabulary.terms, [vocabulary.docs[i] for i in order])
+
+    # writes a new segment file and returns its manifest entry, the caller adds it to the manifest
+    def write_segment(directory, manifest, index, vocabulary, df):
+        index, vocabulary = SegmentedIndex.sort_docs_by_url(index, vocabulary)
+        name = f"segment_{manifest['next_segment']:06d}.bin"
+        manifest["next_segment"] += 1
+        BinaryIndexWriter.write(os.path.join(directory, name), index, vocabulary, df)
+        return {"name": name, "docs": vocabulary.num_docs, "deleted": []}
+
+    # the output of the full pipeline build becomes a segment as it is
+    def import_index(directory, inverted_index_path, word_frequencies_path, vocabulary_path=None):
+        os.makedirs(directory, exist_ok=True)
+        with open(inverted_index_path, "r", encoding="utf-8") as f:
+            index = json.load(f)
+        with open(word_frequencies_path, "r", encoding="utf-8") as f:
+            df = json.load(f)["df"]
+        vocabulary = Vocabulary.load(vocabulary_path or Vocabulary.path_for(inverted_index_path))
+        with SegmentedIndex._write_lock:
+            manifest = SegmentedIndex.read_manifest(directory)
+            info = SegmentedIndex.write_segment(directory, manifest, index, vocabulary, df)
+            manifest["segments"].append(info)
+            SegmentedIndex.write_manifest(directory, manifest)
+        return info
+
+    def add_documents(directory, entries, merge=True, background=True):
+        os.makedirs(directory, exist_ok=True)
+        rows, _, _ = TextOperations.analyze_shard((list(entries), ()))
+        # a url repeated in the batch keeps its first copy, like the pipeline
+        unique = {}
+        for _, (url, words, tfs) in rows:
+            unique.setdefault(url, (words, tfs))
+
+        with SegmentedIndex._write_lock:
+            current = SegmentedIndex(directory)
+            manifest = current.manifest
+            replaced = [found for found in map(current.find, unique) if found is not None]
+
+            vocabulary = Vocabulary()
+            segment_df = []
+            rows = []
+            for url, (words, tfs) in unique.items():
+                vocabulary.add_doc(url)
+                term_ids = [vocabulary.add_term(word) for word in words]
+                while len(segment_df) < vocabulary.num_terms:
+                    segment_df.append(0)
+                for term_id in term_ids:
+                    segment_df[term_id] += 1
+                rows.append((term_ids, tfs))
+
+            postings = [([], []) for _ in range(vocabulary.num_terms)]
+            doc_norms = []
+            for doc_id, (term_ids, tfs) in enumerate(rows):
+                total_terms = sum(tfs) or 1
+                weights = [tf / total_terms for tf in tfs]
+                doc_norms.append(math.sqrt(sum(w * w for w in weights)))
+                for term_id, weight in zip(term_ids, weights):
+                    postings[term_id][0].append(doc_id)
+                    postings[term_id][1].append(weight)
+            index = {"total_docs": len(rows), "doc_norms": doc_norms, "postings": postings}
+            info = SegmentedIndex.write_segment(directory, manifest, index, vocabulary, segment_df)
+
+            for number, doc_id in replaced:
+                manifest["segments"][number]["deleted"].append(doc_id)
+            manifest["segments"].append(info)
+            SegmentedIndex.write_manifest(directory, manifest)
+
+        if merge:
+            SegmentedIndex.maybe_merge(directory, background)
+        return info
+
+    def delete_documents(directory, urls):
+        with SegmentedIndex._write_lock:
+            current = SegmentedIndex(directory)
+            manifest = current.manifest
+            deleted = 0
+            for url in urls:
+                found = current.find(url)
+                if found is not None:
+                    number, doc_id = found
+                    manifest["segments"][number]["deleted"].append(doc_id)
+                    deleted += 1
+            if deleted:
+                SegmentedIndex.write_manifest(directory, manifest)
+        return deleted
+
+    # names of the segments to merge next, or None
+    def pick_merge(manifest):
+        tiers = {}
+        for info in manifest["segments"]:
+            live = info["docs"] - len(info["deleted"])
+            if info["docs"] and len(info["deleted"]) >= info["docs"] * SegmentedIndex.EXPUNGE_RATIO:
+                return [info["name"]]
+            tiers.setdefault(int(math.log10(max(live, 1))), []).append(info["name"])
+        for tier in sorted(tiers):
+            if len(tiers[tier]) >= SegmentedIndex.MERGE_FACTOR:
+                return tiers[tier][:SegmentedIndex.MERGE_FACTOR]
+        return None
+
+    def maybe_merge(directory, background=True):
+        if not background:
+            SegmentedIndex.merge_tiers(directory)
+            return None
+        thread = threading.Thread(target=SegmentedIndex.merge_tiers, args=(directory,), name="segment-merge")
+        thread.start()
+        return thread
+
+    def merge_tiers(directory):
+        with SegmentedIndex._merge_lock:
+            while True:
+                names = SegmentedIndex.pick_merge(SegmentedIndex.read_manifest(directory))
+                if not names or not SegmentedIndex.merge_segments(directory, names):
+                    break
+
+    # merges the named segments into one, leaving out their deleted documents. the new segment
+    # is written without holding the write lock; documents deleted from the sources in the
+    # meantime are carried over as tombstones when the manifest is swapped.
+    def merge_segments(directory, names):
+        manifest = SegmentedIndex.read_manifest(directory)
+        by_name = {info["name"]: info for info in manifest["segments"]}
+        sources = [(name, set(by_name[name]["deleted"])) for name in names]
+
+        vocabulary = Vocabulary()
+        postings = []
+        df = []
+        doc_norms = []
+        new_ids = {}
+        for name, deleted in sources:
+            index = BinaryIndex(os.path.join(directory, name))
+            local_ids = np.full(index.num_docs, -1, dtype=np.int64)
+            for doc_id in range(index.num_docs):
+                url = index.url(doc_id)
+                # a url can only be live once, a second live copy is dropped like a deleted one
+                if doc_id not in deleted and vocabulary.doc_id(url) is None:
+                    local_ids[doc_id] = vocabulary.add_doc(url)
+                    doc_norms.append(float(index.doc_norms[doc_id]))
+            new_ids[name] = local_ids
+            for entry in range(index.num_terms):
+                term_id = vocabulary.add_term(index.term_name(entry))
+                if term_id == len(postings):
+                    postings.append(([], []))
+                    df.append(0)
+                docs, weights = index.postings(entry)
+                keep = local_ids[docs] >= 0
+                postings[term_id][0].extend(local_ids[docs[keep]].tolist())
+                postings[term_id][1].extend(weights[keep].tolist())
+                df[term_id] += index.df(entry) - int(len(docs) - keep.sum())
+            index.close()
+
+        merged = {"total_docs": vocabulary.num_docs, "doc_norms": doc_norms, "postings": postings}
+        with SegmentedIndex._write_lock:
+            manifest = SegmentedIndex.read_manifest(directory)
+            positions = [i for i, info in enumerate(manifest["segments"]) if info["name"] in names]
+            if len(positions) != len(names):
+                return False
+            info = SegmentedIndex.write_segment(directory, manifest, merged, vocabulary, df)
+            # tombstones that arrived during the merge, mapped to the urls of the new segment
+            merged_index = BinaryIndex(os.path.join(directory, info["name"]))
+            for name, deleted in sources:
+                late = set(manifest["segments"][positions[names.index(name)]]["deleted"]) - deleted
+                for doc_id in late:
+                    if new_ids[name][doc_id] >= 0:
+                        info["deleted"].append(merged_index.find_doc(vocabulary.docs[new_ids[name][doc_id]]))
+            merged_index.close()
+            segments = [s for s in manifest["segments"] if s["name"] not in names]
+            segments.insert(positions[0], info)
+            manifest["segments"] = segments
+            SegmentedIndex.write_manifest(directory, manifest)
+        for name in names:
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                # still open in a reader on a platform that can't remove open files
+                pass
+        return True
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=("import", "add", "delete", "merge"))
+    parser.add_argument("--index-dir", default="outputs/segments")
+    parser.add_argument("--input", help="articles to add (JSON array or JSONL)")
+    parser.add_argument("--url", action="append", default=[], help="url to delete, can be repeated")
+    args = parser.parse_args()
+
+    if args.command == "import":
+        info = SegmentedIndex.import_index(args.index_dir, "outputs/inverted_index.json", "outputs/word_frequencies.json")
+        print(f"imported {info['docs']} documents as {info['name']}")
+    elif args.command == "add":
+        info = SegmentedIndex.add_documents(args.index_dir, iter_records(args.input))
+        print(f"added {info['docs']} documents as {info['name']}")
+    elif args.command == "delete":
+        print(f"deleted {SegmentedIndex.delete_documents(args.index_dir, args.url)} documents")
+    else:
+        SegmentedIndex.merge_tiers(args.index_dir)
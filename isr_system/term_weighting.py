@@ -1,9 +1,20 @@
+import argparse
 import json
 import numpy as np
+from array import array
 from collections import Counter
+from records import iter_records, resolve, write_records
 
 # this module handles term weighting, including IDF and TF-IDF calculations.
 # it expects input files generated from the text_operations pipeline.
+# terms and documents are referred to by their vocabulary ids, so idf and the allowed
+# (luhn) terms are plain arrays indexed by term id.
+#
+# documents are weighted lnc.ltc style: the stored weight of a term in a document is its
+# length normalized tf, and idf is only applied to the query, with the df and document count
+# of the index at query time. adding or removing documents then only touches their own
+# postings and the df counters; no stored weight depends on the rest of the corpus.
+# apply_idf=True gives the classic tf-idf document weights.
 
 class TermWeighting:
 
@@ -19,53 +30,167 @@ class TermWeighting:
                 idf_data[term] = np.log2(total_docs / df)
         return idf_data
 
-    # compute TF-IDF for each document and term.
-    def compute_tf_idf(tf_data, word_frequencies, luhn_terms):
+    # boolean mask over term ids, true for the index terms kept by luhn's method
+    def allowed_mask(luhn_terms, num_terms):
+        mask = np.zeros(num_terms, dtype=bool)
+        index_terms = [term["term"] for term in luhn_terms.get("index_terms", [])]
+        mask[np.asarray(index_terms, dtype=np.int64)] = True
+        return mask
+
+    # idf for every term id, 0 for terms outside the allowed mask
+    def compute_idf_vector(df, total_docs, allowed=None):
+        df = np.asarray(df, dtype=np.float64)
+        valid = df > 0
+        if allowed is not None:
+            valid &= allowed
+        idf = np.zeros(len(df), dtype=np.float64)
+        idf[valid] = np.log2(total_docs / df[valid])
+        return idf
+
+    # compute the document weights for each document and term (normalized tf, or tf-idf
+    # with apply_idf), and the idf vector.
+    # tf_data rows are {"doc": id, "terms": [term ids], "tf": [counts]}, word_frequencies
+    # is {"cf": [...], "df": [...]} indexed by term id.
+    # the weights are a generator that reads tf_data once, a row at a time, so the corpus is
+    # never held in memory. the idf needs the number of documents before that: tf_data is
+    # counted with a pass of its own unless total_docs (count_docs) is given, which a one-shot
+    # iterator such as iter_records() needs.
+    def compute_tf_idf(tf_data, word_frequencies, luhn_terms, apply_idf=False, total_docs=None):
+        df = word_frequencies["df"]
         # extract allowed terms from Luhn's index terms
-        allowed_terms = set(term["term"] for term in luhn_terms.get("index_terms", []))
-        total_docs = len(tf_data)
-        idf_data = TermWeighting.compute_idf(word_frequencies, total_docs, allowed_terms=allowed_terms)
+        allowed = TermWeighting.allowed_mask(luhn_terms, len(df))
+        if total_docs is None:
+            if iter(tf_data) is tf_data:
+                raise ValueError("tf_data can only be read once, pass total_docs")
+            total_docs = TermWeighting.count_docs(tf_data)
+        idf = TermWeighting.compute_idf_vector(df, total_docs, allowed)
+
+        doc_weights = idf if apply_idf else allowed.astype(np.float64)
+        return TermWeighting.weigh_rows(tf_data, allowed, doc_weights), idf
+
+    def weigh_rows(tf_data, allowed, doc_weights):
+        for doc in TermWeighting.first_rows(tf_data):
+            term_ids = np.asarray(doc["terms"], dtype=np.int64)
+            tf = np.asarray(doc["tf"], dtype=np.float64)
+            total_terms_in_doc = tf.sum()
+            keep = allowed[term_ids]
+            term_ids = term_ids[keep]
+            # term frequency normalization
+            if total_terms_in_doc > 0:
+                tf_idf = tf[keep] / total_terms_in_doc * doc_weights[term_ids]
+            else:
+                tf_idf = np.zeros(len(term_ids))
+            yield {
+                "doc": doc["doc"],
+                "terms": term_ids.tolist(),
+                "tf_idf": tf_idf.tolist(),
+            }
 
-        tf_idf_data = []
+    # number of documents of tf_data, a repeated doc id counted once
+    def count_docs(tf_data):
+        return sum(1 for _ in TermWeighting.first_rows(tf_data))
+
+    # the rows of tf_data in doc id order; a repeated doc id (same url scraped twice) keeps its
+    # first row, like the index. both modes count the documents of the corpus this way.
+    def first_rows(tf_data):
+        last_doc = -1
         for doc in tf_data:
-            url = doc.get("url", "")
-            terms = doc.get("terms", [])
-            total_terms_in_doc = sum(term["tf"] for term in terms)
-            tf_idf_terms = []
-            for term_entry in terms:
-                term = term_entry["term"]
-                if term not in allowed_terms:
-                    continue
-                tf = term_entry["tf"]
-                # term frequency normalization
-                tf_norm = tf / total_terms_in_doc if total_terms_in_doc > 0 else 0
-                idf = idf_data.get(term, 0)
-                tf_idf = tf_norm * idf
-                tf_idf_terms.append({
-                    "term": term,
-                    "tf_idf": tf_idf
-                })
-            tf_idf_data.append({
-                "url": url,
-                "terms": tf_idf_terms
-            })
-        return tf_idf_data, idf_data
+            if doc["doc"] <= last_doc:
+                continue
+            last_doc = doc["doc"]
+            yield doc
+
+    # vectorized mode. the term frequencies are laid out as a doc x term csr matrix
+    # (indptr, indices, data arrays), rows are length normalized (and with apply_idf
+    # multiplied by the idf vector) in bulk, and the luhn mask is applied as a column selection. a row per document,
+    # from first_rows.
+    def tf_matrix(tf_data):
+        doc_ids = array("q")
+        indptr = array("q", [0])
+        indices = array("q")
+        tf = array("d")
+        for doc in TermWeighting.first_rows(tf_data):
+            doc_ids.append(doc["doc"])
+            indices.extend(doc["terms"])
+            tf.extend(doc["tf"])
+            indptr.append(len(indices))
+        return (
+            np.frombuffer(indptr, dtype=np.int64),
+            np.frombuffer(indices, dtype=np.int64),
+            np.frombuffer(tf, dtype=np.float64),
+            np.frombuffer(doc_ids, dtype=np.int64),
+        )
+
+    def compute_tf_idf_matrix(tf_data, word_frequencies, luhn_terms, apply_idf=False):
+        df = word_frequencies["df"]
+        num_terms = len(df)
+        indptr, indices, tf, doc_ids = TermWeighting.tf_matrix(tf_data)
+        num_docs = len(doc_ids)
+        allowed = TermWeighting.allowed_mask(luhn_terms, num_terms)
+        idf = TermWeighting.compute_idf_vector(df, num_docs, allowed)
+
+        rows = np.repeat(np.arange(num_docs), np.diff(indptr))
+        # the length normalization uses every term of the document, before the column selection
+        total_terms_in_doc = np.bincount(rows, weights=tf, minlength=num_docs)
+        keep = allowed[indices]
+        rows = rows[keep]
+        indices = indices[keep]
+        data = tf[keep] / total_terms_in_doc[rows]
+        if apply_idf:
+            data *= idf[indices]
+        indptr = np.concatenate(([0], np.cumsum(np.bincount(rows, minlength=num_docs))))
+        doc_norms = np.sqrt(np.bincount(rows, weights=data * data, minlength=num_docs))
+        return {
+            "indptr": indptr,
+            "indices": indices,
+            "data": data,
+            "shape": np.array([num_docs, num_terms]),
+            "doc_ids": doc_ids,
+            "doc_norms": doc_norms,
+            "idf": idf,
+        }
+
+    def save_tf_idf_matrix(path, matrix):
+        np.savez_compressed(path, **matrix)
+
+    def load_tf_idf_matrix(path):
+        with np.load(path) as npz:
+            return {key: npz[key] for key in npz.files}
+
+    # the matrix as a scipy.sparse.csr_matrix, scipy is only needed by callers that want one
+    def as_csr(matrix):
+        from scipy.sparse import csr_matrix
+
+        return csr_matrix(
+            (matrix["data"], matrix["indices"], matrix["indptr"]),
+            shape=tuple(matrix["shape"]),
+        )
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sparse", action="store_true",
+                        help="weight the whole corpus as one sparse matrix and save outputs/tfidf_results.npz")
+    args = parser.parse_args()
+
     # Load the required input files produced by the text_operations module
-    with open("outputs/term_frequencies.json", "r", encoding="utf-8") as f:
-        tf_data = json.load(f)
+    tf_path = resolve("outputs/term_frequencies.jsonl")
+    tf_data = iter_records(tf_path)
     with open("outputs/word_frequencies.json", "r", encoding="utf-8") as f:
         word_frequencies = json.load(f)
     with open("outputs/luhn_cutoffs_results.json", "r", encoding="utf-8") as f:
         luhn_terms = json.load(f)
 
-    # compute TF-IDF and IDF values for the filtered vocabulary
-    tf_idf_data, idf_data = TermWeighting.compute_tf_idf(tf_data, word_frequencies, luhn_terms)
+    if args.sparse:
+        matrix = TermWeighting.compute_tf_idf_matrix(tf_data, word_frequencies, luhn_terms)
+        TermWeighting.save_tf_idf_matrix("outputs/tfidf_results.npz", matrix)
+        idf = matrix["idf"]
+    else:
+        # compute TF-IDF and IDF values for the filtered vocabulary
+        total_docs = TermWeighting.count_docs(iter_records(tf_path))
+        tf_idf_data, idf = TermWeighting.compute_tf_idf(tf_data, word_frequencies, luhn_terms, total_docs=total_docs)
 
-    # save TF-IDF results for each document
-    with open("outputs/tfidf_results.json", "w", encoding="utf-8") as f:
-        json.dump(tf_idf_data, f, indent=2, ensure_ascii=False)
-    # save global IDF values for all index terms
+        # save TF-IDF results for each document, as they are computed
+        write_records("outputs/tfidf_results.jsonl", tf_idf_data)
+    # save global IDF values for all index terms, indexed by term id
     with open("outputs/idf_values.json", "w", encoding="utf-8") as f:
-        json.dump(idf_data, f, indent=2, ensure_ascii=False)
\ No newline at end of file
+        json.dump({"idf": idf.tolist()}, f, separators=(",", ":"))
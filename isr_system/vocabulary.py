@@ -0,0 +1,62 @@
+import json
+import os
+
+# the vocabulary maps every term to an integer term id and every document url to an integer
+# doc id. it is built once by the text_operations pipeline, in first-seen order, and all later
+# artifacts (term frequencies, word frequencies, tf-idf, inverted index) refer to terms and
+# documents by these ids only. lists indexed by id hold the strings for the way back.
+
+class Vocabulary:
+
+    FILE_NAME = "vocabulary.json"
+
+    def __init__(self, terms=None, docs=None):
+        self.terms = list(terms or [])
+        self.docs = list(docs or [])
+        self.term_ids = {term: term_id for term_id, term in enumerate(self.terms)}
+        self.doc_ids = {url: doc_id for doc_id, url in enumerate(self.docs)}
+
+    # returns the id of the term, adding it when it is new
+    def add_term(self, term):
+        term_id = self.term_ids.get(term)
+        if term_id is None:
+            term_id = len(self.terms)
+            self.term_ids[term] = term_id
+            self.terms.append(term)
+        return term_id
+
+    def add_doc(self, url):
+        doc_id = self.doc_ids.get(url)
+        if doc_id is None:
+            doc_id = len(self.docs)
+            self.doc_ids[url] = doc_id
+            self.docs.append(url)
+        return doc_id
+
+    def term_id(self, term):
+        return self.term_ids.get(term)
+
+    def doc_id(self, url):
+        return self.doc_ids.get(url)
+
+    @property
+    def num_terms(self):
+        return len(self.terms)
+
+    @property
+    def num_docs(self):
+        return len(self.docs)
+
+    def save(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"terms": self.terms, "docs": self.docs}, f, ensure_ascii=False, separators=(",", ":"))
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return cls(data["terms"], data["docs"])
+
+    # the vocabulary is written next to the other artifacts of the same build
+    def path_for(artifact_path):
+        return os.path.join(os.path.dirname(os.path.abspath(artifact_path)), Vocabulary.FILE_NAME)